@@ -1,20 +1,39 @@
 import os
+import sys
 import time
+import atexit
+import socket
+import uuid
+import json
+import queue
+import heapq
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 import threading
 import re
 import html
+import hmac
+import hashlib
+from collections import defaultdict, OrderedDict
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from urllib.parse import quote
+import random
 import requests
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
 
 
 # 👇 УНИВЕРСАЛЬНЫЙ КАССИР CRYPTOBOT (ДЛЯ РЕКЛАМЫ И ШТРАФОВ) 👇
+# Одна keep-alive сессия на процесс (без нового TLS-рукопожатия на каждый счет)
+# и небольшой пул, чтобы счета в разных валютах создавались параллельно.
+CRYPTO_TIMEOUT = float(os.getenv("CRYPTO_TIMEOUT", 10))
+crypto_session = requests.Session()
+crypto_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=8))
+crypto_executor = ThreadPoolExecutor(max_workers=4)
+
 def get_crypto_pay_url(custom_payload, amount_stars, description, asset=None):
-    import os
-    import requests
-    
     amount_rub = int(amount_stars * 1.8)
     API_TOKEN = os.getenv("CRYPTO_TOKEN")
     
@@ -41,7 +60,7 @@ def get_crypto_pay_url(custom_payload, amount_stars, description, asset=None):
         payload["asset"] = asset
     
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
+        response = crypto_session.post(url, json=payload, headers=headers, timeout=CRYPTO_TIMEOUT)
         res = response.json()
         
         if res.get("ok"): 
@@ -51,6 +70,11 @@ def get_crypto_pay_url(custom_payload, amount_stars, description, asset=None):
         
     return None
 
+def get_crypto_pay_urls(custom_payload, amount_stars, description, assets):
+    """Создает счета сразу во всех валютах параллельно: {asset: url или None}"""
+    futures = {asset: crypto_executor.submit(get_crypto_pay_url, custom_payload, amount_stars, description, asset) for asset in assets}
+    return {asset: future.result() for asset, future in futures.items()}
+
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 ATTEMPTS_PER_PAGE = 10
@@ -63,6 +87,14 @@ from datetime import datetime, timedelta
 def now_ekb():
     return datetime.now(timezone('Asia/Yekaterinburg'))
 
+def to_utc_naive(dt):
+    """Дата из кода (ЕКБ, с tz) или из Mongo (UTC без tz) -> UTC без tz"""
+    return dt.astimezone(pytz.utc).replace(tzinfo=None) if dt.tzinfo else dt
+
+def now_utc():
+    """Текущее время в том виде, в каком Mongo возвращает даты (UTC без tz) — для сравнений с ними"""
+    return to_utc_naive(now_ekb())
+
 ekb_tz = pytz.timezone('Asia/Yekaterinburg')
 today = now_ekb().astimezone(ekb_tz).date()
 
@@ -76,8 +108,9 @@ def to_ekb_str(dt, format_str='%d.%m.%Y %H:%M'):
 import telebot
 from telebot import types
 from telebot.apihelper import ApiTelegramException
+from telebot.handler_backends import HandlerBackend
 
-from flask import Flask, request, Response
+from flask import Flask, request, Response, jsonify
 
 # Собственная функция для экранирования спецсимволов Markdown
 def escape_md(text):
@@ -87,30 +120,165 @@ def escape_md(text):
     return text
 
 # 👇 УМНЫЙ ФИЛЬТР СТОП-СЛОВ (КРАСНАЯ ЗОНА + ЧЕРНАЯ ЗОНА) 👇
-def check_stop_words(text, ignore_black_zone=False):
-    if not text: return False, None
-    text_lower = text.lower()
-    dict_data = db['settings'].find_one({"_id": "skynet_dictionary"}) or {}
-    
-    # 1. КРАСНАЯ ЗОНА (Проверяем ВСЕГДА у всех)
-    for w in dict_data.get("red", []):
-        pattern = w.get("pattern", rf"\b{w['word']}\b")
-        try:
-            if re.search(pattern, text_lower, re.IGNORECASE):
-                return True, w['word']
-        except: pass
-
-    # 2. ЧЕРНАЯ ЗОНА (Пропускаем, если у юзера VIP-тариф)
-    if not ignore_black_zone:
-        for w in dict_data.get("black", []):
-            pattern = w.get("pattern", rf"{w['word']}")
+# Матчер собирается один раз на версию словаря (см. settings_cache): простые слова зоны — в один
+# автомат Ахо-Корасик, записи с regex — в одну скомпилированную альтернацию. Один проход по тексту
+# на зону вне зависимости от размера словаря.
+LINK_PATTERN = re.compile(r'(t\.me/|@\w+|http)')
+REGEX_CHARS = set(r".^$*+?{}[]\|()")
+
+def is_word_boundary(text, pos):
+    """Аналог \\b: с одной стороны позиции буква/цифра/_, с другой — нет"""
+    is_word = lambda i: 0 <= i < len(text) and (text[i].isalnum() or text[i] == "_")
+    return is_word(pos - 1) != is_word(pos)
+
+class WordAutomaton:
+    """Автомат Ахо-Корасик по набору слов (поиск подстрок за один проход)"""
+    def __init__(self, words):
+        self.goto = [{}]   # состояние -> {символ: состояние}
+        self.fail = [0]
+        self.output = [[]] # состояние -> индексы слов, заканчивающихся здесь
+        self.words = words
+        for idx, word in enumerate(words):
+            state = 0
+            for ch in word:
+                if ch not in self.goto[state]:
+                    self.goto.append({}); self.fail.append(0); self.output.append([])
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.output[state].append(idx)
+        # Суффиксные ссылки обходом в ширину
+        queue_states = list(self.goto[0].values())
+        for state in queue_states:
+            for ch, nxt in self.goto[state].items():
+                queue_states.append(nxt)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nxt] = self.goto[fallback].get(ch, 0)
+                self.output[nxt] += self.output[self.fail[nxt]]
+
+    def iter_matches(self, text):
+        """(начало, конец, индекс слова) для всех вхождений, по возрастанию конца"""
+        state = 0
+        for pos, ch in enumerate(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for idx in self.output[state]:
+                yield pos + 1 - len(self.words[idx]), pos + 1, idx
+
+# Шаблоны, которые нельзя вклеить в общую альтернацию: нумерация групп в ней сдвигается,
+# и \1 начнет ссылаться на чужую группу; свои именованные группы конфликтуют между записями
+STANDALONE_REGEX = re.compile(r"\\[1-9]|\(\?P[<=]")
+
+def embeds_in_alternation(pattern):
+    """Можно ли вклеить шаблон в альтернацию: (?i) и прочие глобальные флаги валидны только в начале"""
+    try:
+        re.compile(f"x|(?P<w0>{pattern})")
+        return True
+    except re.error:
+        return False
+
+class StopWordZone:
+    """Одна зона словаря: автомат по простым словам + общая regex-альтернация"""
+    def __init__(self, entries, whole_words):
+        self.whole_words = whole_words # красная зона: простые слова ищем целиком (\b...\b)
+        plain, self.plain_labels = [], []
+        parts, self.regex_labels = [], []
+        standalone, self.standalone_labels = [], []
+        for entry in entries:
+            word = str(entry.get("word", ""))
+            if "pattern" not in entry and word and not REGEX_CHARS & set(word):
+                plain.append(word.lower()); self.plain_labels.append(word)
+            elif word or entry.get("pattern"):
+                pattern = entry.get("pattern") or (rf"\b{word}\b" if whole_words else word)
+                try: compiled = re.compile(pattern, re.IGNORECASE)
+                except re.error: continue # Битую запись пропускаем, как и раньше
+                label = word or pattern # Пустая метка — ложь, и попадание потерялось бы
+                if not STANDALONE_REGEX.search(pattern) and embeds_in_alternation(pattern):
+                    parts.append(pattern); self.regex_labels.append(label)
+                else:
+                    standalone.append(compiled); self.standalone_labels.append(label)
+        self.automaton = WordAutomaton(plain) if plain else None
+        self.combined = None
+        if parts:
             try:
-                if re.search(pattern, text_lower, re.IGNORECASE):
-                    match = re.search(pattern, text_lower, re.IGNORECASE)
-                    return True, match.group(0)
-            except: pass
+                self.combined = re.compile("|".join(f"(?P<w{i}>{p})" for i, p in enumerate(parts)), re.IGNORECASE)
+            except re.error as e:
+                # Страховка: общая альтернация не собралась — все записи проверяются по отдельности
+                print(f"⚠️ Общая regex стоп-слов не собралась, проверяю записи по одной: {e}", flush=True)
+                standalone += [re.compile(p, re.IGNORECASE) for p in parts]
+                self.standalone_labels += self.regex_labels
+                self.regex_labels = []
+        self.patterns = standalone
+
+    def find_plain(self, text):
+        if not self.automaton: return None
+        best = None
+        for start, end, idx in self.automaton.iter_matches(text):
+            if best and start >= best[0]: continue
+            if self.whole_words and not (is_word_boundary(text, start) and is_word_boundary(text, end)): continue
+            best = (start, idx, text[start:end])
+        return best
+
+    def find_regex(self, text):
+        """Самое раннее попадание regex-записей: (позиция, метка, фрагмент) или None"""
+        hits = []
+        if self.combined:
+            m = self.combined.search(text)
+            # lastgroup — самая внешняя группа альтернации, т.е. наша w{i}
+            if m: hits.append((m.start(), self.regex_labels[int(m.lastgroup[1:])], m.group(0)))
+        for label, pattern in zip(self.standalone_labels, self.patterns):
+            m = pattern.search(text)
+            if m: hits.append((m.start(), label, m.group(0)))
+        return min(hits, key=lambda hit: hit[0]) if hits else None
+
+    def find(self, text):
+        """Самое раннее попадание в тексте: (слово из словаря, найденный фрагмент) или None"""
+        hits = []
+        plain_hit = self.find_plain(text)
+        if plain_hit: hits.append((plain_hit[0], self.plain_labels[plain_hit[1]], plain_hit[2]))
+        regex_hit = self.find_regex(text)
+        if regex_hit: hits.append(regex_hit)
+        if not hits: return None
+        _, label, fragment = min(hits, key=lambda hit: hit[0])
+        return label, fragment
+
+class StopWordMatcher:
+    def __init__(self, dict_data, version):
+        self.version = version
+        self.red = StopWordZone(dict_data.get("red", []), whole_words=True)
+        self.black = StopWordZone(dict_data.get("black", []), whole_words=False)
+
+    def scan(self, text, ignore_black_zone=False):
+        """(красное слово, черный фрагмент, есть ли ссылки) за один вызов"""
+        text_lower = (text or "").lower()
+        red_hit = self.red.find(text_lower)
+        black_hit = None if ignore_black_zone else self.black.find(text_lower)
+        return (red_hit[0] if red_hit else None,
+                black_hit[1] if black_hit else None,
+                bool(LINK_PATTERN.search(text_lower)))
+
+stop_word_matcher = None
+
+def get_stop_word_matcher():
+    """Матчер под текущую версию словаря; пересобирается только при ее смене"""
+    global stop_word_matcher
+    dict_data, version = settings_cache.snapshot("skynet_dictionary")
+    matcher = stop_word_matcher
+    if matcher is None or matcher.version != version:
+        matcher = stop_word_matcher = StopWordMatcher(dict_data or {}, version)
+        inc_metric("stop_word_matcher_builds")
+    return matcher
 
-    return False, None
+def check_stop_words(text, ignore_black_zone=False):
+    """(запрещено ли, сработавшее слово, есть ли ссылки) — всё за один проход матчера"""
+    if not text: return False, None, False
+    # Красная зона — всегда у всех, черная пропускается у VIP-тарифа
+    red_word, black_fragment, has_links = get_stop_word_matcher().scan(text, ignore_black_zone)
+    if red_word: return True, red_word, has_links
+    if black_fragment: return True, black_fragment, has_links
+    return False, None, has_links
 
 def escape_html(text):
     """
@@ -120,9 +288,14 @@ def escape_html(text):
         text = str(text)
     return html.escape(text)
 
+# Служебная команда при запуске скриптом (python mpserv.py <команда>): фоновые задачи не стартуют
+CLI_COMMAND = sys.argv[1] if __name__ == '__main__' and len(sys.argv) > 1 else None
+
 # Получаем токен из переменной окружения
 TOKEN = os.getenv('BOT_TOKEN')
-bot = telebot.TeleBot(TOKEN)
+# threaded=False: хендлеры выполняются прямо в воркерах очереди апдейтов (см. UpdateDispatcher),
+# иначе телебот раскидает их по своему пулу и порядок сообщений одного юзера потеряется
+bot = telebot.TeleBot(TOKEN, threaded=False)
 
 # Создаём Flask-приложение
 app = Flask(__name__)
@@ -142,6 +315,199 @@ autopost_queue = db['autopost_queue']       # НОВАЯ: Очередь авт
 promocodes_collection = db['promocodes']    # СУЩЕСТВУЮЩАЯ ИЗ СКАЙНЕТА
 ad_templates_collection = db['ad_templates'] # НОВАЯ: Шаблоны пользователей
 admins_collection = db['admins']            # НОВАЯ: Список админов
+post_quota_collection = db['post_quota']    # НОВАЯ: Леджер дневных квот (user, сеть, город, день)
+# =============================================================
+
+# ==================== 📈 МЕТРИКИ (/metrics) ====================
+# Эндпоинт закрыт токеном: curl -H "X-Metrics-Token: $METRICS_TOKEN" .../metrics
+# Без METRICS_TOKEN в окружении /metrics отдает 404.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+_metrics_lock = threading.Lock()
+metrics_counters = defaultdict(int) # Счетчики событий (растут с момента старта процесса)
+metrics_gauges = {}                 # Мгновенные значения: имя -> функция без аргументов
+
+def inc_metric(name, value=1):
+    """Потокобезопасно увеличивает счетчик метрики"""
+    with _metrics_lock:
+        metrics_counters[name] += value
+
+def get_metrics_snapshot():
+    """Снимок всех счетчиков и gauge-значений для /metrics"""
+    with _metrics_lock:
+        snapshot = dict(metrics_counters)
+    for name, getter in metrics_gauges.items():
+        try: snapshot[name] = getter()
+        except Exception: snapshot[name] = None
+    return snapshot
+# =============================================================
+
+# ==================== ⚙️ КЭШ НАСТРОЕК СКАЙНЕТА ====================
+# Словарь стоп-слов, тарифы и матрица чатов меняются в основном боте несколько раз в день,
+# а читаются на каждом объявлении. Держим их в памяти процесса: у каждого ключа своя версия
+# (растет только при реальном изменении документа). Сброс — по change stream Mongo; если
+# реплика-сета нет, работаем по TTL: устаревшее значение отдаем сразу и обновляем в фоне.
+SETTINGS_CACHE_TTL = int(os.getenv("SETTINGS_CACHE_TTL", 60)) # сек, только без change stream
+# autopost_signal — счетчик изменений очереди автопостинга (см. AutopostScheduler), нужен ради подписки
+CACHED_SETTINGS = ["skynet_dictionary", "skynet_pricing", "infrastructure", "autopost_signal"]
+
+class SettingsCache:
+    def __init__(self, collection, keys, ttl):
+        self.collection = collection
+        self.keys = list(keys)
+        self.ttl = ttl
+        self.entries = {}       # _id -> (документ, версия, время загрузки)
+        self.refreshing = set() # ключи, которые сейчас обновляются в фоне
+        self.watching = False   # change stream жив -> TTL не нужен
+        self.listeners = defaultdict(list) # key -> функции без аргументов, зовутся при смене версии
+        self.lock = threading.Lock()
+
+    def load(self, key):
+        """Читает документ из Mongo; версия растет, только если содержимое изменилось"""
+        doc = self.collection.find_one({"_id": key})
+        with self.lock:
+            old = self.entries.get(key)
+            version = 1 if old is None else old[1] + (old[0] != doc)
+            self.entries[key] = (doc, version, time.time())
+            self.refreshing.discard(key)
+        inc_metric("settings_loads")
+        if old is not None and version != old[1]:
+            for listener in self.listeners[key]: listener()
+        return doc, version
+
+    def refresh_in_background(self, key):
+        try: self.load(key)
+        except Exception as e:
+            with self.lock: self.refreshing.discard(key)
+            print(f"⚠️ Не удалось обновить настройку {key}: {e}", flush=True)
+
+    def snapshot(self, key):
+        """(документ или None, версия). Первое чтение синхронное, дальше — stale-while-revalidate"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                is_stale = not self.watching and time.time() - entry[2] > self.ttl
+                if is_stale and key not in self.refreshing:
+                    self.refreshing.add(key)
+                    threading.Thread(target=self.refresh_in_background, args=(key,), daemon=True).start()
+        if entry is None:
+            inc_metric("settings_misses")
+            return self.load(key)
+        inc_metric("settings_hits")
+        return entry[0], entry[1]
+
+    def get(self, key):
+        return self.snapshot(key)[0]
+
+    def version(self, key):
+        return self.snapshot(key)[1]
+
+    # Коды «change streams здесь не бывает» (standalone-сервер, старый Mongo): только тогда уходим на TTL
+    CHANGE_STREAM_UNSUPPORTED_CODES = (40573, 40324, 115)
+
+    def watch_forever(self):
+        """Слушает изменения settings; без реплика-сета выходит и оставляет TTL"""
+        pipeline = [{"$match": {"documentKey._id": {"$in": self.keys}}}]
+        backoff = 1
+        while True:
+            try:
+                with self.collection.watch(pipeline) as stream:
+                    self.watching = True
+                    backoff = 1
+                    # Пока стрима не было, изменения могли пройти мимо — перечитываем то, что уже в кэше
+                    for key in list(self.entries):
+                        self.load(key)
+                    for change in stream:
+                        self.load(change["documentKey"]["_id"])
+            except OperationFailure as e:
+                self.watching = False
+                if e.code in self.CHANGE_STREAM_UNSUPPORTED_CODES:
+                    print(f"ℹ️ Change stream недоступен ({e.code}), настройки обновляются по TTL {self.ttl} сек", flush=True)
+                    return
+                # ChangeStreamHistoryLost и прочие временные сбои: пока стрима нет, работает TTL, потом переоткрываем
+                print(f"⚠️ Change stream настроек упал ({e.code}), переоткрываем через {backoff} сек: {e}", flush=True)
+            except PyMongoError as e:
+                self.watching = False
+                print(f"⚠️ Change stream настроек оборвался, переоткрываем через {backoff} сек: {e}", flush=True)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+settings_cache = SettingsCache(db['settings'], CACHED_SETTINGS, SETTINGS_CACHE_TTL)
+metrics_gauges["settings_change_stream"] = lambda: int(settings_cache.watching)
+if not CLI_COMMAND:
+    threading.Thread(target=settings_cache.watch_forever, daemon=True).start()
+# =============================================================
+
+# ==================== 🧩 СОСТОЯНИЕ NEXT-STEP ДИАЛОГОВ ====================
+# Шаги визарда храним не как замыкания в памяти процесса, а как компактные дескрипторы
+# {step, args, kwargs} (имя шага + сеть, город и т.п.). Так диалог переживает рестарт и деплой:
+# его продолжает новый процесс. Черновик объявления и так лежит в db['users'].
+STEP_BACKEND = os.getenv("STEP_BACKEND", "mongo") # mongo | memory (локальный запуск в одном процессе)
+STEP_TTL_HOURS = int(os.getenv("STEP_TTL_HOURS", 24))
+wizard_steps = {}
+
+def wizard_step(func):
+    """Регистрирует функцию как шаг next_step-диалога (ищется по имени)"""
+    wizard_steps[func.__name__] = func
+    return func
+
+def dump_step(handler):
+    """Handler телебота -> сериализуемый дескриптор шага"""
+    callback = handler["callback"]
+    name = getattr(callback, "__name__", None)
+    if wizard_steps.get(name) is not callback:
+        raise ValueError(f"Шаг {name} не зарегистрирован через @wizard_step")
+    return {"step": name, "args": list(handler["args"]), "kwargs": dict(handler["kwargs"])}
+
+def load_step(descriptor):
+    """Дескриптор -> Handler телебота (None, если такого шага больше нет в коде)"""
+    callback = wizard_steps.get(descriptor.get("step"))
+    if not callback: return None
+    return telebot.Handler(callback, *descriptor.get("args", []), **descriptor.get("kwargs", {}))
+
+class MongoStepBackend(HandlerBackend):
+    """Шаги в коллекции step_states (переживают рестарт процесса), брошенные диалоги чистит TTL-индекс"""
+    def __init__(self, collection):
+        super().__init__()
+        self.collection = collection
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def register_handler(self, handler_group_id, handler):
+        self.collection.update_one(
+            {"_id": handler_group_id},
+            {"$push": {"steps": dump_step(handler)}, "$set": {"expires_at": now_ekb() + timedelta(hours=STEP_TTL_HOURS)}},
+            upsert=True
+        )
+
+    def clear_handlers(self, handler_group_id):
+        self.collection.delete_one({"_id": handler_group_id})
+
+    def get_handlers(self, handler_group_id):
+        # Забираем и удаляем атомарно: во время деплоя старый и новый процесс не выполнят шаг дважды
+        doc = self.collection.find_one_and_delete({"_id": handler_group_id})
+        if not doc: return None
+        return [h for h in map(load_step, doc.get("steps", [])) if h] or None
+
+class MemoryStepBackend(HandlerBackend):
+    """Те же дескрипторы, но в памяти процесса — для локального запуска без общей базы состояний"""
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+
+    def register_handler(self, handler_group_id, handler):
+        with self._lock:
+            self.handlers.setdefault(handler_group_id, []).append(dump_step(handler))
+
+    def clear_handlers(self, handler_group_id):
+        with self._lock:
+            self.handlers.pop(handler_group_id, None)
+
+    def get_handlers(self, handler_group_id):
+        with self._lock:
+            steps = self.handlers.pop(handler_group_id, None)
+        if not steps: return None
+        return [h for h in map(load_step, steps) if h] or None
+
+bot.next_step_backend = MemoryStepBackend() if STEP_BACKEND == "memory" else MongoStepBackend(db['step_states'])
 # =============================================================
 
 # ADMIN ID (ваш ID)
@@ -157,27 +523,198 @@ def send_error_to_admin(e, context=""):
     error_trace = traceback.format_exc()
     error_msg = f"🚨 <b>КРИТИЧЕСКАЯ ОШИБКА ({context})</b>\n\n<pre>{escape_html(error_trace[-800:])}</pre>"
     try:
-        bot.send_message(ADMIN_CHAT_ID, error_msg, parse_mode="HTML")
+        tg.send_message(ADMIN_CHAT_ID, error_msg, parse_mode="HTML")
     except:
         pass
 
-# Самоочистка базы данных (чтобы сервер никогда не переполнился)
-db['failed_attempts'].create_index("time", expireAfterSeconds=2592000) # Удаляет логи отказов через 30 дней
-ad_posts_collection.create_index("time", expireAfterSeconds=7776000) # Удаляет историю постов через 90 дней
+# ==================== 🗂 ИНДЕКСЫ MONGODB ====================
+# Все индексы в одном месте: (коллекция, ключи, опции). create_index с тем же описанием —
+# no-op, поэтому список безопасно прогонять на каждом старте.
+# Проверить, что горячие запросы не сканируют коллекции: python mpserv.py verify-indexes
+INDEX_SPECS = [
+    # Самоочистка базы данных (чтобы сервер никогда не переполнился)
+    ("failed_attempts", [("time", 1)], {"expireAfterSeconds": 2592000}), # Удаляет логи отказов через 30 дней
+    ("price_quotes", [("expires_at", 1)], {"expireAfterSeconds": 0}),     # Котировки тарифов живут QUOTE_TTL_MINUTES
+    ("crypto_invoices", [("expires_at", 1)], {"expireAfterSeconds": 0}),  # Кэш счетов CryptoBot
+    ("crypto_invoices", [("payload", 1)], {}),                            # Сброс кэша после оплаты
+    # Журнал платежей: очередь на выдачу и защита от двойной выдачи
+    ("payment_events", [("status", 1), ("created_at", 1)], {}),
+    ("ad_subscriptions", [("payment_id", 1)], {"unique": True, "partialFilterExpression": {"payment_id": {"$exists": True}}}),
+    ("daily_revenue", [("payment_id", 1)], {"unique": True, "partialFilterExpression": {"payment_id": {"$exists": True}}}),
+    ("ad_posts", [("time", 1)], {"expireAfterSeconds": 7776000}),        # Удаляет историю постов через 90 дней
+    # Админка: keyset-пагинация по (time, _id), свежие сверху
+    ("failed_attempts", [("time", -1), ("_id", -1)], {}),
+    ("ad_posts", [("time", -1), ("_id", -1)], {}),
+    # is_user_paid, проверка ссылок/закрепа: user_id + city + network ($in) + end_date.
+    # Он же ведет список оплативших: обход по user_id, фильтры проверяются по ключам индекса
+    ("ad_subscriptions", [("user_id", 1), ("city", 1), ("network", 1), ("end_date", 1)], {}),
+    ("ad_subscriptions", [("end_date", 1)], {}),
+    # Напоминания об окончании: поле есть только у подписок, которым еще есть что слать
+    ("ad_subscriptions", [("next_notify_at", 1)], {"name": "due_notifications"}),
+    # Лимит 3 поста в день: один счетчик на (user, день, сеть, город); уникальность делает upsert атомарным
+    ("post_quota", [("user_id", 1), ("day", 1), ("network", 1), ("city", 1)], {"unique": True}),
+    ("post_quota", [("expires_at", 1)], {"expireAfterSeconds": 0}), # Старые дни удаляются сами
+    ("post_quota", [("day", 1)], {}), # Сводка дня для админской статистики
+    # «Удалить объявление»: только живые посты юзера, свежие сверху
+    ("ad_posts", [("user_id", 1), ("time", -1)], {"name": "user_live_posts", "partialFilterExpression": {"deleted": False}}),
+    # Пересинхронизация кучи автопостинга: только задачи, у которых остались посты
+    ("autopost_queue", [("next_run", 1)], {"name": "due_autoposts", "partialFilterExpression": {"posts_left": {"$gt": 0}}}),
+    # «Мои автопосты»
+    ("autopost_queue", [("user_id", 1), ("next_run", 1)], {}),
+    # «Мои шаблоны»
+    ("ad_templates", [("user_id", 1), ("created_at", -1)], {}),
+]
+
+def ensure_indexes():
+    """Идемпотентно создает все индексы из INDEX_SPECS"""
+    for collection_name, keys, options in INDEX_SPECS:
+        try:
+            db[collection_name].create_index(keys, **options)
+        except OperationFailure as e:
+            # Индекс с тем же именем, но другими опциями (например, сменили TTL) — старт не валим
+            print(f"⚠️ Индекс {collection_name} {keys} не создан: {e}", flush=True)
+
+# Формы горячих запросов для verify-indexes: (название, коллекция, фильтр, сортировка)
+_sample_time = datetime(2000, 1, 1)
+HOT_QUERIES = [
+    ("is_user_paid", "ad_subscriptions", {"user_id": 0, "city": "", "network": {"$in": ["Все сети", ""]}, "end_date": {"$gt": _sample_time}}, None),
+    ("get_user_statistics", "post_quota", {"user_id": 0, "day": ""}, None),
+    ("admin_statistics", "post_quota", {"day": ""}, None),
+    ("admin_statistics_subs", "ad_subscriptions", {"user_id": {"$in": [0, 1]}}, None),
+    ("paid_users_page", "ad_subscriptions", {"end_date": {"$gt": _sample_time}, "network": {"$in": ["НС", "Все сети"]}, "user_id": {"$gt": 0}}, [("user_id", 1)]),
+    ("due_notifications", "ad_subscriptions", {"next_notify_at": {"$lte": _sample_time}}, [("next_notify_at", 1)]),
+    ("autopost_resync", "autopost_queue", {"posts_left": {"$gt": 0}}, [("next_run", 1)]),
+    ("user_live_posts", "ad_posts", {"user_id": 0, "deleted": False}, [("time", -1)]),
+    ("user_templates", "ad_templates", {"user_id": 0}, [("created_at", -1)]),
+    ("failed_attempts_page", "failed_attempts", {"$or": [{"time": {"$lt": _sample_time}}, {"time": _sample_time, "_id": {"$lt": ObjectId()}}]}, [("time", -1), ("_id", -1)]),
+    ("post_history_page", "ad_posts", {"$or": [{"time": {"$lt": _sample_time}}, {"time": _sample_time, "_id": {"$lt": ObjectId()}}]}, [("time", -1), ("_id", -1)]),
+]
+
+def get_plan_stages(plan):
+    """Плоский список stage из дерева плана (inputStage / inputStages / queryPlan у SBE)"""
+    stages = [plan["stage"]] if "stage" in plan else []
+    children = list(plan.get("inputStages", []))
+    for key in ("inputStage", "queryPlan"):
+        if key in plan: children.append(plan[key])
+    for child in children:
+        stages += get_plan_stages(child)
+    return stages
+
+def verify_query_plans():
+    """Прогоняет explain() по HOT_QUERIES и возвращает список запросов, упавших в COLLSCAN"""
+    failed = []
+    for name, collection_name, query, sort in HOT_QUERIES:
+        cursor = db[collection_name].find(query)
+        if sort: cursor = cursor.sort(sort)
+        stages = get_plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+        is_collscan = "COLLSCAN" in stages
+        print(f"{'❌' if is_collscan else '✅'} {name}: {' <- '.join(stages)}", flush=True)
+        if is_collscan: failed.append(name)
+    return failed
+
+ensure_indexes()
+# =============================================================
+
+# ==================== ✍️ ОТЛОЖЕННАЯ ЗАПИСЬ ЖУРНАЛОВ ====================
+# Журнал отказов пишется на пути запроса пачкой одиночных insert_one. Вместо этого он копится
+# в буфере и пишется insert_many: как только набралось WRITE_BATCH_SIZE документов или прошло
+# WRITE_FLUSH_SECONDS. _id проставляется сразу, поэтому повтор пачки после сетевой ошибки не плодит дубли.
+# Буфер живет в памяти процесса и при SIGKILL теряется, поэтому сюда идут только журналы, которые
+# никто не читает обратно. История постов (ad_posts) пишется синхронно, но пачкой: вся публикация
+# ("Все сети" — десятки чатов) — один insert_many и один bulk_write в леджер (add_posts_to_history).
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 50))
+WRITE_FLUSH_SECONDS = float(os.getenv("WRITE_FLUSH_SECONDS", 1))
+WRITE_BUFFER_LIMIT = int(os.getenv("WRITE_BUFFER_LIMIT", 5000)) # Пока Mongo недоступна, старые записи вытесняются
+
+class BufferedWriter:
+    def __init__(self, collection, max_batch, max_delay, max_buffer=WRITE_BUFFER_LIMIT):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.lock = threading.Lock()        # буфер
+        self.flush_lock = threading.Lock()  # одна запись за раз, чтобы пачки шли по порядку
+        self.wake = threading.Event()
+
+    def add(self, doc):
+        """Ставит документ в очередь на запись и возвращает его _id"""
+        doc.setdefault("_id", ObjectId())
+        with self.lock:
+            self.buffer.append(doc)
+            self.trim()
+            full = len(self.buffer) >= self.max_batch
+        if full: self.wake.set()
+        return doc["_id"]
+
+    def trim(self):
+        """Держит буфер в пределах max_buffer, выбрасывая самые старые записи (под self.lock)"""
+        overflow = len(self.buffer) - self.max_buffer
+        if overflow > 0:
+            del self.buffer[:overflow]
+            inc_metric(f"buffered_writes_dropped_{self.collection.name}", overflow)
+
+    def flush(self):
+        """Синхронно пишет все накопленное; возвращает число записанных документов.
+        Если Mongo недоступна — возвращает пачку в буфер и пробрасывает ошибку"""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.buffer = self.buffer, []
+            if not batch: return 0
+            try:
+                self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # Дубли _id — это уже записанная часть прошлой попытки; прочие ошибки повтор не исправит
+                rejected = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                if rejected:
+                    print(f"⚠️ {self.collection.name}: {len(rejected)} док. отвергнуты: {rejected[0].get('errmsg')}", flush=True)
+                return len(batch) - len(rejected)
+            except PyMongoError:
+                with self.lock:
+                    self.buffer[:0] = batch
+                    self.trim()
+                inc_metric(f"buffered_write_errors_{self.collection.name}")
+                raise
+            inc_metric(f"buffered_writes_{self.collection.name}", len(batch))
+            return len(batch)
+
+    def run_forever(self):
+        while True:
+            self.wake.wait(self.max_delay)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ Ошибка фоновой записи {self.collection.name}, повторим: {e}", flush=True)
+
+failed_attempts_writer = BufferedWriter(db['failed_attempts'], WRITE_BATCH_SIZE, WRITE_FLUSH_SECONDS)
+BUFFERED_WRITERS = [failed_attempts_writer]
+
+@atexit.register
+def flush_buffered_writers():
+    """При остановке дописываем все, что осталось в буферах"""
+    for writer in BUFFERED_WRITERS:
+        try: writer.flush()
+        except Exception as e: print(f"⚠️ Буфер {writer.collection.name} не дописан: {e}", flush=True)
+
+if not CLI_COMMAND:
+    for writer in BUFFERED_WRITERS:
+        threading.Thread(target=writer.run_forever, daemon=True).start()
+# =============================================================
 
 def log_failed_attempt(user_id, network, city, reason):
-    """Логирует неудачную попытку публикации напрямую в MongoDB."""
-    db['failed_attempts'].insert_one({
+    """Логирует неудачную попытку публикации (запись в MongoDB — через буфер)."""
+    failed_attempts_writer.add({
         "user_id": user_id,
         "network": network,
         "city": city,
         "time": now_ekb(),
         "reason": reason
     })
-    print(f"[FAILED] {user_id}, {network}, {city}, {reason}")
+    inc_metric("failed_attempts")
 
-def add_post_to_history(user_id, user_name, network, city, chat_id, message_id, deleted=False, deleted_by=None, media_message_ids=None):
-    """Сохраняет пост в архив MongoDB."""
+def make_history_post(user_id, user_name, network, city, chat_id, message_id, deleted=False, deleted_by=None, media_message_ids=None):
+    """Документ архива для одного опубликованного сообщения."""
     post_data = {
         "user_id": user_id,
         "user_name": user_name,
@@ -193,20 +730,110 @@ def add_post_to_history(user_id, user_name, network, city, chat_id, message_id,
     # Записываем ID всех фоток из альбома, если они есть
     if media_message_ids:
         post_data["media_message_ids"] = media_message_ids
-        
-    ad_posts_collection.insert_one(post_data)
+    return post_data
+
+def add_posts_to_history(posts):
+    """Сохраняет все посты одной публикации в архив MongoDB: один insert_many + одна пачка в леджер.
+    Пишется синхронно: сразу после публикации историю читают удаление и пересборка леджера."""
+    if not posts: return
+    ad_posts_collection.insert_many(posts)
+    # Леджер квот пишется сразу: по нему проверяется лимит следующей публикации
+    record_quota_usage(posts)
+
+# ==================== 🧮 ЛЕДЖЕР ДНЕВНЫХ КВОТ ====================
+# Вместо count_documents по ad_posts на каждую проверку держим готовые счетчики
+# {user_id, day, network, city, count, links}. Это же дневная сводка для админской статистики.
+# Лидер досчитывает его из истории при старте и раз в сутки; вручную: python mpserv.py rebuild-quota
+DAILY_POST_LIMIT = 3
+QUOTA_LEDGER_DAYS = 7 # Сколько дней хранить счетчики (TTL)
+
+def get_day_key(moment=None):
+    """Ключ дня по Екатеринбургу: '2025-01-31'"""
+    return (moment or now_ekb()).strftime("%Y-%m-%d")
+
+def get_quota_expiry(day):
+    """Момент, после которого TTL-индекс удалит счетчик дня"""
+    return datetime.strptime(day, "%Y-%m-%d") + timedelta(days=QUOTA_LEDGER_DAYS)
+
+def get_post_link(chat_id, message_id):
+    return f"https://t.me/c/{str(chat_id).replace('-100', '')}/{message_id}"
+
+def upsert_quota_rows(ops):
+    """bulk_write upsert'ов в леджер с повтором гонок за уникальный ключ"""
+    try:
+        post_quota_collection.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        # Два upsert одного ключа одновременно: документ уже есть, повтор станет update
+        retry = [ops[err["index"]] for err in e.details.get("writeErrors", []) if err.get("code") == 11000]
+        if len(retry) < len(e.details.get("writeErrors", [])): raise
+        post_quota_collection.bulk_write(retry, ordered=False)
+
+def record_quota_usage(posts):
+    """Атомарно учитывает посты из истории в леджере: один $inc на (юзер, день, сеть, город)"""
+    rows = defaultdict(list)
+    for post in posts:
+        rows[(post["user_id"], get_day_key(post["time"]), post["network"], post["city"])].append(get_post_link(post["chat_id"], post["message_id"]))
+    upsert_quota_rows([
+        UpdateOne(
+            {"user_id": user_id, "day": day, "network": network, "city": city},
+            {"$inc": {"count": len(links)}, "$addToSet": {"links": {"$each": links}}, "$setOnInsert": {"expires_at": get_quota_expiry(day)}},
+            upsert=True
+        )
+        for (user_id, day, network, city), links in rows.items()
+    ])
+
+def rebuild_quota_ledger(days=QUOTA_LEDGER_DAYS):
+    """Досчитывает леджер за последние days дней из ad_posts (история — источник правды).
+
+    Без удаления: счетчик поднимается через $max, ссылки добавляются через $addToSet, так что
+    публикации, учтенные параллельно с пересборкой, не теряются и не задваиваются."""
+    since = now_ekb().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    pipeline = [
+        {"$match": {"time": {"$gte": since}}},
+        {"$group": {
+            "_id": {
+                "user_id": "$user_id", "network": "$network", "city": "$city",
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$time", "timezone": "Asia/Yekaterinburg"}}
+            },
+            "count": {"$sum": 1},
+            "posts": {"$addToSet": {"chat_id": "$chat_id", "message_id": "$message_id"}}
+        }}
+    ]
+    ops = [
+        UpdateOne(row["_id"], {
+            "$max": {"count": row["count"]},
+            "$addToSet": {"links": {"$each": [get_post_link(post["chat_id"], post["message_id"]) for post in row["posts"]]}},
+            "$set": {"expires_at": get_quota_expiry(row["_id"]["day"])}
+        }, upsert=True)
+        for row in ad_posts_collection.aggregate(pipeline)
+    ]
+    if ops: upsert_quota_rows(ops)
+    return len(ops)
+
+QUOTA_REBUILD_INTERVAL = 24 * 3600 # сек
+
+def rebuild_quota_ledger_tick():
+    """Фоновая пересборка у лидера: сразу после старта (леджер мог отстать от истории) и раз в сутки"""
+    print(f"🧮 Леджер квот досчитан: {rebuild_quota_ledger()} счетчиков", flush=True)
+    return QUOTA_REBUILD_INTERVAL
 
 # 🧠 Автогенерация all_cities на основе chat_ids_* и учёта особых случаев
 
 # === 🌍 УМНАЯ ЗАГРУЗКА МАТРИЦЫ ИЗ БАЗЫ ДАННЫХ (ЦУП) ===
-chat_ids_parni, chat_ids_mk, chat_ids_ns, chat_ids_rainbow, chat_ids_gayznak = {}, {}, {}, {}, {}
-all_cities = {}
-PARNI_CHATS = []
-BIG_CHATS = []
+# Матрица — неизменяемый снимок, собранный под версию документа infrastructure (см. settings_cache).
+# refresh_matrix() дешевый: пересборка только при смене версии, новый снимок подменяется одним
+# присваиванием, так что читатели всегда видят целостную матрицу.
+NETWORK_KEYS = ["mk", "parni", "ns", "rainbow", "gayznak"]
+NON_CITIES = [
+    "БЕЗ ПРЕДРАССУДКОВ", "RAINBOW MAN", "Мужской Чат", "Фетиши", 
+    "Аренда Жилья", "Секс Туризм", "Галерея", "Тестовая группа 🛠️",
+    "Общая группа Юга", "Казахстан", "ХМАО", "ЯМАЛ"
+]
+BIG_CHAT_NAMES = ["БЕЗ ПРЕДРАССУДКОВ", "Галерея", "Мужской Чат", "Фетиши", "Аренда Жилья", "Секс Туризм"] # Из сети mk
 
 def get_live_network_chats(network_key):
     """Универсальный парсер баз данных (как в основном боте)"""
-    infra = db['settings'].find_one({"_id": "infrastructure"}) or {}
+    infra = settings_cache.get("infrastructure") or {}
     networks = infra.get("networks", {})
     chats_data = networks.get(network_key)
     result = {}
@@ -222,52 +849,43 @@ def get_live_network_chats(network_key):
             else: result[str(k)] = v
     return result
 
+class MatrixSnapshot:
+    def __init__(self, version, network_chats):
+        self.version = version
+        self.network_chats = network_chats # ключ сети -> {название чата: chat_id}
+        self.all_cities = {}                # город -> ключ сети -> [{"name", "chat_id"}]
+        self.chat_locations = {}            # chat_id -> (ключ сети, город)
+
+        for net_key in NETWORK_KEYS:
+            for city, chat_id in network_chats.get(net_key, {}).items():
+                if city in NON_CITIES or str(city).startswith("⚠️"): continue
+                # 🔥 БРОНЕБОЙНОЕ ОТРЕЗАНИЕ ЦИФР (Челябинск 3, Челябинск3, Челябинск 3  -> Челябинск)
+                clean_city = re.sub(r'\s*\d+\s*$', '', str(city)).strip()
+                self.all_cities.setdefault(clean_city, {}).setdefault(net_key, []).append({"name": city, "chat_id": chat_id})
+                self.chat_locations[chat_id] = (net_key, clean_city)
+
+        # Готовые списки городов для клавиатур
+        self.cities_by_network = {net_key: [c for c, nets in self.all_cities.items() if net_key in nets] for net_key in NETWORK_KEYS}
+        self.multi_network_cities = [c for c, nets in self.all_cities.items() if len(nets) >= 2] # Для "Все сети"
+
+        mk_chats = network_chats.get("mk", {})
+        self.big_chats = frozenset(mk_chats[name] for name in BIG_CHAT_NAMES if mk_chats.get(name) is not None)
+
+    def cities_for(self, network):
+        """Города для выбора сети (название сети или "Все сети")"""
+        if network == "Все сети": return self.multi_network_cities
+        return self.cities_by_network.get(normalize_network_key(network), [])
+
+matrix = MatrixSnapshot(None, {})
+
 def refresh_matrix():
-    global all_cities, chat_ids_parni, chat_ids_mk, chat_ids_ns, chat_ids_rainbow, chat_ids_gayznak, PARNI_CHATS, BIG_CHATS
+    """Пересобирает матрицу, только если документ infrastructure изменился"""
+    global matrix
     try:
-        chat_ids_parni = get_live_network_chats("parni")
-        chat_ids_mk = get_live_network_chats("mk")
-        chat_ids_ns = get_live_network_chats("ns")
-        chat_ids_rainbow = get_live_network_chats("rainbow")
-        chat_ids_gayznak = get_live_network_chats("gayznak")
-        
-        NON_CITIES = [
-            "БЕЗ ПРЕДРАССУДКОВ", "RAINBOW MAN", "Мужской Чат", "Фетиши", 
-            "Аренда Жилья", "Секс Туризм", "Галерея", "Тестовая группа 🛠️",
-            "Общая группа Юга", "Казахстан", "ХМАО", "ЯМАЛ"
-        ]
-        
-        temp_all_cities = {}
-        def insert_to_all(city, net_key, real_name, chat_id):
-            if city in NON_CITIES or str(city).startswith("⚠️"): return
-            
-            # 🔥 БРОНЕБОЙНОЕ ОТРЕЗАНИЕ ЦИФР (Челябинск 3, Челябинск3, Челябинск 3  -> Челябинск)
-            clean_city = re.sub(r'\s*\d+\s*$', '', str(city)).strip()
-            
-            if clean_city not in temp_all_cities:
-                temp_all_cities[clean_city] = {}
-            if net_key not in temp_all_cities[clean_city]:
-                temp_all_cities[clean_city][net_key] = []
-            temp_all_cities[clean_city][net_key].append({"name": real_name, "chat_id": chat_id})
-
-        for city, chat_id in chat_ids_mk.items(): insert_to_all(city, "mk", city, chat_id)
-        for city, chat_id in chat_ids_parni.items(): insert_to_all(city, "parni", city, chat_id)
-        for city, chat_id in chat_ids_ns.items(): insert_to_all(city, "ns", city, chat_id)
-        for city, chat_id in chat_ids_rainbow.items(): insert_to_all(city, "rainbow", city, chat_id)
-        for city, chat_id in chat_ids_gayznak.items(): insert_to_all(city, "gayznak", city, chat_id)
-
-        all_cities = temp_all_cities
-        PARNI_CHATS = list(chat_ids_parni.values())
-        
-        # Обновляем BIG_CHATS
-        BIG_CHATS = [
-            chat_ids_mk.get("БЕЗ ПРЕДРАССУДКОВ"), chat_ids_mk.get("Галерея"),
-            chat_ids_mk.get("Мужской Чат"), chat_ids_mk.get("Фетиши"),
-            chat_ids_mk.get("Аренда Жилья"), chat_ids_mk.get("Секс Туризм")
-        ]
-        # Очищаем от пустых значений
-        BIG_CHATS = [cid for cid in BIG_CHATS if cid is not None]
-
+        version = settings_cache.version("infrastructure")
+        if version == matrix.version: return
+        matrix = MatrixSnapshot(version, {net_key: get_live_network_chats(net_key) for net_key in NETWORK_KEYS})
+        inc_metric("matrix_rebuilds")
     except Exception as e:
         print(f"⚠️ Ошибка обновления матрицы: {e}")
 
@@ -311,10 +929,387 @@ ad_top_stickers = (
     '<tg-emoji emoji-id="5201849382852372388">🔥</tg-emoji>\n\n'
 )
 
+# ==================== 📡 КЛИЕНТ TELEGRAM API ====================
+# Все вызовы Bot API идут через tg, а не напрямую через bot: 429 ждем retry_after и
+# повторяем, временные сбои (5xx, обрыв соединения) повторяем с джиттер-бэкоффом,
+# общий бюджет вызовов в секунду держит бота ниже глобального лимита Telegram.
+TG_GLOBAL_PER_SECOND = float(os.getenv("TG_GLOBAL_PER_SECOND", 25))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))
+TG_MAX_RETRY_AFTER = int(os.getenv("TG_MAX_RETRY_AFTER", 30)) # Дольше не ждем — отдаем ошибку наверх
+
+class TokenBucket:
+    """Ведро токенов: пополняется на rate токенов в секунду, копит не больше capacity"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Блокирует поток, пока в ведре не наберется нужное число токенов"""
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+class TelegramClient:
+    """Обертка над bot: tg.send_message(...) и т.д. с ретраями, бюджетом вызовов и метриками"""
+    TRANSIENT_CODES = (500, 502, 503, 504)
+    # Отправки неидемпотентны: таймаут или 5xx после того, как Telegram принял запрос,
+    # при повторе дал бы дубль объявления в чате. Их повторяем только на 429 и при ошибке соединения.
+    NON_IDEMPOTENT_PREFIXES = ("send_", "forward_", "copy_")
+
+    def __init__(self, bot, calls_per_second, max_retries, max_retry_after):
+        self.bot = bot
+        self.budget = TokenBucket(calls_per_second, calls_per_second)
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+
+    def __getattr__(self, name):
+        method = getattr(self.bot, name)
+        if not callable(method): return method
+        return lambda *args, **kwargs: self.call(name, method, *args, **kwargs)
+
+    @staticmethod
+    def call_cost(name, args, kwargs):
+        # Альбом Telegram считает как несколько сообщений
+        if name == "send_media_group":
+            media = kwargs.get("media", args[1] if len(args) > 1 else None)
+            return max(1, len(media or []))
+        return 1
+
+    @staticmethod
+    def is_connect_error(error):
+        """Запрос гарантированно не дошел до Telegram: соединение так и не установилось"""
+        if isinstance(error, requests.exceptions.ConnectTimeout): return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def retry_delay(self, error, attempt, idempotent=True):
+        """Пауза перед повтором или None, если ошибку повторять бессмысленно (или опасно)"""
+        if attempt >= self.max_retries:
+            return None
+        if isinstance(error, ApiTelegramException):
+            if error.error_code == 429:
+                retry_after = (error.result_json.get("parameters") or {}).get("retry_after", 1)
+                return retry_after if retry_after <= self.max_retry_after else None
+            if error.error_code not in self.TRANSIENT_CODES or not idempotent:
+                return None # 400/403 и т.п. — повтор не поможет; 5xx на отправке — мог уже уйти
+        elif not idempotent and not self.is_connect_error(error):
+            return None
+        # Временный сбой: экспоненциальный бэкофф с джиттером (0.5с, 1с, 2с ... ± случайность)
+        return 0.5 * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def call(self, name, method, *args, **kwargs):
+        cost = self.call_cost(name, args, kwargs)
+        idempotent = not name.startswith(self.NON_IDEMPOTENT_PREFIXES)
+        attempt = 0
+        while True:
+            self.budget.acquire(cost)
+            started = time.monotonic()
+            error = None
+            try:
+                result = method(*args, **kwargs)
+            except (ApiTelegramException, requests.exceptions.ConnectionError) as e:
+                error = e
+            # tg_calls и tg_latency_ms считают каждую попытку, удачную или нет — средняя латентность честная
+            inc_metric(f"tg_calls_{name}")
+            inc_metric(f"tg_latency_ms_{name}", int((time.monotonic() - started) * 1000))
+            if error is None:
+                return result
+
+            code = getattr(error, "error_code", "network")
+            inc_metric(f"tg_errors_{name}")
+            inc_metric(f"tg_errors_code_{code}")
+            delay = self.retry_delay(error, attempt, idempotent)
+            if delay is None:
+                raise error
+            inc_metric(f"tg_retries_{code}")
+            time.sleep(delay)
+            attempt += 1
+
+tg = TelegramClient(bot, TG_GLOBAL_PER_SECOND, TG_MAX_RETRIES, TG_MAX_RETRY_AFTER)
+# =============================================================
+
+# ==================== 🚀 ДВИЖОК ПУБЛИКАЦИИ ====================
+# Публикация в разные чаты независима, поэтому шлем параллельно. Общий лимит бота
+# держит tg, а здесь еще отдельное ведро на каждую группу (~20 сообщений/мин).
+# Итоговое время ≈ самый медленный чат, а не сумма всех.
+PUBLISH_WORKERS = int(os.getenv("PUBLISH_WORKERS", 8))
+TG_CHAT_PER_MINUTE = float(os.getenv("TG_CHAT_PER_MINUTE", 20))
+
+class PublishEngine:
+    """Параллельная рассылка по чатам с початовым лимитом Telegram"""
+    def __init__(self, workers, chat_per_minute):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="publish")
+        self.chat_rate = chat_per_minute / 60
+        self.chat_capacity = chat_per_minute
+        self.chat_buckets = {}
+        self._lock = threading.Lock()
+
+    def throttle(self, chat_id, cost=1):
+        """Ждет, пока можно отправить cost сообщений в chat_id (лимит группы)"""
+        with self._lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_capacity)
+        bucket.acquire(cost)
+
+    def run(self, jobs):
+        """Выполняет функции-задачи параллельно. Возвращает [(результат, ошибка)] в исходном порядке"""
+        futures = [self.executor.submit(job) for job in jobs]
+        results = []
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as e:
+                results.append((None, e))
+        inc_metric("publish_jobs", len(results))
+        inc_metric("publish_errors", sum(1 for _, error in results if error))
+        return results
+
+publish_engine = PublishEngine(PUBLISH_WORKERS, TG_CHAT_PER_MINUTE)
+
+def send_ad_to_chat(chat_id, full_text, reply_markup, media_type, file_id, media_array=None, pin=False):
+    """Публикует объявление в один чат. Возвращает (ID сообщения с текстом, ID сообщений альбома или None)"""
+    media_msg_ids = None
+    if media_type == "album":
+        media_list = []
+        for m in media_array or []:
+            if m['type'] == 'photo': media_list.append(types.InputMediaPhoto(m['id']))
+            else: media_list.append(types.InputMediaVideo(m['id']))
+
+        # 1. Отправляем альбом и сохраняем ID каждого отправленного фото
+        publish_engine.throttle(chat_id, len(media_list))
+        sent_media = tg.send_media_group(chat_id, media_list)
+        media_msg_ids = [m.message_id for m in sent_media]
+
+        # 2. Следом кидаем текст
+        publish_engine.throttle(chat_id)
+        sent_msg = tg.send_message(chat_id, full_text, parse_mode="HTML", reply_markup=reply_markup)
+    elif media_type == "photo":
+        publish_engine.throttle(chat_id)
+        sent_msg = tg.send_photo(chat_id, file_id, caption=full_text, parse_mode="HTML", reply_markup=reply_markup)
+    elif media_type == "video":
+        publish_engine.throttle(chat_id)
+        sent_msg = tg.send_video(chat_id, file_id, caption=full_text, parse_mode="HTML", reply_markup=reply_markup)
+    else:
+        publish_engine.throttle(chat_id)
+        sent_msg = tg.send_message(chat_id, full_text, parse_mode="HTML", reply_markup=reply_markup)
+
+    if pin:
+        publish_engine.throttle(chat_id)
+        try: tg.pin_chat_message(chat_id, sent_msg.message_id, disable_notification=True)
+        except: pass
+
+    return sent_msg.message_id, media_msg_ids
+# =============================================================
+
+# ==================== 👥 КЭШ ЧИСЛА УЧАСТНИКОВ ЧАТОВ ====================
+# Размер чата нужен только для выбора тарифа (больше/меньше 1000), поэтому в пейволе не ждем
+# Telegram: значение берется из памяти, устаревшее отдается сразу и обновляется в фоне.
+# Копия лежит в Mongo (рестарт стартует «теплым»), лидер обходит все чаты матрицы по кругу.
+MEMBER_COUNT_TTL = int(os.getenv("MEMBER_COUNT_TTL", 6 * 3600))                  # сек
+MEMBER_COUNT_SWEEP_PER_SECOND = float(os.getenv("MEMBER_COUNT_SWEEP_PER_SECOND", 1)) # запросов к Telegram при обходе
+DEFAULT_MEMBER_COUNT = 500 # Если Telegram недоступен и в кэше пусто
+MEMBER_COUNT_FAILURE_TTL = 300 # сек: после неудачного первого запроса столько не дергаем Telegram синхронно
+member_counts_collection = db['chat_member_counts'] # {_id: chat_id, count, fetched_at}
+
+class MemberCountCache:
+    def __init__(self, collection, ttl):
+        self.collection = collection
+        self.ttl = ttl
+        self.entries = {}       # chat_id -> (count, fetched_at)
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def warm(self):
+        """Подтягивает сохраненные значения из Mongo"""
+        for doc in self.collection.find({}):
+            self.entries[doc["_id"]] = (doc["count"], doc.get("fetched_at", 0))
+
+    def is_fresh(self, entry, ttl=None):
+        return entry is not None and time.time() - entry[1] < (ttl or self.ttl)
+
+    def fetch(self, chat_id):
+        """Спрашивает Telegram и сохраняет значение в память и Mongo"""
+        count = tg.get_chat_member_count(chat_id)
+        entry = (count, time.time())
+        with self.lock:
+            self.entries[chat_id] = entry
+        self.collection.update_one({"_id": chat_id}, {"$set": {"count": count, "fetched_at": entry[1]}}, upsert=True)
+        inc_metric("member_count_fetches")
+        return count
+
+    def refresh(self, chat_id):
+        """Фоновое обновление: сперва свежая копия из Mongo (ее мог обновить лидер), потом Telegram"""
+        try:
+            doc = self.collection.find_one({"_id": chat_id})
+            entry = (doc["count"], doc.get("fetched_at", 0)) if doc else None
+            if self.is_fresh(entry):
+                with self.lock: self.entries[chat_id] = entry
+            else:
+                self.fetch(chat_id)
+        except Exception as e:
+            print(f"⚠️ Не удалось обновить число участников {chat_id}: {e}", flush=True)
+        finally:
+            with self.lock: self.refreshing.discard(chat_id)
+
+    def get(self, chat_id):
+        """Число участников без ожидания Telegram (кроме самого первого запроса по чату)"""
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is not None and not self.is_fresh(entry) and chat_id not in self.refreshing:
+                self.refreshing.add(chat_id)
+                threading.Thread(target=self.refresh, args=(chat_id,), daemon=True).start()
+        if entry is not None:
+            inc_metric("member_count_hits")
+            return entry[0]
+        inc_metric("member_count_misses")
+        try:
+            return self.fetch(chat_id)
+        except Exception:
+            # Негативный кэш (только в памяти): DEFAULT_MEMBER_COUNT «свеж» MEMBER_COUNT_FAILURE_TTL секунд,
+            # дальше обновляется в фоне, а не на пути запроса
+            inc_metric("member_count_failures")
+            with self.lock:
+                self.entries.setdefault(chat_id, (DEFAULT_MEMBER_COUNT, time.time() - self.ttl + MEMBER_COUNT_FAILURE_TTL))
+            return DEFAULT_MEMBER_COUNT
+
+    def sweep(self, chat_ids, per_second):
+        """Обновляет чаты, которым скоро истекать, не быстрее per_second запросов в секунду"""
+        refreshed = 0
+        for chat_id in chat_ids:
+            if self.is_fresh(self.entries.get(chat_id), self.ttl * 0.8): continue
+            try:
+                self.fetch(chat_id)
+                refreshed += 1
+            except Exception as e:
+                print(f"⚠️ Обход числа участников: {chat_id}: {e}", flush=True)
+            time.sleep(1 / per_second)
+        return refreshed
+
+member_count_cache = MemberCountCache(member_counts_collection, MEMBER_COUNT_TTL)
+try:
+    member_count_cache.warm()
+except Exception as e:
+    print(f"⚠️ Кэш числа участников не прогрет: {e}", flush=True)
+
+def sweep_member_counts():
+    """Фоновая задача (один проход): освежает число участников всех чатов матрицы"""
+    refresh_matrix()
+    member_count_cache.sweep(list(matrix.chat_locations), MEMBER_COUNT_SWEEP_PER_SECOND)
+    return 600
+# =============================================================
+
+# ==================== 🪪 КЭШ ПРОФИЛЕЙ ЮЗЕРОВ ====================
+# Имя/юзернейм нужны только для отображения, а get_chat — это запрос к Telegram на каждого.
+# Профили приходят даром в from каждого апдейта: запоминаем их в памяти (LRU + TTL) и в Mongo.
+# get_chat остается последним шансом для юзеров, которых бот еще не видел.
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 5000))
+PROFILE_MEMORY_TTL = 3600           # сек: после этого перечитываем из Mongo
+PROFILE_STALE_AFTER = 7 * 24 * 3600 # сек: профиль старше недели обновляем через get_chat в фоне
+user_profiles_collection = db['user_profiles'] # {_id: user_id, first_name, last_name, username, updated_at}
+
+class UserProfileCache:
+    def __init__(self, collection, maxsize):
+        self.collection = collection
+        self.maxsize = maxsize
+        self.entries = OrderedDict() # user_id -> (профиль, время загрузки в память)
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def remember(self, profile):
+        with self.lock:
+            self.entries[profile["_id"]] = (profile, time.time())
+            self.entries.move_to_end(profile["_id"])
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def save(self, profile):
+        self.remember(profile)
+        self.collection.update_one({"_id": profile["_id"]}, {"$set": profile}, upsert=True)
+
+    def observe(self, user):
+        """Пассивное наполнение из from апдейта (dict Bot API). В Mongo пишем только изменения"""
+        if not user or user.get("is_bot"): return
+        profile = {"_id": user["id"], "first_name": user.get("first_name"), "last_name": user.get("last_name"), "username": user.get("username")}
+        with self.lock:
+            entry = self.entries.get(user["id"])
+        known = entry and {k: entry[0].get(k) for k in profile} == profile and time.time() - entry[0].get("updated_at", 0) < PROFILE_STALE_AFTER / 2
+        if known: return
+        profile["updated_at"] = time.time()
+        self.save(profile)
+        inc_metric("profiles_observed")
+
+    def fetch(self, user_id):
+        """Профиль из Telegram (get_chat) с сохранением; None — если Telegram не знает юзера"""
+        try:
+            chat = tg.get_chat(user_id)
+        except Exception:
+            return None
+        profile = {"_id": user_id, "first_name": chat.first_name, "last_name": chat.last_name, "username": chat.username, "updated_at": time.time()}
+        self.save(profile)
+        inc_metric("profiles_fetched")
+        return profile
+
+    def refresh_in_background(self, user_id):
+        try: self.fetch(user_id)
+        finally:
+            with self.lock: self.refreshing.discard(user_id)
+
+    def get_many(self, user_ids):
+        """{user_id: types.User или None}: память -> один запрос в Mongo -> get_chat для не найденных"""
+        result, missing, stale = {}, [], []
+        now = time.time()
+        with self.lock:
+            for user_id in dict.fromkeys(user_ids):
+                entry = self.entries.get(user_id)
+                if entry and now - entry[1] < PROFILE_MEMORY_TTL:
+                    self.entries.move_to_end(user_id)
+                    result[user_id] = entry[0]
+                else:
+                    missing.append(user_id)
+        if missing:
+            for profile in self.collection.find({"_id": {"$in": missing}}):
+                self.remember(profile)
+                result[profile["_id"]] = profile
+        for user_id in missing:
+            if user_id not in result:
+                result[user_id] = self.fetch(user_id)
+
+        # Старые профили отдаем как есть и обновляем в фоне
+        with self.lock:
+            for user_id, profile in result.items():
+                if profile and now - profile.get("updated_at", 0) > PROFILE_STALE_AFTER and user_id not in self.refreshing:
+                    self.refreshing.add(user_id)
+                    stale.append(user_id)
+        for user_id in stale:
+            threading.Thread(target=self.refresh_in_background, args=(user_id,), daemon=True).start()
+
+        return {user_id: self.to_user(profile) if profile else None for user_id, profile in result.items()}
+
+    def get(self, user_id):
+        return self.get_many([user_id])[user_id]
+
+    def to_user(self, profile):
+        return types.User(profile["_id"], False, profile.get("first_name") or "", last_name=profile.get("last_name"), username=profile.get("username"))
+
+user_profiles = UserProfileCache(user_profiles_collection, PROFILE_CACHE_SIZE)
+# =============================================================
+
 def get_price_for_chat(chat_id, days):
-    """Динамический расчет стоимости рекламы из MongoDB"""
+    """Динамический расчет стоимости рекламы из MongoDB (через кэш настроек)"""
     try:
-        prices = db['settings'].find_one({"_id": "skynet_pricing"})
+        prices = settings_cache.get("skynet_pricing")
     except:
         prices = None
 
@@ -327,16 +1322,13 @@ def get_price_for_chat(chat_id, days):
         }
 
     # 1. Если это БИГ-чат
-    if chat_id in BIG_CHATS:
+    if chat_id in matrix.big_chats:
         if days == 1: return prices.get("vip_big_chat_1", 1095)
         if days == 7: return prices.get("vip_big_chat_7", 7656)
         return None
         
-    # 2. Узнаем размер обычного чата
-    try:
-        count = bot.get_chat_member_count(chat_id)
-    except:
-        count = 500 
+    # 2. Узнаем размер обычного чата (из кэша, см. member_count_cache)
+    count = member_count_cache.get(chat_id)
         
     # 3. Выдаем цену по динамической матрице
     if count > 1000:
@@ -349,6 +1341,130 @@ def get_price_for_chat(chat_id, days):
     key = day_map.get(days)
     return prices.get(key, fallback_map.get(days))
 
+# ==================== 🧾 КОТИРОВКИ ТАРИФОВ ====================
+# Вся ценовая математика (VIP ×1.5, пакетная скидка за сети, закреп ×1.2, промокод) — здесь.
+# Таблица тарифов считается один раз при показе пейвола и кладется в Mongo под коротким ID,
+# который едет в callback_data (ad_pay_<qid>_<дни>). Чекаут берет ровно показанную сумму.
+QUOTE_TTL_MINUTES = int(os.getenv("QUOTE_TTL_MINUTES", 60))
+QUOTE_DAYS = [1, 7, 15, 30]
+NETWORK_NAMES = {"mk": "Мужской Клуб", "parni": "ПАРНИ 18+", "ns": "НС", "rainbow": "Радуга", "gayznak": "Гей Знакомства", "all": "Все сети"}
+quotes_collection = db['price_quotes']
+
+def get_network_discount(total_nets):
+    """Пакетная скидка (%) за число сетей в городе"""
+    if total_nets >= 5: return 30
+    if total_nets == 4: return 20
+    if total_nets == 3: return 10
+    return 0
+
+def build_quote(user_id, net_key, city, promo_data=None):
+    """Считает таблицу тарифов для (юзер, сеть, город) и сохраняет котировку. None — города/сети нет"""
+    city_nets = matrix.all_cities.get(city, {})
+    user_data = db['users'].find_one({"_id": user_id})
+    is_vip = user_data.get("temp_ad_type") == "vip" if user_data else False
+
+    if net_key == "all":
+        if not city_nets: return None
+        # Для базовой цены берем первый доступный чат в этом городе
+        chat_id = next(iter(city_nets.values()))[0]["chat_id"]
+        active_subs_count = len(ad_subs_collection.distinct("network", {"user_id": user_id, "city": city, "end_date": {"$gt": now_ekb()}}))
+        buying_now = len([n for n, d in city_nets.items() if d]) - active_subs_count
+        discount_net = get_network_discount(active_subs_count + buying_now)
+    else:
+        if not city_nets.get(net_key): return None
+        chat_id = city_nets[net_key][0]["chat_id"]
+        buying_now, discount_net = 1, 0
+
+    promo_discount = promo_data["value"] if promo_data else 0 # Промокод уже проверен вызывающим
+
+    tiers = {}
+    for days in QUOTE_DAYS:
+        base_price = get_price_for_chat(chat_id, days)
+        if not base_price: continue
+        if is_vip: base_price = int(base_price * 1.5) # Наценка VIP — ДО скидок за мульти-сеть
+        price = int((base_price * buying_now) * (1 - discount_net / 100))
+        pin_price = int(price * 1.2)
+        # Промокод — последним, от итоговой суммы (с закрепом или без)
+        tiers[str(days)] = {
+            "price": int(price * (1 - promo_discount / 100)),
+            "pin_price": int(pin_price * (1 - promo_discount / 100))
+        }
+
+    quote = {
+        "_id": uuid.uuid4().hex[:10],
+        "user_id": user_id,
+        "net_key": net_key,
+        "network": NETWORK_NAMES.get(net_key, net_key),
+        "city": city,
+        "is_vip": is_vip,
+        "discount_net": discount_net,
+        "promo_code": promo_data["_id"] if promo_data else None,
+        "promo_discount": promo_discount,
+        "tiers": tiers,
+        "expires_at": now_utc() + timedelta(minutes=QUOTE_TTL_MINUTES)
+    }
+    quotes_collection.insert_one(quote)
+    inc_metric("quotes_built")
+    return quote
+
+def get_quote(quote_id, user_id):
+    """Котировка по ID, если она жива и принадлежит этому юзеру"""
+    quote = quotes_collection.find_one({"_id": quote_id, "user_id": user_id})
+    if not quote or quote["expires_at"] < now_utc(): return None # TTL-индекс удаляет с задержкой
+    return quote
+
+def get_quote_payload(quote, days, is_pin):
+    """invoice_payload для Stars/CryptoBot (формат разбирают successful_payment и crypto_webhook)"""
+    payload_base = "ad_access_vip" if quote["is_vip"] else "ad_access"
+    promo_code = quote.get("promo_code")
+    payload = f"{payload_base}_discount_{days}_{quote['net_key']}_{quote['city']}_{promo_code}" if promo_code else f"{payload_base}_{days}_{quote['net_key']}_{quote['city']}"
+    return payload + "_pin" if is_pin else payload
+
+def add_quote_buttons(markup, quote, discount_label=0):
+    """Ряды «тариф / +закреп» из котировки"""
+    btn_prefix = "🔥 VIP:" if quote["is_vip"] else "💳"
+    for days, tier in quote["tiers"].items():
+        price = tier["price"]
+        btn_t = f"{btn_prefix} {days} дн. (-{discount_label}% за {price}⭐️)" if discount_label > 0 else f"{btn_prefix} {days} дн. ({price}⭐️)"
+        markup.row(
+            types.InlineKeyboardButton(btn_t, callback_data=f"ad_pay_{quote['_id']}_{days}"),
+            types.InlineKeyboardButton(f"📌 +Закреп ({tier['pin_price']}⭐️)", callback_data=f"ad_paypin_{quote['_id']}_{days}")
+        )
+
+# ==================== 🪙 СЧЕТА CRYPTOBOT ====================
+# eager — счета создаются при открытии чекаута (обе валюты параллельно);
+# lazy  — в чекауте только кнопки, счет создается по нажатию.
+# В обоих режимах созданный счет кэшируется по (валюта, сумма, payload): повторные нажатия
+# и повторный чекаут того же тарифа не плодят новые счета. Оплата сбрасывает кэш payload.
+CRYPTO_INVOICE_MODE = os.getenv("CRYPTO_INVOICE_MODE", "eager") # eager | lazy
+CRYPTO_INVOICE_TTL_MINUTES = int(os.getenv("CRYPTO_INVOICE_TTL_MINUTES", 60))
+CRYPTO_ASSETS = {"USDT": "🟢 Оплатить через USDT (CryptoBot)", "TON": "💎 Оплатить через TON (CryptoBot)"}
+crypto_invoices_collection = db['crypto_invoices'] # {_id: "asset:amount:payload", payload, url, expires_at}
+
+def get_cached_crypto_urls(crypto_payload, amount, description, assets):
+    """{asset: url} — из кэша, недостающие счета создаются параллельно"""
+    ids = {asset: f"{asset}:{amount}:{crypto_payload}" for asset in assets}
+    urls = {}
+    for doc in crypto_invoices_collection.find({"_id": {"$in": list(ids.values())}, "expires_at": {"$gt": now_utc()}}):
+        urls[doc["_id"].split(":", 1)[0]] = doc["url"]
+    missing = [asset for asset in assets if asset not in urls]
+    if not missing:
+        inc_metric("crypto_invoice_cache_hits")
+        return urls
+
+    created = get_crypto_pay_urls(crypto_payload, amount, description, missing)
+    expires_at = now_utc() + timedelta(minutes=CRYPTO_INVOICE_TTL_MINUTES)
+    for asset, url in created.items():
+        if not url: continue
+        urls[asset] = url
+        crypto_invoices_collection.update_one(
+            {"_id": ids[asset]},
+            {"$set": {"payload": crypto_payload, "url": url, "expires_at": expires_at}},
+            upsert=True
+        )
+    inc_metric("crypto_invoices_created", len([url for url in created.values() if url]))
+    return urls
+
 def get_main_keyboard():
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     markup.add("Создать новое объявление", "📝 Мои шаблоны")
@@ -372,23 +1488,15 @@ def get_user_name(user):
         return f"[{name}](tg://user?id={user.id})"
 
 # Функция для выбора срока оплаты
+@wizard_step
 def select_duration_for_payment(message, user_id, network, city):
     if message.text == "Назад":
         markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True, row_width=2)
-        if network == "Мужской Клуб":
-            cities = list(chat_ids_mk.keys())
-        elif network == "ПАРНИ 18+":
-            cities = list(chat_ids_parni.keys())
-        elif network == "НС":
-            cities = list(chat_ids_ns.keys())
-        elif network == "Радуга":
-            cities = list(chat_ids_rainbow.keys())
-        elif network == "Гей Знакомства":
-            cities = list(chat_ids_gayznak.keys())
+        cities = list(matrix.network_chats.get(normalize_network_key(network), {}).keys())
         markup.add(*cities)
         markup.add("Назад")
-        bot.send_message(message.chat.id, "📍 Выберите город для добавления пользователя:", reply_markup=markup)
-        bot.register_next_step_handler(message, lambda m: select_city_for_payment(m, user_id, network))
+        tg.send_message(message.chat.id, "📍 Выберите город для добавления пользователя:", reply_markup=markup)
+        bot.register_next_step_handler(message, select_city_for_payment, user_id, network)
         return
 
     duration = message.text
@@ -399,14 +1507,14 @@ def select_duration_for_payment(message, user_id, network, city):
     elif duration == "Месяц":
         days = 30
     else:
-        bot.send_message(message.chat.id, "❗ Ошибка! Выберите правильный срок.")
-        bot.register_next_step_handler(message, lambda m: select_duration_for_payment(m, user_id, network, city))
+        tg.send_message(message.chat.id, "❗ Ошибка! Выберите правильный срок.")
+        bot.register_next_step_handler(message, select_duration_for_payment, user_id, network, city)
         return
 
     expiry_date = now_ekb() + timedelta(days=days)
 
     # 💥 ЗАПИСЬ В БАЗУ ДАННЫХ
-    ad_subs_collection.insert_one({
+    insert_subscription({
         "user_id": user_id,
         "network": network,
         "city": city,
@@ -419,54 +1527,53 @@ def select_duration_for_payment(message, user_id, network, city):
         "notified_3h": False
     })
 
-    try:
-        user_info = bot.get_chat(user_id)
+    user_info = user_profiles.get(user_id)
+    if user_info:
         user_name = f"{user_info.first_name or ''} {user_info.last_name or ''}".strip()
         if not user_name: user_name = user_info.username or "Имя не указано"
-    except:
+    else:
         user_name = "Имя не найдено"
 
     if message.chat.id != ADMIN_CHAT_ID:
-        bot.send_message(message.chat.id, f"✅ {user_name} (ID: {user_id}) добавлен в «{network}» ({city}) до {expiry_date.strftime('%d.%m.%Y')}.")
+        tg.send_message(message.chat.id, f"✅ {user_name} (ID: {user_id}) добавлен в «{network}» ({city}) до {expiry_date.strftime('%d.%m.%Y')}.")
 
-    bot.send_message(ADMIN_CHAT_ID, f"👨‍💼 Выданы права (руками):\n{user_name} (ID: {user_id})\nСеть: {network}\nГород: {city}\n📅 До: {expiry_date.strftime('%d.%m.%Y')}")
+    tg.send_message(ADMIN_CHAT_ID, f"👨‍💼 Выданы права (руками):\n{user_name} (ID: {user_id})\nСеть: {network}\nГород: {city}\n📅 До: {expiry_date.strftime('%d.%m.%Y')}")
 
-def get_user_statistics(user_id):
-    """Получает статистику пользователя напрямую из MongoDB."""
+def get_user_statistics(user_id, active_subs=None):
+    """Статистика пользователя за сегодня: активные доступы + одно чтение леджера квот.
+    active_subs — уже подгруженные активные доступы (автопостинг берет их пачкой на проход)"""
     stats = {"published": 0, "remaining": 0, "details": {}}
     limit_total = 0
-    today_start = now_ekb().replace(hour=0, minute=0, second=0, microsecond=0)
 
     # 1. Получаем все активные доступы юзера
-    active_subs = list(ad_subs_collection.find({"user_id": user_id, "end_date": {"$gt": now_ekb()}}))
+    if active_subs is None:
+        active_subs = list(ad_subs_collection.find({"user_id": user_id, "end_date": {"$gt": now_ekb()}}))
 
-    # Разворачиваем "Все сети" в конкретные сети для проверки лимитов
-    networks_to_check = []
+    # Разворачиваем "Все сети" в конкретные сети для проверки лимитов (дата окончания — самая поздняя)
+    networks_to_check = {}
     for sub in active_subs:
-        if sub["network"] == "Все сети":
-            for net in ["Мужской Клуб", "ПАРНИ 18+", "НС", "Радуга", "Гей Знакомства"]:
-                networks_to_check.append((net, sub["city"]))
-        else:
-            networks_to_check.append((sub["network"], sub["city"]))
+        nets = ["Мужской Клуб", "ПАРНИ 18+", "НС", "Радуга", "Гей Знакомства"] if sub["network"] == "Все сети" else [sub["network"]]
+        for net in nets:
+            key = (net, sub["city"])
+            networks_to_check[key] = max(networks_to_check.get(key, sub["end_date"]), sub["end_date"])
 
-    networks_to_check = list(set(networks_to_check)) # Убираем дубликаты
+    # 2. Публикации за сегодня — готовые счетчики из леджера
+    today_counts = {
+        (row["network"], row["city"]): row.get("count", 0)
+        for row in post_quota_collection.find({"user_id": user_id, "day": get_day_key()})
+    } if networks_to_check else {}
 
-    # 2. Считаем публикации за сегодня
-    for network, city in networks_to_check:
-        today_posts_count = ad_posts_collection.count_documents({
-            "user_id": user_id,
-            "network": network,
-            "city": city,
-            "time": {"$gte": today_start}
-        })
+    for (network, city), end_date in networks_to_check.items():
+        today_posts_count = today_counts.get((network, city), 0)
 
-        limit_total += 3
+        limit_total += DAILY_POST_LIMIT
         if network not in stats["details"]:
             stats["details"][network] = {}
 
         stats["details"][network][city] = {
             "published": today_posts_count,
-            "remaining": max(0, 3 - today_posts_count)
+            "remaining": max(0, DAILY_POST_LIMIT - today_posts_count),
+            "end_date": end_date
         }
         stats["published"] += today_posts_count
 
@@ -474,56 +1581,109 @@ def get_user_statistics(user_id):
     return stats
 
 def get_admin_statistics():
-    """Сбор статистики для админов (по всем юзерам за сегодня)"""
+    """Сбор статистики для админов (по всем юзерам за сегодня) из дневной сводки леджера одной агрегацией"""
+    pipeline = [
+        {"$match": {"day": get_day_key()}},
+        {"$group": {
+            "_id": "$user_id",
+            "published": {"$sum": "$count"},
+            "details": {"$push": {"network": "$network", "city": "$city", "count": "$count"}},
+            "links": {"$push": "$links"}
+        }},
+        {"$sort": {"published": -1}}
+    ]
+
     statistics = {}
-    today_start = now_ekb().replace(hour=0, minute=0, second=0, microsecond=0)
+    for row in post_quota_collection.aggregate(pipeline):
+        details = {}
+        for item in row["details"]:
+            details.setdefault(item["network"], {})[item["city"]] = {
+                "published": item["count"],
+                "remaining": max(0, DAILY_POST_LIMIT - item["count"])
+            }
+        statistics[row["_id"]] = {
+            "published": row["published"],
+            "details": details,
+            "links": list(dict.fromkeys(link for links in row["links"] for link in links or []))
+        }
+    return statistics
 
-    # Берем ВСЕ сегодняшние посты из базы
-    today_posts = list(ad_posts_collection.find({"time": {"$gte": today_start}}))
-    
-    for post in today_posts:
-        uid = post["user_id"]
-        net = post["network"]
-        city = post["city"]
-        
-        if uid not in statistics:
-            statistics[uid] = {"published": 0, "remaining": 0, "details": {}, "links": set()}
-            
-        if net not in statistics[uid]["details"]:
-            statistics[uid]["details"][net] = {}
-            
-        if city not in statistics[uid]["details"][net]:
-            statistics[uid]["details"][net][city] = {"published": 0, "remaining": 3} # Выдаем базовый лимит
-            
-        # Плюсуем счетчики
-        statistics[uid]["details"][net][city]["published"] += 1
-        statistics[uid]["details"][net][city]["remaining"] = max(0, 3 - statistics[uid]["details"][net][city]["published"])
-        statistics[uid]["published"] += 1
-        
-        # Добавляем ссылку
-        chat_id_short = str(post["chat_id"]).replace("-100", "")
-        statistics[uid]["links"].add(f"https://t.me/c/{chat_id_short}/{post['message_id']}")
+# ==================== 🧭 РОУТЕР CALLBACK-КНОПОК ====================
+# Телебот проверяет лямбды callback-хендлеров по очереди на каждое нажатие.
+# Вместо этого держим два словаря: точные callback_data и префиксы. Префикс всегда
+# заканчивается разделителем ("_" или ":"), поэтому поиск — несколько dict-lookup'ов
+# по позициям разделителей, и его цена не зависит от количества кнопок.
+CALLBACK_SEPARATORS = "_:"
+callback_exact_routes = {}
+callback_prefix_routes = {}
+
+def callback_route(*keys, args=()):
+    """Регистрирует хендлер кнопки. Ключ, оканчивающийся на "_" или ":", — префикс, иначе точное совпадение.
+
+    Хвост после префикса режется по тому же разделителю на len(args) частей (последняя часть
+    забирает остаток — в названиях городов бывает "_") и приводится к типам из args.
+    Хендлер вызывается как handler(call, *args).
+    """
+    def decorator(handler):
+        for key in keys:
+            table = callback_prefix_routes if key[-1] in CALLBACK_SEPARATORS else callback_exact_routes
+            table[key] = (handler, args)
+        return handler
+    return decorator
+
+def parse_callback_args(payload, sep, converters):
+    if not converters: return ()
+    parts = payload.split(sep, len(converters) - 1)
+    if len(parts) != len(converters):
+        raise ValueError(f"ожидалось {len(converters)} аргументов, пришло {len(parts)}")
+    return tuple(convert(part) for convert, part in zip(converters, parts))
+
+def resolve_callback(data):
+    """Возвращает (хендлер, разобранные аргументы) для callback_data или (None, ())"""
+    route = callback_exact_routes.get(data)
+    if route:
+        return route[0], ()
+    # Побеждает самый длинный префикс: идем по разделителям справа налево
+    for i in range(len(data) - 1, -1, -1):
+        if data[i] in CALLBACK_SEPARATORS:
+            route = callback_prefix_routes.get(data[:i + 1])
+            if route:
+                handler, converters = route
+                return handler, parse_callback_args(data[i + 1:], data[i], converters)
+    return None, ()
+
+@bot.callback_query_handler(func=lambda call: True)
+def dispatch_callback(call):
+    try:
+        handler, args = resolve_callback(call.data or "")
+    except (ValueError, InvalidId):
+        inc_metric("callbacks_bad_payload")
+        tg.answer_callback_query(call.id, "❌ Устаревшая кнопка.")
+        return
 
-    # Преобразуем множества ссылок в списки
-    for uid in statistics:
-        statistics[uid]["links"] = list(statistics[uid]["links"])
-        
-    return statistics
+    if not handler:
+        inc_metric("callbacks_unrouted")
+        tg.answer_callback_query(call.id)
+        return
+
+    inc_metric("callbacks_routed")
+    handler(call, *args)
+# ===================================================================
 
 @bot.message_handler(commands=['start'])
 def start(message):
     try:
         if message.chat.type != "private":
-            bot.send_message(message.chat.id, "Пожалуйста, используйте ЛС для работы с ботом.")
+            tg.send_message(message.chat.id, "Пожалуйста, используйте ЛС для работы с ботом.")
             return
 
-        bot.send_message(
+        tg.send_message(
             message.chat.id,
             "Привет! Я PostGoldBot. 👋\nВыберите действие:",
             reply_markup=get_main_keyboard()
         )
     except Exception as e:
-        bot.send_message(ADMIN_CHAT_ID, f"Ошибка в /start: {e}")
+        tg.send_message(ADMIN_CHAT_ID, f"Ошибка в /start: {e}")
 
 from collections import defaultdict
 
@@ -531,10 +1691,10 @@ from collections import defaultdict
 @bot.message_handler(commands=['admin'])
 def admin_panel(message):
     if not is_admin(message.chat.id):
-        bot.send_message(message.chat.id, "⛔ У вас нет прав для выполнения этой команды.")
+        tg.send_message(message.chat.id, "⛔ У вас нет прав для выполнения этой команды.")
         return
 
-    refresh_matrix() # <--- ДОБАВИТЬ ЭТУ СТРОКУ
+    refresh_matrix()
 
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("➕ Добавить оплатившего", callback_data="admin_add_paid_user"))
@@ -546,31 +1706,29 @@ def admin_panel(message):
     markup.add(types.InlineKeyboardButton("🗂 История постов", callback_data="admin_post_history:0"))
     markup.add(types.InlineKeyboardButton("🗑 Удалить объявления пользователя", callback_data="admin_delete_user_posts"))
 
-    bot.send_message(message.chat.id, "🛠 *Админ-панель:*", reply_markup=markup, parse_mode="Markdown")
+    tg.send_message(message.chat.id, "🛠 *Админ-панель:*", reply_markup=markup, parse_mode="Markdown")
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_add_paid_user")
+@callback_route("admin_add_paid_user")
 def handle_add_paid_user(call):
-    bot.send_message(call.message.chat.id, "Введите ID пользователя:")
+    tg.send_message(call.message.chat.id, "Введите ID пользователя:")
     bot.register_next_step_handler(call.message, process_user_id_for_payment)
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_list_paid_users")
+@callback_route("admin_list_paid_users")
 def handle_list_paid_users(call):
     show_paid_users(call.message)
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_change_duration")
+@callback_route("admin_change_duration")
 def handle_change_duration_request(call):
-    bot.send_message(call.message.chat.id, "Введите ID пользователя для изменения срока:")
+    tg.send_message(call.message.chat.id, "Введите ID пользователя для изменения срока:")
     bot.register_next_step_handler(call.message, select_user_for_duration_change)
 
 # --- МОДЕРАЦИЯ VIP-РЕКЛАМЫ ---
-@bot.callback_query_handler(func=lambda call: call.data.startswith("vip_approve_") or call.data.startswith("vip_reject_"))
-def handle_vip_moderation(call):
-    bot.answer_callback_query(call.id) # 🛑 Убираем "часики" загрузки с кнопки
+@callback_route("vip_approve_", "vip_reject_", args=(int,))
+def handle_vip_moderation(call, user_id):
+    tg.answer_callback_query(call.id) # 🛑 Убираем "часики" загрузки с кнопки
     
-    # Правильная распаковка: call.data выглядит как "vip_approve_123456"
-    parts = call.data.split("_")
-    action = parts[1] # Теперь здесь будет точно "approve" или "reject"
-    user_id = int(parts[2])
+    # call.data выглядит как "vip_approve_123456", ID уже разобран роутером
+    action = "approve" if call.data.startswith("vip_approve_") else "reject"
 
     if action == "approve":
         # 1. Записываем юзеру VIP-статус для расчета цен
@@ -580,50 +1738,52 @@ def handle_vip_moderation(call):
         markup = types.InlineKeyboardMarkup()
         markup.add(types.InlineKeyboardButton("🚀 Выбрать сеть и оплатить", callback_data="start_vip_payment"))
         try:
-            bot.send_message(user_id, "🎉 <b>Ваш ресурс успешно одобрен!</b>\nТеперь вы можете выбрать сеть, город и оплатить размещение (к прайсу применена наценка +50% за увод аудитории).\n\nЖмите кнопку ниже:", parse_mode="HTML", reply_markup=markup)
+            tg.send_message(user_id, "🎉 <b>Ваш ресурс успешно одобрен!</b>\nТеперь вы можете выбрать сеть, город и оплатить размещение (к прайсу применена наценка +50% за увод аудитории).\n\nЖмите кнопку ниже:", parse_mode="HTML", reply_markup=markup)
         except: pass
         
         # 3. Убираем кнопки у админа, чтобы не нажать дважды
-        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
-        bot.send_message(call.message.chat.id, f"✅ <b>Заявка ОДОБРЕНА (Пользователь ID: <code>{user_id}</code>)</b>", reply_to_message_id=call.message.message_id, parse_mode="HTML")
+        tg.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        tg.send_message(call.message.chat.id, f"✅ <b>Заявка ОДОБРЕНА (Пользователь ID: <code>{user_id}</code>)</b>", reply_to_message_id=call.message.message_id, parse_mode="HTML")
 
     elif action == "reject":
         # Убираем статус на всякий случай
         db['users'].update_one({"_id": user_id}, {"$unset": {"temp_ad_type": ""}})
         try:
-            bot.send_message(user_id, "❌ К сожалению, мы не можем разместить рекламу данного ресурса в нашей сети. Заявка отклонена.", reply_markup=get_main_keyboard())
+            tg.send_message(user_id, "❌ К сожалению, мы не можем разместить рекламу данного ресурса в нашей сети. Заявка отклонена.", reply_markup=get_main_keyboard())
         except: pass
         
         # Убираем кнопки у админа
-        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
-        bot.send_message(call.message.chat.id, f"❌ <b>Заявка ОТКЛОНЕНА (Пользователь ID: <code>{user_id}</code>)</b>", reply_to_message_id=call.message.message_id, parse_mode="HTML")
+        tg.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        tg.send_message(call.message.chat.id, f"❌ <b>Заявка ОТКЛОНЕНА (Пользователь ID: <code>{user_id}</code>)</b>", reply_to_message_id=call.message.message_id, parse_mode="HTML")
 
 # --- СТАРТ ПОСЛЕ ОДОБРЕНИЯ ---
-@bot.callback_query_handler(func=lambda call: call.data == "start_vip_payment")
+@callback_route("start_vip_payment")
 def resume_vip_payment(call):
-    bot.answer_callback_query(call.id)
-    bot.send_message(call.message.chat.id, "📋 Выберите сеть для публикации:", reply_markup=get_network_markup())
+    tg.answer_callback_query(call.id)
+    tg.send_message(call.message.chat.id, "📋 Выберите сеть для публикации:", reply_markup=get_network_markup())
     bot.register_next_step_handler(call.message, select_network_step)
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_statistics")
+@callback_route("admin_statistics")
 def handle_admin_statistics(call):
     show_statistics_for_admin(call.message.chat.id)
 
-@bot.callback_query_handler(func=lambda call: call.data == "admin_delete_user_posts")
+@callback_route("admin_delete_user_posts")
 def handle_admin_delete_user_posts(call):
-    bot.send_message(call.message.chat.id, "🆔 Введите ID пользователя, чьи объявления нужно удалить:")
+    tg.send_message(call.message.chat.id, "🆔 Введите ID пользователя, чьи объявления нужно удалить:")
     bot.register_next_step_handler(call.message, delete_user_posts_step)
 
 # Функция для добавления оплатившего
+@wizard_step
 def process_user_id_for_payment(message):
     try:
         user_id = int(message.text)
-        bot.send_message(message.chat.id, "️ Выберите сеть для добавления пользователя:", reply_markup=get_network_markup())
-        bot.register_next_step_handler(message, lambda m: select_network_for_payment(m, user_id))
+        tg.send_message(message.chat.id, "️ Выберите сеть для добавления пользователя:", reply_markup=get_network_markup())
+        bot.register_next_step_handler(message, select_network_for_payment, user_id)
     except ValueError:
-        bot.send_message(message.chat.id, " Ошибка: ID должен быть числом.")
+        tg.send_message(message.chat.id, " Ошибка: ID должен быть числом.")
 
 # Функция для выбора сети при добавлении оплатившего
+@wizard_step
 def select_network_for_payment(message, user_id):
     if message.text == "Назад":
         admin_panel(message)
@@ -631,82 +1791,136 @@ def select_network_for_payment(message, user_id):
 
     network = message.text
     if network not in ["Мужской Клуб", "ПАРНИ 18+", "НС", "Радуга", "Гей Знакомства", "Все сети"]:
-        bot.send_message(message.chat.id, "❗ Ошибка! Выберите правильную сеть.")
-        bot.register_next_step_handler(message, lambda m: select_network_for_payment(m, user_id))
+        tg.send_message(message.chat.id, "❗ Ошибка! Выберите правильную сеть.")
+        bot.register_next_step_handler(message, select_network_for_payment, user_id)
         return
 
     markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True, row_width=2)
-    network_key = normalize_network_key(network)
-
-    if network == "Все сети":
-        # Только города, где хотя бы 2+ сетей доступны
-        cities = [city for city, data in all_cities.items() if len(data.keys()) >= 2]
-    else:
-        cities = [city for city, data in all_cities.items() if network_key in data]
+    # Для "Все сети" — только города, где хотя бы 2+ сетей доступны
+    cities = matrix.cities_for(network)
 
     for city in cities:
         markup.add(city)
     markup.add("Назад")
-    bot.send_message(message.chat.id, "📍 Выберите город для добавления пользователя:", reply_markup=markup)
-    bot.register_next_step_handler(message, lambda m: select_city_for_payment(m, user_id, network))
+    tg.send_message(message.chat.id, "📍 Выберите город для добавления пользователя:", reply_markup=markup)
+    bot.register_next_step_handler(message, select_city_for_payment, user_id, network)
 
+@wizard_step
 def select_city_for_payment(message, user_id, network):
     if message.text == "Назад":
-        bot.send_message(message.chat.id, "️Выберите сеть для добавления пользователя:", reply_markup=get_network_markup())
-        bot.register_next_step_handler(message, lambda m: select_network_for_payment(m, user_id))
+        tg.send_message(message.chat.id, "️Выберите сеть для добавления пользователя:", reply_markup=get_network_markup())
+        bot.register_next_step_handler(message, select_network_for_payment, user_id)
         return
 
     city = message.text
-    network_key = normalize_network_key(network)
 
     # Повторно получаем список допустимых городов для проверки
-    if network == "Все сети":
-        allowed_cities = [c for c, d in all_cities.items() if len(d.keys()) >= 2]
-    else:
-        allowed_cities = [c for c, d in all_cities.items() if network_key in d]
+    allowed_cities = matrix.cities_for(network)
 
     if city not in allowed_cities:
         markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
         for c in allowed_cities:
             markup.add(c)
         markup.add("Назад")
-        bot.send_message(message.chat.id, "📍 Пожалуйста, выберите город из списка:", reply_markup=markup)
-        bot.register_next_step_handler(message, lambda m: select_city_for_payment(m, user_id, network))
+        tg.send_message(message.chat.id, "📍 Пожалуйста, выберите город из списка:", reply_markup=markup)
+        bot.register_next_step_handler(message, select_city_for_payment, user_id, network)
         return
 
     # Всё ок — идём дальше
     markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
     markup.add("День", "Неделя", "Месяц")
-    bot.send_message(message.chat.id, "⏳ Выберите срок оплаты:", reply_markup=markup)
-    bot.register_next_step_handler(message, lambda m: select_duration_for_payment(m, user_id, network, city))
+    tg.send_message(message.chat.id, "⏳ Выберите срок оплаты:", reply_markup=markup)
+    bot.register_next_step_handler(message, select_duration_for_payment, user_id, network, city)
+
+# ==================== 📑 KEYSET-ПАГИНАЦИЯ АДМИНКИ ====================
+# Страницы листаются от крайнего показанного документа по индексу (time, _id), а не через skip:
+# любая страница — один индексный запрос на per_page + 1 документов, как бы ни разрослась история.
+# Курсор живет в callback_data: "<n|p><страница>.<time в мс, base36>.<_id hex>" — без "_" и ":",
+# чтобы не путать роутер кнопок. "n" — страница после документа, "p" — перед ним.
+UNIX_EPOCH = datetime(1970, 1, 1)
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def to_base36(number):
+    out = ""
+    while True:
+        number, rem = divmod(number, 36)
+        out = BASE36_DIGITS[rem] + out
+        if not number: return out
+
+def parse_page_cursor(token):
+    """Токен из кнопки -> (направление, страница, time, _id); "0" (старые кнопки) -> None, т.е. первая страница"""
+    if token.isdigit(): return None
+    direction, rest = token[0], token[1:]
+    if direction not in "np":
+        raise ValueError(f"неизвестное направление курсора: {direction}")
+    page, ms, oid = rest.split(".")
+    return direction, int(page), UNIX_EPOCH + timedelta(milliseconds=int(ms, 36)), ObjectId(oid)
+
+class KeysetPaginator:
+    """Постраничный просмотр коллекции по (time desc, _id desc)"""
+
+    def __init__(self, collection, per_page):
+        self.collection = collection
+        self.per_page = per_page
+        self.sort_desc = [("time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+        self.sort_asc = [("time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]
+
+    @staticmethod
+    def make_cursor(direction, page, doc):
+        moment = to_utc_naive(doc["time"])
+        return f"{direction}{page}.{to_base36((moment - UNIX_EPOCH) // timedelta(milliseconds=1))}.{doc['_id']}"
+
+    def fetch(self, cursor=None):
+        """Возвращает (документы, номер страницы, курсор «Назад» или None, курсор «Вперёд» или None)"""
+        if cursor is None:
+            direction, page = "n", 0
+            docs = list(self.collection.find().sort(self.sort_desc).limit(self.per_page + 1))
+        else:
+            direction, page, moment, oid = cursor
+            op = "$gt" if direction == "p" else "$lt"
+            query = {"$or": [{"time": {op: moment}}, {"time": moment, "_id": {op: oid}}]}
+            docs = list(self.collection.find(query).sort(self.sort_asc if direction == "p" else self.sort_desc).limit(self.per_page + 1))
+
+        has_more = len(docs) > self.per_page
+        docs = docs[:self.per_page]
+        if direction == "p":
+            # Назад уперлись в начало (или свежие записи удалили) — отдаем полноценную первую страницу
+            if not has_more: return self.fetch()
+            docs.reverse()
+            has_prev, has_next = True, True
+        else:
+            # Вперёд пусто: хвост успел уйти по TTL
+            if not docs and page: return self.fetch()
+            has_prev, has_next = page > 0, has_more
+
+        prev_cursor = self.make_cursor("p", max(page - 1, 0), docs[0]) if has_prev and docs else None
+        next_cursor = self.make_cursor("n", page + 1, docs[-1]) if has_next and docs else None
+        return docs, page, prev_cursor, next_cursor
+
+    def total_pages(self):
+        """Примерное число страниц по метаданным коллекции, без подсчета документов"""
+        return max(1, -(-self.collection.estimated_document_count() // self.per_page))
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("show_failed_attempts"))
-def show_failed_attempts(call):
+failed_attempts_pages = KeysetPaginator(db['failed_attempts'], ATTEMPTS_PER_PAGE)
+post_history_pages = KeysetPaginator(ad_posts_collection, 5)
+
+@callback_route("show_failed_attempts", "show_failed_attempts:", args=(parse_page_cursor,))
+def show_failed_attempts(call, cursor=None):
     if not is_admin(call.from_user.id):
-        bot.answer_callback_query(call.id, "⛔ Нет доступа.")
+        tg.answer_callback_query(call.id, "⛔ Нет доступа.")
         return
 
     try:
-        parts = call.data.split(":")
-        page = int(parts[1]) if len(parts) > 1 else 0
-    except:
-        page = 0
-
-    try:
-        # ЗАПРОС К MONGODB ВМЕСТО SQLITE
-        attempts = list(db['failed_attempts'].find().sort("time", pymongo.DESCENDING))
+        if cursor is None: failed_attempts_writer.flush()
+        attempts, page, prev_cursor, next_cursor = failed_attempts_pages.fetch(cursor)
 
         if not attempts:
-            bot.answer_callback_query(call.id, "✅ Нет попыток без доступа.")
+            tg.answer_callback_query(call.id, "✅ Нет попыток без доступа.")
             return
 
-        start = page * ATTEMPTS_PER_PAGE
-        end = start + ATTEMPTS_PER_PAGE
-        total_pages = (len(attempts) - 1) // ATTEMPTS_PER_PAGE + 1
-        page_attempts = attempts[start:end]
-
-        response = f"<b>📛 Попытки публикации без доступа (стр. {page+1} из {total_pages}):</b>\n\n"
-        for attempt in page_attempts:
+        total_pages = max(failed_attempts_pages.total_pages(), page + 1)
+        response = f"<b>📛 Попытки публикации без доступа (стр. {page+1} из ~{total_pages}):</b>\n\n"
+        for attempt in attempts:
             user_id = attempt.get('user_id', 'Неизвестно')
             network = escape_html(attempt.get('network', ''))
             city = escape_html(attempt.get('city', ''))
@@ -721,31 +1935,26 @@ def show_failed_attempts(call):
 
         keyboard = InlineKeyboardMarkup()
         buttons = []
-        if page > 0: buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"show_failed_attempts:{page - 1}"))
-        if end < len(attempts): buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"show_failed_attempts:{page + 1}"))
+        if prev_cursor: buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"show_failed_attempts:{prev_cursor}"))
+        if next_cursor: buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"show_failed_attempts:{next_cursor}"))
         if buttons: keyboard.row(*buttons)
 
-        bot.edit_message_text(response, chat_id=call.message.chat.id, message_id=call.message.message_id, parse_mode="HTML", reply_markup=keyboard)
-        bot.answer_callback_query(call.id)
+        tg.edit_message_text(response, chat_id=call.message.chat.id, message_id=call.message.message_id, parse_mode="HTML", reply_markup=keyboard)
+        tg.answer_callback_query(call.id)
     except Exception as e:
-        bot.send_message(call.message.chat.id, f"❌ Ошибка: {e}")
+        tg.send_message(call.message.chat.id, f"❌ Ошибка: {e}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("admin_post_history:"))
-def show_post_history(call):
+@callback_route("admin_post_history:", args=(parse_page_cursor,))
+def show_post_history(call, cursor):
     try:
-        page = int(call.data.split(":")[1])
-        posts_per_page = 5 
-
-        # ОПТИМИЗАЦИЯ: Считаем общее кол-во и берем из базы ТОЛЬКО 5 нужных постов (чтобы бот летал)
-        total_posts = ad_posts_collection.count_documents({})
-        if total_posts == 0:
-            bot.answer_callback_query(call.id, "История постов пуста.")
+        # Одна страница = один индексный запрос, без count_documents и skip
+        posts, page, prev_cursor, next_cursor = post_history_pages.fetch(cursor)
+        if not posts:
+            tg.answer_callback_query(call.id, "История постов пуста.")
             return
 
-        total_pages = (total_posts - 1) // posts_per_page + 1
-        posts = list(ad_posts_collection.find().sort("time", pymongo.DESCENDING).skip(page * posts_per_page).limit(posts_per_page))
-
-        report = f"<b>📜 История публикаций (стр. {page + 1} из {total_pages}):</b>\n\n"
+        total_pages = max(post_history_pages.total_pages(), page + 1)
+        report = f"<b>📜 История публикаций (стр. {page + 1} из ~{total_pages}):</b>\n\n"
         for post in posts:
             user_id = post.get('user_id')
             raw_user_name = post.get('user_name', 'Неизвестен')
@@ -774,13 +1983,14 @@ def show_post_history(call):
 
         keyboard = types.InlineKeyboardMarkup()
         buttons = []
-        if page > 0: buttons.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f"admin_post_history:{page - 1}"))
-        if page < total_pages - 1: buttons.append(types.InlineKeyboardButton("Вперёд ➡️", callback_data=f"admin_post_history:{page + 1}"))
+        if prev_cursor: buttons.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f"admin_post_history:{prev_cursor}"))
+        if next_cursor: buttons.append(types.InlineKeyboardButton("Вперёд ➡️", callback_data=f"admin_post_history:{next_cursor}"))
         if buttons: keyboard.row(*buttons)
 
-        bot.edit_message_text(report, chat_id=call.message.chat.id, message_id=call.message.message_id, parse_mode="HTML", reply_markup=keyboard)
+        tg.edit_message_text(report, chat_id=call.message.chat.id, message_id=call.message.message_id, parse_mode="HTML", reply_markup=keyboard)
     except Exception as e:
-        bot.answer_callback_query(call.id, f"Ошибка: {e}")
+        tg.answer_callback_query(call.id, f"Ошибка: {e}")
+# =============================================================
 
 def is_admin(user_id):
     """Проверка прав администратора через MongoDB"""
@@ -797,48 +2007,202 @@ def add_admin_step(message):
             {"$set": {"added_by": message.from_user.id, "time": now_ekb()}}, 
             upsert=True
         )
-        bot.send_message(message.chat.id, f"✅ Пользователь {new_admin_id} добавлен как администратор.")
+        tg.send_message(message.chat.id, f"✅ Пользователь {new_admin_id} добавлен как администратор.")
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Ошибка: ID должен быть числом.")
+        tg.send_message(message.chat.id, "❌ Ошибка: ID должен быть числом.")
  
-# Функция для отображения списка оплативших ИЗ MONGODB
-def show_paid_users(message):
+# ==================== 📋 СПИСОК ОПЛАТИВШИХ ====================
+# Страница — keyset-курсор по user_id: подписки обходятся по индексу с user_id в нужном порядке,
+# и обход останавливается на PAID_USERS_PER_PAGE + 1 разных юзерах, а не группирует все совпадения.
+# Имена — одним батчем из кэша профилей. Все состояние просмотра живет в callback_data:
+# "paid_users:<сеть>.<дни>.<город>[.<n|p><страница>.<user_id>]", где сеть — индекс в PAID_FILTER_NETWORKS
+# (0 — без фильтра), город — короткий хэш названия (get_city_key, "0" — без фильтра),
+# дни — «истекают в ближайшие N дней». Хэш не съезжает, когда в матрице появляются новые города.
+PAID_USERS_PER_PAGE = 15
+PAID_USERS_SCAN_INDEX = [("user_id", 1), ("city", 1), ("network", 1), ("end_date", 1)]
+PAID_FILTER_NETWORKS = [None, "Мужской Клуб", "ПАРНИ 18+", "НС", "Радуга", "Гей Знакомства", "Все сети"]
+PAID_FILTER_DAYS = [1, 3, 7, 30]
+
+def get_city_key(city):
+    """Стабильный короткий ключ города для callback_data"""
+    return hashlib.sha1(city.encode("utf-8")).hexdigest()[:8] if city else "0"
+
+def find_city_by_key(city_key):
+    """Город из матрицы по ключу; ValueError — если такого города больше нет (кнопка устарела)"""
+    if city_key == "0": return None
+    city = next((city for city in matrix.all_cities if get_city_key(city) == city_key), None)
+    if city is None:
+        raise ValueError(f"город {city_key} не найден в матрице")
+    return city
+
+def parse_paid_users_view(token):
+    """Токен из кнопки -> (сеть, дни, ключ города, курсор) — (направление, страница, user_id) или None"""
+    parts = token.split(".")
+    if len(parts) not in (3, 5):
+        raise ValueError(f"неверный токен списка оплативших: {token}")
+    net, days, city = int(parts[0]), int(parts[1]), parts[2]
+    if not 0 <= net < len(PAID_FILTER_NETWORKS) or days < 0 or not re.fullmatch(r"0|[0-9a-f]{8}", city):
+        raise ValueError(f"неверные фильтры списка оплативших: {token}")
+    cursor = None
+    if len(parts) == 5:
+        direction = parts[3][:1]
+        if direction not in ("n", "p"):
+            raise ValueError(f"неизвестное направление курсора: {direction}")
+        cursor = (direction, int(parts[3][1:]), int(parts[4]))
+    return net, days, city, cursor
+
+def get_paid_users_match(network, city, days):
+    """Фильтр активных подписок; все поля есть в индексе PAID_USERS_SCAN_INDEX"""
     now = now_ekb()
-    # Ищем все подписки, которые еще не истекли
-    active_subs = list(ad_subs_collection.find({"end_date": {"$gt": now}}).sort("end_date", 1))
+    match = {"end_date": {"$gt": now}}
+    if days: match["end_date"]["$lte"] = now + timedelta(days=days)
+    # Подписка на "Все сети" действует и в конкретной сети
+    if network: match["network"] = network if network == "Все сети" else {"$in": [network, "Все сети"]}
+    if city: match["city"] = city
+    return match
+
+def fetch_paid_users_page(match, cursor=None):
+    """Одна страница юзеров: (группы {_id: user_id, subs}, страница, курсор «Назад», курсор «Вперёд»)"""
+    direction, page, edge = cursor or ("n", 0, None)
+    query = dict(match)
+    if edge is not None: query["user_id"] = {"$lt" if direction == "p" else "$gt": edge}
+    order = pymongo.DESCENDING if direction == "p" else pymongo.ASCENDING
+
+    # 1. Идем по индексу в порядке user_id и останавливаемся, набрав страницу + 1 юзера
+    user_ids = []
+    with ad_subs_collection.find(query, {"user_id": 1, "_id": 0}).sort("user_id", order).hint(PAID_USERS_SCAN_INDEX).batch_size(100) as scan:
+        for sub in scan:
+            if user_ids and user_ids[-1] == sub["user_id"]: continue
+            user_ids.append(sub["user_id"])
+            if len(user_ids) > PAID_USERS_PER_PAGE: break
+
+    # 2. Подписки только этих юзеров
+    subs_by_user = defaultdict(list)
+    page_query = dict(match, user_id={"$in": user_ids[:PAID_USERS_PER_PAGE]})
+    for sub in ad_subs_collection.find(page_query, {"user_id": 1, "network": 1, "city": 1, "end_date": 1}):
+        subs_by_user[sub["user_id"]].append(sub)
+    groups = [{"_id": user_id, "subs": subs_by_user[user_id]} for user_id in user_ids]
+
+    has_more = len(groups) > PAID_USERS_PER_PAGE
+    groups = groups[:PAID_USERS_PER_PAGE]
+    if direction == "p":
+        if not has_more: return fetch_paid_users_page(match) # Дошли до начала — полноценная первая страница
+        groups.reverse()
+        has_prev, has_next = True, True
+    else:
+        if not groups and page: return fetch_paid_users_page(match)
+        has_prev, has_next = page > 0, has_more
+
+    prev_cursor = f"p{max(page - 1, 0)}.{groups[0]['_id']}" if has_prev and groups else None
+    next_cursor = f"n{page + 1}.{groups[-1]['_id']}" if has_next and groups else None
+    return groups, page, prev_cursor, next_cursor
+
+def send_paid_users_page(chat_id, view, message_id=None):
+    """Рисует страницу списка оплативших; с message_id — редактирует сообщение вместо отправки нового"""
+    net, days, city_key, cursor = view
+    network = PAID_FILTER_NETWORKS[net]
+    city = find_city_by_key(city_key)
+
+    groups, page, prev_cursor, next_cursor = fetch_paid_users_page(get_paid_users_match(network, city, days), cursor)
+    state = f"{net}.{days}.{city_key}"
+
+    filters = [f"🧩 {escape_html(network)}" if network else "", f"📍 {escape_html(city)}" if city else "", f"⏳ истекают ≤ {days} дн." if days else ""]
+    filters_line = " | ".join(f for f in filters if f)
+    header = f"📋 <b>Список активных оплат (стр. {page + 1}):</b>\n"
+    if filters_line: header += f"Фильтры: {filters_line}\n"
+
+    blocks = [header]
+    if not groups:
+        blocks.append("Ничего не найдено по фильтрам." if filters_line else "Пусто. Никто еще не купил рекламу.")
+
+    profiles = user_profiles.get_many([group["_id"] for group in groups])
+    for group in groups:
+        user_id = group["_id"]
+        user_info = profiles.get(user_id)
+        if user_info:
+            name = escape_html(user_info.first_name or "Без имени")
+            block = f"👤 <a href='tg://user?id={user_id}'>{user_id}</a> | {name}"
+            if user_info.username: block += f" (@{user_info.username})"
+        else:
+            block = f"👤 Пользователь: <code>{user_id}</code>"
+        block += "\n"
+        for sub in sorted(group["subs"], key=lambda sub: sub["end_date"]):
+            block += f" - 🧩 {escape_html(sub.get('network'))}, 📍 {escape_html(sub.get('city'))} (до {to_ekb_str(sub['end_date'])})\n"
+        blocks.append(block)
 
-    if not active_subs:
-        bot.send_message(message.chat.id, "📋 <b>Список активных оплат:</b>\n\nПусто. Никто еще не купил рекламу.", parse_mode="HTML")
-        return
+    markup = types.InlineKeyboardMarkup()
+    buttons = []
+    if prev_cursor: buttons.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f"paid_users:{state}.{prev_cursor}"))
+    if next_cursor: buttons.append(types.InlineKeyboardButton("Вперёд ➡️", callback_data=f"paid_users:{state}.{next_cursor}"))
+    if buttons: markup.row(*buttons)
+    markup.row(types.InlineKeyboardButton("🧩 Сеть", callback_data=f"paid_net:{state}"),
+               types.InlineKeyboardButton("📍 Город", callback_data=f"paid_city:{state}"),
+               types.InlineKeyboardButton("⏳ Срок", callback_data=f"paid_days:{state}"))
+    if filters_line: markup.add(types.InlineKeyboardButton("♻️ Сбросить фильтры", callback_data="paid_users:0.0.0"))
+
+    # Страница обычно влезает в одно сообщение; если нет — досылаем хвост, кнопки на последнем куске
+    chunks = pack_message_chunks(blocks)
+    for i, chunk in enumerate(chunks):
+        reply_markup = markup if i == len(chunks) - 1 else None
+        if i == 0 and message_id:
+            tg.edit_message_text(chunk, chat_id=chat_id, message_id=message_id, parse_mode="HTML", reply_markup=reply_markup)
+        else:
+            tg.send_message(chat_id, chunk, parse_mode="HTML", reply_markup=reply_markup)
 
-    response = "📋 <b>Список активных оплат (MongoDB):</b>\n"
-    current_user = None
-    
-    for sub in active_subs:
-        user_id = sub.get("user_id")
-        network = escape_html(sub.get("network"))
-        city = escape_html(sub.get("city"))
-        end_date = sub.get("end_date")
-        date_str = to_ekb_str(end_date)
+def show_paid_users(message):
+    send_paid_users_page(message.chat.id, (0, 0, "0", None))
 
-        if user_id != current_user:
-            try:
-                user_info = bot.get_chat(user_id)
-                name = escape_html(user_info.first_name or "Без имени")
-                username = user_info.username
-                user_line = f"\n👤 <a href='tg://user?id={user_id}'>{user_id}</a> | {name}"
-                if username: user_line += f" (@{username})"
-            except:
-                user_line = f"\n👤 Пользователь: <code>{user_id}</code>"
-            
-            response += f"{user_line}\n"
-            current_user = user_id
+@callback_route("paid_users:", args=(parse_paid_users_view,))
+def handle_paid_users_page(call, view):
+    if not is_admin(call.from_user.id):
+        tg.answer_callback_query(call.id, "⛔ Нет доступа.")
+        return
+    try:
+        send_paid_users_page(call.message.chat.id, view, call.message.message_id)
+        tg.answer_callback_query(call.id)
+    except ValueError:
+        tg.answer_callback_query(call.id, "❌ Устаревшая кнопка.")
 
-        response += f" - 🧩 {network}, 📍 {city} (до {date_str})\n"
+@callback_route("paid_net:", "paid_days:", args=(parse_paid_users_view,))
+def handle_paid_users_filter(call, view):
+    if not is_admin(call.from_user.id):
+        tg.answer_callback_query(call.id, "⛔ Нет доступа.")
+        return
+    net, days, city_key, _ = view
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    if call.data.startswith("paid_net:"):
+        markup.add(*[types.InlineKeyboardButton(name or "Любая сеть", callback_data=f"paid_users:{i}.{days}.{city_key}")
+                     for i, name in enumerate(PAID_FILTER_NETWORKS)])
+    else:
+        markup.add(*[types.InlineKeyboardButton(f"≤ {d} дн.", callback_data=f"paid_users:{net}.{d}.{city_key}") for d in PAID_FILTER_DAYS])
+        markup.add(types.InlineKeyboardButton("Любой срок", callback_data=f"paid_users:{net}.0.{city_key}"))
+    tg.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=markup)
+    tg.answer_callback_query(call.id)
 
-    bot.send_message(message.chat.id, response, parse_mode="HTML")
+@callback_route("paid_city:", args=(parse_paid_users_view,))
+def handle_paid_users_city(call, view):
+    if not is_admin(call.from_user.id):
+        tg.answer_callback_query(call.id, "⛔ Нет доступа.")
+        return
+    net, days, _, _ = view
+    tg.answer_callback_query(call.id)
+    tg.send_message(call.message.chat.id, "📍 Введите город (или «-», чтобы показать все):")
+    bot.register_next_step_handler(call.message, select_paid_users_city, net, days)
+
+@wizard_step
+def select_paid_users_city(message, net, days):
+    text = (message.text or "").strip()
+    city = None
+    if text != "-":
+        city = next((c for c in matrix.all_cities if c.lower() == text.lower()), None)
+        if city is None:
+            tg.send_message(message.chat.id, "❌ Город не найден в матрице.")
+            return
+    send_paid_users_page(message.chat.id, (net, days, get_city_key(city), None))
+# =============================================================
 
 # --- 1. Вывод списка активных подписок юзера ---
+@wizard_step
 def select_user_for_duration_change(message):
     try:
         user_id = int(message.text)
@@ -846,7 +2210,7 @@ def select_user_for_duration_change(message):
         active_subs = list(ad_subs_collection.find({"user_id": user_id, "end_date": {"$gt": now_ekb()}}))
         
         if not active_subs:
-            bot.send_message(message.chat.id, "❌ У пользователя нет активных подписок в базе.")
+            tg.send_message(message.chat.id, "❌ У пользователя нет активных подписок в базе.")
             return
 
         markup = types.InlineKeyboardMarkup(row_width=1)
@@ -859,14 +2223,13 @@ def select_user_for_duration_change(message):
             btn_text = f"🧩 {net} | 📍 {city} (до {end_date})"
             markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"manage_sub_{sub_id}"))
             
-        bot.send_message(message.chat.id, f"📋 Найдены активные подписки для ID <code>{user_id}</code>.\nВыберите, какую именно изменить:", reply_markup=markup, parse_mode="HTML")
+        tg.send_message(message.chat.id, f"📋 Найдены активные подписки для ID <code>{user_id}</code>.\nВыберите, какую именно изменить:", reply_markup=markup, parse_mode="HTML")
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Ошибка: ID должен быть числом.")
+        tg.send_message(message.chat.id, "❌ Ошибка: ID должен быть числом.")
 
 # --- 2. Меню выбора (+1 день, -1 неделя и т.д.) ---
-@bot.callback_query_handler(func=lambda call: call.data.startswith("manage_sub_"))
-def handle_manage_sub_selection(call):
-    sub_id = call.data.replace("manage_sub_", "")
+@callback_route("manage_sub_", args=(str,))
+def handle_manage_sub_selection(call, sub_id):
     
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("+1 день", callback_data=f"change_duration_{sub_id}_1"),
@@ -880,112 +2243,125 @@ def handle_manage_sub_selection(call):
     markup.add(types.InlineKeyboardButton("✅ Разрешить ссылки", callback_data=f"allow_links_{sub_id}"),
                types.InlineKeyboardButton("❌ Запретить ссылки", callback_data=f"deny_links_{sub_id}"))
     
-    bot.edit_message_text("⏳ Выберите действие для выбранной подписки:", call.message.chat.id, call.message.message_id, reply_markup=markup)
+    tg.edit_message_text("⏳ Выберите действие для выбранной подписки:", call.message.chat.id, call.message.message_id, reply_markup=markup)
 
 # --- 3. Физическое применение изменений в MongoDB ---
-@bot.callback_query_handler(func=lambda call: call.data.startswith("change_duration_"))
-def handle_duration_change(call):
+@callback_route("change_duration_", args=(ObjectId, int))
+def handle_duration_change(call, sub_id, days):
     try:
-        parts = call.data.split("_")
-        # ЗАЩИТА: проверяем, что кусков данных точно хватает
-        if len(parts) < 4:
-            bot.answer_callback_query(call.id, "❌ Устаревшая кнопка.")
-            return
-            
-        sub_id = parts[2]
-        days = int(parts[3])
-
         # Ищем эту конкретную подписку по ObjectId
-        sub = ad_subs_collection.find_one({"_id": ObjectId(sub_id)})
+        sub = ad_subs_collection.find_one({"_id": sub_id})
         
         if not sub:
-            bot.answer_callback_query(call.id, "❌ Подписка не найдена или уже истекла.")
+            tg.answer_callback_query(call.id, "❌ Подписка не найдена или уже истекла.")
             return
 
         # Накидываем или убавляем дни
         new_date = sub["end_date"] + timedelta(days=days)
-        ad_subs_collection.update_one({"_id": ObjectId(sub_id)}, {"$set": {"end_date": new_date}})
+        ad_subs_collection.update_one({"_id": sub_id}, {"$set": {"end_date": new_date}})
+        reschedule_notify(sub_id, new_date, sub)
 
-        bot.answer_callback_query(call.id, f"✅ Срок изменён на {days} дней.")
+        tg.answer_callback_query(call.id, f"✅ Срок изменён на {days} дней.")
         
         # Отчитываемся админу об успехе (используем наш новый переводчик to_ekb_str)
         success_text = (f"✅ <b>Срок успешно изменён!</b>\n\n"
                         f"🌐 Сеть: <b>{escape_html(sub.get('network'))}</b>\n"
                         f"📍 Город: <b>{escape_html(sub.get('city'))}</b>\n"
                         f"⏳ Новая дата окончания: <b>{to_ekb_str(new_date)}</b>")
-        bot.edit_message_text(success_text, call.message.chat.id, call.message.message_id, parse_mode="HTML")
+        tg.edit_message_text(success_text, call.message.chat.id, call.message.message_id, parse_mode="HTML")
 
     except Exception as e:
         print(f"Ошибка в handle_duration_change: {e}")
-        bot.answer_callback_query(call.id, "❌ Произошла ошибка при изменении срока.")
+        tg.answer_callback_query(call.id, "❌ Произошла ошибка при изменении срока.")
 
 # --- Выдача и отзыв прав на ссылки для конкретной подписки ---
-@bot.callback_query_handler(func=lambda call: call.data.startswith("allow_links_") or call.data.startswith("deny_links_"))
-def handle_links_permission(call):
-    action, _, sub_id = call.data.split("_")
-    
+@callback_route("allow_links_", "deny_links_", args=(ObjectId,))
+def handle_links_permission(call, sub_id):
     # Определяем, выдаем или забираем права
-    is_allowed = (action == "allow")
+    is_allowed = call.data.startswith("allow_links_")
     
     # Обновляем конкретную подписку в MongoDB
     result = ad_subs_collection.update_one(
-        {"_id": ObjectId(sub_id)}, 
+        {"_id": sub_id}, 
         {"$set": {"can_post_links": is_allowed}}
     )
     
     if result.modified_count > 0:
         status_text = "✅ Разрешение на публикацию ссылок ВЫДАНО!" if is_allowed else "🚫 Разрешение на ссылки ОТОЗВАНО."
-        bot.answer_callback_query(call.id, status_text, show_alert=True)
+        tg.answer_callback_query(call.id, status_text, show_alert=True)
     else:
-        bot.answer_callback_query(call.id, "⚠️ Подписка уже имеет этот статус или не найдена.")
+        tg.answer_callback_query(call.id, "⚠️ Подписка уже имеет этот статус или не найдена.")
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def pack_message_chunks(blocks, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Склеивает блоки отчета в сообщения не длиннее limit, не разрывая блоки без нужды.
+    Слишком длинный блок делится только по целым строкам: запись отчета (и ее <a>) не режется."""
+    chunks, current = [], ""
+    for block in blocks:
+        block = block.rstrip("\n") + "\n\n"
+        pieces = [block] if len(block) <= limit else [line + "\n" for line in block.split("\n")]
+        for piece in pieces:
+            if len(current) + len(piece) > limit:
+                if current.strip(): chunks.append(current)
+                current = ""
+            current += piece
+    if current.strip(): chunks.append(current)
+    return chunks
 
 @bot.message_handler(commands=['statistics'])
 def show_statistics_for_admin(chat_id):
     if not is_admin(chat_id):
-        bot.send_message(chat_id, "⛔ У вас нет прав для просмотра статистики.")
+        tg.send_message(chat_id, "⛔ У вас нет прав для просмотра статистики.")
         return
 
     stats = get_admin_statistics()
     if not stats:
-        bot.send_message(chat_id, "ℹ️ Нет данных о публикациях за сегодня.")
+        tg.send_message(chat_id, "ℹ️ Нет данных о публикациях за сегодня.")
         return
 
-    response = "<b>📊 Статистика публикаций за сегодня:</b>\n\n"
+    profiles = user_profiles.get_many(list(stats.keys()))
+
+    # Сроки подписок одним запросом на всех юзеров: (user_id, сеть, город) -> самая поздняя дата
+    sub_ends = {}
+    for sub in ad_subs_collection.find({"user_id": {"$in": list(stats.keys())}}, {"user_id": 1, "network": 1, "city": 1, "end_date": 1}):
+        key = (sub["user_id"], sub["network"], sub["city"])
+        sub_ends[key] = max(sub_ends.get(key, sub["end_date"]), sub["end_date"])
 
+    blocks = ["<b>📊 Статистика публикаций за сегодня:</b>\n"]
     for user_id, user_stats in stats.items():
-        try:
-            user_info = bot.get_chat(user_id)
+        user_info = profiles.get(user_id)
+        if user_info:
             user_name = escape_html(user_info.first_name)
             user_link = (f"<a href='https://t.me/{user_info.username}'>{user_name}</a>" if user_info.username 
                          else f"<a href='tg://user?id={user_info.id}'>{user_name}</a>")
-        except:
+        else:
             user_link = f"ID <code>{user_id}</code>"
 
-        response += (f"👤 {user_link}\n"
-                     f"📨 Опубликовано: <b>{user_stats['published']}</b>\n")
+        block = (f"👤 {user_link}\n"
+                 f"📨 Опубликовано: <b>{user_stats['published']}</b>\n")
 
         if user_stats["details"]:
-            response += "🧾 <b>Детали по сетям:</b>\n"
+            block += "🧾 <b>Детали по сетям:</b>\n"
             for network, cities in user_stats["details"].items():
                 for city, data in cities.items():
-                    # Ищем подписку в Mongo
-                    sub = ad_subs_collection.find_one({"user_id": user_id, "network": {"$in": ["Все сети", network]}, "city": city})
-                    expire_str = f"⏳ до {sub['end_date'].strftime('%d.%m.%Y')}" if sub else "(Без активной подписки)"
+                    end_date = sub_ends.get((user_id, network, city)) or sub_ends.get((user_id, "Все сети", city))
+                    expire_str = f"⏳ до {end_date.strftime('%d.%m.%Y')}" if end_date else "(Без активной подписки)"
                     
-                    response += (f"  └ 🧩 <b>{escape_html(network)}</b>, 📍<b>{escape_html(city)}</b> {expire_str}:\n"
-                                 f"     Опубликовано: <b>{data['published']} / 3</b>\n")
+                    block += (f"  └ 🧩 <b>{escape_html(network)}</b>, 📍<b>{escape_html(city)}</b> {expire_str}:\n"
+                              f"     Опубликовано: <b>{data['published']} / {DAILY_POST_LIMIT}</b>\n")
 
         if user_stats["links"]:
-            unique_links = list(set(user_stats["links"]))
-            response += "🔗 <b>Ссылки:</b>\n"
-            for link in unique_links:
-                response += f"  • <a href='{link}'>{link}</a>\n"
-        response += "\n"
+            block += "🔗 <b>Ссылки:</b>\n"
+            for link in user_stats["links"]:
+                block += f"  • <a href='{link}'>{link}</a>\n"
+        blocks.append(block)
 
     try:
-        bot.send_message(chat_id, response, parse_mode="HTML", disable_web_page_preview=True)
+        for chunk in pack_message_chunks(blocks):
+            tg.send_message(chat_id, chunk, parse_mode="HTML", disable_web_page_preview=True)
     except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка отправки: <code>{escape_html(str(e))}</code>", parse_mode="HTML")
+        tg.send_message(chat_id, f"❌ Ошибка отправки: <code>{escape_html(str(e))}</code>", parse_mode="HTML")
 
 # --- ВЕРНУВШИЕСЯ ПОМОЩНИКИ ---
 def get_network_markup():
@@ -1021,8 +2397,8 @@ def get_user_html_link(user):
 def create_new_post_category(message):
     if message.chat.type != "private": return
     
-    # 👇 Обновляем города из базы данных прямо сейчас! 👇
-    refresh_matrix() 
+    # 👇 Обновляем города из базы данных, если ЦУП их поменял 👇
+    refresh_matrix()
     
     # 🧹 ОЧИЩАЕМ КОРЗИНУ (чтобы бот забыл старые посты/шаблоны)
     db['users'].update_one(
@@ -1032,16 +2408,17 @@ def create_new_post_category(message):
     
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True, row_width=1)
     markup.add("💆‍♂️ Встречи / Услуги / Массажи", "📢 Реклама TG-групп / Каналов", "Назад")
-    bot.send_message(message.chat.id, "Выберите категорию вашего объявления:", reply_markup=markup)
+    tg.send_message(message.chat.id, "Выберите категорию вашего объявления:", reply_markup=markup)
     bot.register_next_step_handler(message, handle_category)
 
+@wizard_step
 def handle_category(message):
     if message.text == "Назад":
-        bot.send_message(message.chat.id, "Главное меню", reply_markup=get_main_keyboard())
+        tg.send_message(message.chat.id, "Главное меню", reply_markup=get_main_keyboard())
         return
         
     if "групп" in message.text:
-        bot.send_message(
+        tg.send_message(
             message.chat.id, 
             "Отлично! 🎪 Но перед оплатой мы должны убедиться, что тематика вашего ресурса подходит для нашей сети.\n\n"
             "Пожалуйста, отправьте ссылку на ваш канал/группу или @username:", 
@@ -1052,13 +2429,14 @@ def handle_category(message):
         
     # Если это обычное объявление — сохраняем статус "std" и идем дальше
     db['users'].update_one({"_id": message.from_user.id}, {"$set": {"temp_ad_type": "std"}}, upsert=True)
-    bot.send_message(message.chat.id, "📋 Выберите сеть для публикации:", reply_markup=get_network_markup())
+    tg.send_message(message.chat.id, "📋 Выберите сеть для публикации:", reply_markup=get_network_markup())
     bot.register_next_step_handler(message, select_network_step)
 
 # НОВАЯ ФУНКЦИЯ: Принимаем ссылку и шлем админу
+@wizard_step
 def request_vip_approval(message):
     if message.text in ["Назад", "/start"]:
-        bot.send_message(message.chat.id, "Главное меню", reply_markup=get_main_keyboard())
+        tg.send_message(message.chat.id, "Главное меню", reply_markup=get_main_keyboard())
         return
         
     link = message.text
@@ -1071,7 +2449,7 @@ def request_vip_approval(message):
         types.InlineKeyboardButton("✅ Одобрить", callback_data=f"vip_approve_{user_id}"),
         types.InlineKeyboardButton("❌ Отклонить", callback_data=f"vip_reject_{user_id}")
     )
-    bot.send_message(
+    tg.send_message(
         ADMIN_CHAT_ID,
         f"🚨 <b>Новая заявка на VIP-рекламу!</b>\n👤 Пользователь: <a href='tg://user?id={user_id}'>{user_name}</a> (<code>{user_id}</code>)\n🔗 Ссылка: {escape_html(link)}",
         parse_mode="HTML",
@@ -1079,8 +2457,9 @@ def request_vip_approval(message):
     )
 
     # 2. Успокаиваем пользователя
-    bot.send_message(message.chat.id, "⏳ <b>Заявка отправлена на модерацию.</b>\nКак только администратор проверит ресурс, вы получите уведомление!", parse_mode="HTML", reply_markup=get_main_keyboard())
+    tg.send_message(message.chat.id, "⏳ <b>Заявка отправлена на модерацию.</b>\nКак только администратор проверит ресурс, вы получите уведомление!", parse_mode="HTML", reply_markup=get_main_keyboard())
 
+@wizard_step
 def select_network_step(message):
     if message.text == "Назад":
         # Возвращаем на шаг назад к выбору категории
@@ -1093,17 +2472,13 @@ def select_network_step(message):
     if selected_network in valid_networks:
         markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True, row_width=2)
 
-        if selected_network == "Все сети":
-            cities = [city for city, nets in all_cities.items() if len(nets) >= 2]
-        else:
-            key = normalize_network_key(selected_network)
-            cities = [city for city, nets in all_cities.items() if key in nets]
+        cities = matrix.cities_for(selected_network)
 
         for city in cities:
             markup.add(city)
         markup.add("Выбрать другую сеть", "Назад")
 
-        bot.send_message(
+        tg.send_message(
             message.chat.id,
             "📍 <b>Выберите город</b> для публикации или нажмите «<i>Выбрать другую сеть</i>»:",
             reply_markup=markup,
@@ -1112,12 +2487,13 @@ def select_network_step(message):
         # Передаем эстафету функции проверки оплаты
         bot.register_next_step_handler(message, select_city_check_payment, selected_network)
     else:
-        bot.send_message(message.chat.id, "❌ Ошибка! Пожалуйста, выберите одну из предложенных сетей.", parse_mode="HTML")
+        tg.send_message(message.chat.id, "❌ Ошибка! Пожалуйста, выберите одну из предложенных сетей.", parse_mode="HTML")
         bot.register_next_step_handler(message, select_network_step)
 
+@wizard_step
 def select_city_check_payment(message, selected_network):
     if message.text == "Назад" or message.text == "Выбрать другую сеть":
-        bot.send_message(message.chat.id, "📋 Выберите сеть для публикации:", reply_markup=get_network_markup())
+        tg.send_message(message.chat.id, "📋 Выберите сеть для публикации:", reply_markup=get_network_markup())
         bot.register_next_step_handler(message, select_network_step)
         return
 
@@ -1129,7 +2505,7 @@ def select_city_check_payment(message, selected_network):
     has_access = False
     for network in networks:
         net_key = normalize_network_key(network)
-        if all_cities.get(city, {}).get(net_key) and is_user_paid(user_id, network, city):
+        if matrix.all_cities.get(city, {}).get(net_key) and is_user_paid(user_id, network, city):
             has_access = True
             break
 
@@ -1139,15 +2515,22 @@ def select_city_check_payment(message, selected_network):
         net_key = normalize_network_key(network)
         
         # Если вдруг выбранного города нет в этой сети, ищем первую подходящую
-        if not all_cities.get(city, {}).get(net_key):
+        if not matrix.all_cities.get(city, {}).get(net_key):
             for n in networks:
-                if all_cities.get(city, {}).get(normalize_network_key(n)):
+                if matrix.all_cities.get(city, {}).get(normalize_network_key(n)):
                     network = n
                     net_key = normalize_network_key(n)
                     break
 
-        chat_id = all_cities[city][net_key][0]["chat_id"]
-        
+        # Вся математика (VIP-наценка, пакетная скидка, закреп) — в котировке
+        callback_net_key = "all" if selected_network == "Все сети" else net_key
+        quote = build_quote(user_id, callback_net_key, city)
+        if not quote:
+            # Город набран руками или пропал из матрицы — просим выбрать из списка еще раз
+            tg.send_message(message.chat.id, f"❌ Города <b>{escape_html(city)}</b> нет в сети <b>{escape_html(selected_network)}</b>. Выберите город из списка:", parse_mode="HTML")
+            bot.register_next_step_handler(message, select_city_check_payment, selected_network)
+            return
+
         cheap_stars_text = (
             "<b>💡 Лайфхак: Как купить звёзды ДЕШЕВЛЕ официального курса?</b>\n\n"
             "Перед оплатой рекомендуем приобрести звёзды через проверенный сервис. "
@@ -1160,50 +2543,14 @@ def select_city_check_payment(message, selected_network):
             "5️⃣ Оплатите удобным способом\n\n"
             "После покупки возвращайтесь сюда и выбирайте тариф ниже! 👇"
         )
-        try: bot.send_message(message.chat.id, cheap_stars_text, parse_mode="HTML", disable_web_page_preview=True)
+        try: tg.send_message(message.chat.id, cheap_stars_text, parse_mode="HTML", disable_web_page_preview=True)
         except: pass
 
-        # 👇 ПОДНЯЛИ ПЕРЕМЕННУЮ СЮДА 👇
-        callback_net_key = "all" if selected_network == "Все сети" else net_key
-
         markup = types.InlineKeyboardMarkup(row_width=1)
         markup.add(types.InlineKeyboardButton("🎫 У меня есть промокод", callback_data=f"ad_promo_{callback_net_key}_{city}"))
-        
-        active_subs_count = len(ad_subs_collection.distinct("network", {"user_id": user_id, "city": city, "end_date": {"$gt": now_ekb()}}))
-        buying_now = (len([n for n, d in all_cities[city].items() if d]) - active_subs_count) if selected_network == "Все сети" else 1
-        total_nets = (active_subs_count + buying_now)
-        
-        discount = 0
-        if total_nets == 3: discount = 10
-        elif total_nets == 4: discount = 20
-        elif total_nets >= 5: discount = 30
+        add_quote_buttons(markup, quote, quote["discount_net"])
 
-        # --- Достаем VIP статус для наценки ---
-        user_data = db['users'].find_one({"_id": user_id})
-        is_vip = user_data.get("temp_ad_type") == "vip" if user_data else False
-        markup_multiplier = 1.5 if is_vip else 1.0 # 👈 НАЦЕНКА +50%
-
-        # (Отсюда строку callback_net_key = ... удаляем, она теперь сверху)
-
-        for days in [1, 7, 15, 30]:
-            base_p = get_price_for_chat(chat_id, days)
-            if base_p:
-                # Умножаем на 1.5 ДО применения скидок за мульти-сеть
-                base_p = int(base_p * markup_multiplier)
-                
-                f_price = int((base_p * buying_now) * (1 - discount / 100))
-                pin_p = int(f_price * 1.2)
-                
-                btn_prefix = "🔥 VIP:" if is_vip else "💳"
-                btn_t = f"{btn_prefix} {days} дн. (-{discount}% за {f_price}⭐️)" if discount > 0 else f"{btn_prefix} {days} дн. ({f_price}⭐️)"
-                
-                # 👇 МЕНЯЕМ net_key НА callback_net_key 👇
-                markup.row(
-                    types.InlineKeyboardButton(btn_t, callback_data=f"ad_pay_{days}_{callback_net_key}_{city}"),
-                    types.InlineKeyboardButton(f"📌 +Закреп ({pin_p}⭐️)", callback_data=f"ad_paypin_{days}_{callback_net_key}_{city}")
-                )
-
-        bot.send_message(
+        tg.send_message(
             message.chat.id,
             f"⛔ У вас нет доступа к публикации в <b>{escape_html(selected_network)}</b> ({escape_html(city)}).\n\nПриобретите доступ:",
             reply_markup=markup,
@@ -1218,51 +2565,54 @@ def select_city_check_payment(message, selected_network):
         # Если текст уже загружен из шаблона, перепрыгиваем к предпросмотру
         msg = types.Message(message.message_id, message.from_user, message.date, message.chat, "content_type", {}, "")
         msg.text = "✅ Все файлы загружены. Далее"
-        bot.send_message(message.chat.id, "✅ Доступ подтвержден. Идет подготовка шаблона...")
+        tg.send_message(message.chat.id, "✅ Доступ подтвержден. Идет подготовка шаблона...")
         process_ad_media_loop(msg, selected_network, city)
     else:
         # Обычный сценарий — просим текст
-        bot.send_message(message.chat.id, f"✅ Доступ подтверждён!\n\nНапишите текст объявления для <b>{selected_network} ({city})</b>:", parse_mode="HTML", reply_markup=types.ReplyKeyboardRemove())
+        tg.send_message(message.chat.id, f"✅ Доступ подтверждён!\n\nНапишите текст объявления для <b>{selected_network} ({city})</b>:", parse_mode="HTML", reply_markup=types.ReplyKeyboardRemove())
         bot.register_next_step_handler(message, process_text_step, selected_network, city)
 
+@wizard_step
 def process_text_step(message, selected_network, city):
     if message.text == "Назад":
-        bot.send_message(message.chat.id, "Вы вернулись в главное меню.", reply_markup=get_main_keyboard())
+        tg.send_message(message.chat.id, "Вы вернулись в главное меню.", reply_markup=get_main_keyboard())
         return
 
     text = message.text or message.caption or ""
     if not text:
-        bot.send_message(message.chat.id, "❌ Ошибка! Сначала отправьте ТЕКСТ объявления:")
+        tg.send_message(message.chat.id, "❌ Ошибка! Сначала отправьте ТЕКСТ объявления:")
         bot.register_next_step_handler(message, process_text_step, selected_network, city)
         return
 
     # Проверка стоп-слов
     sub = ad_subs_collection.find_one({"user_id": message.from_user.id, "city": city, "network": {"$in": ["Все сети", selected_network]}, "end_date": {"$gt": now_ekb()}})
     can_post_links = sub.get("can_post_links", False) if sub else False
-    is_bad, trigger_word = check_stop_words(text, ignore_black_zone=can_post_links)
+    is_bad, trigger_word, has_links = check_stop_words(text, ignore_black_zone=can_post_links)
     
     if is_bad:
-        bot.send_message(message.chat.id, f"❌ <b>Объявление отклонено!</b>\n\nВ тексте найдено запрещенное слово: <b>{trigger_word}</b>\n\nИсправьте текст и отправьте заново:", parse_mode="HTML")
+        tg.send_message(message.chat.id, f"❌ <b>Объявление отклонено!</b>\n\nВ тексте найдено запрещенное слово: <b>{trigger_word}</b>\n\nИсправьте текст и отправьте заново:", parse_mode="HTML")
         bot.register_next_step_handler(message, process_text_step, selected_network, city)
         return
 
     # 1. Сохраняем чистый текст во временную корзину MongoDB
-    db['users'].update_one({"_id": message.from_user.id}, {"$set": {"temp_ad_text": text, "temp_ad_media": []}}, upsert=True)
+    db['users'].update_one({"_id": message.from_user.id}, {"$set": {"temp_ad_text": text, "temp_ad_has_links": has_links, "temp_ad_media": []}}, upsert=True)
 
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     markup.add("✅ Все файлы загружены. Далее")
     markup.add("Назад")
     
-    bot.send_message(message.chat.id, "📸 Теперь отправьте фото или видео (до 10 штук).\n<i>Если медиа не нужно, просто нажмите кнопку ниже 👇</i>", parse_mode="HTML", reply_markup=markup)
+    tg.send_message(message.chat.id, "📸 Теперь отправьте фото или видео (до 10 штук).\n<i>Если медиа не нужно, просто нажмите кнопку ниже 👇</i>", parse_mode="HTML", reply_markup=markup)
     bot.register_next_step_handler(message, process_ad_media_loop, selected_network, city)
 
 
+@wizard_step
 def process_ad_media_loop(message, selected_network, city):
     uid = message.from_user.id
 
     if message.text == "✅ Все файлы загружены. Далее":
         user_data = db['users'].find_one({"_id": uid})
         text = user_data.get("temp_ad_text", "")
+        has_links = user_data.get("temp_ad_has_links")
         media = user_data.get("temp_ad_media", [])
         
         media_type = None
@@ -1276,7 +2626,7 @@ def process_ad_media_loop(message, selected_network, city):
             file_id = "album_data"
 
         # --- 👁 ГЕНЕРАЦИЯ ПРЕДПРОСМОТРА ---
-        bot.send_message(message.chat.id, "👁 <b>ПРЕДПРОСМОТР ВАШЕГО ОБЪЯВЛЕНИЯ:</b>\n<i>Именно так его увидят пользователи в группе:</i>", parse_mode="HTML")
+        tg.send_message(message.chat.id, "👁 <b>ПРЕДПРОСМОТР ВАШЕГО ОБЪЯВЛЕНИЯ:</b>\n<i>Именно так его увидят пользователи в группе:</i>", parse_mode="HTML")
         
         # Берем подпись для выбранной сети (если "Все сети", берем подпись МК как дефолтную для превью)
         preview_network = "Мужской Клуб" if selected_network == "Все сети" else selected_network
@@ -1294,16 +2644,16 @@ def process_ad_media_loop(message, selected_network, city):
                 for m in media:
                     if m['type'] == 'photo': media_list.append(types.InputMediaPhoto(m['id']))
                     else: media_list.append(types.InputMediaVideo(m['id']))
-                bot.send_media_group(message.chat.id, media_list)
-                bot.send_message(message.chat.id, full_text_preview, parse_mode="HTML", reply_markup=reply_markup)
+                tg.send_media_group(message.chat.id, media_list)
+                tg.send_message(message.chat.id, full_text_preview, parse_mode="HTML", reply_markup=reply_markup)
             elif media_type == "photo": 
-                bot.send_photo(message.chat.id, file_id, caption=full_text_preview, parse_mode="HTML", reply_markup=reply_markup)
+                tg.send_photo(message.chat.id, file_id, caption=full_text_preview, parse_mode="HTML", reply_markup=reply_markup)
             elif media_type == "video": 
-                bot.send_video(message.chat.id, file_id, caption=full_text_preview, parse_mode="HTML", reply_markup=reply_markup)
+                tg.send_video(message.chat.id, file_id, caption=full_text_preview, parse_mode="HTML", reply_markup=reply_markup)
             else: 
-                bot.send_message(message.chat.id, full_text_preview, parse_mode="HTML", reply_markup=reply_markup)
+                tg.send_message(message.chat.id, full_text_preview, parse_mode="HTML", reply_markup=reply_markup)
         except Exception as e:
-            bot.send_message(message.chat.id, f"⚠️ Ошибка генерации предпросмотра: {e}")
+            tg.send_message(message.chat.id, f"⚠️ Ошибка генерации предпросмотра: {e}")
         # -----------------------------------
 
         # Выводим меню действий после предпросмотра
@@ -1313,12 +2663,12 @@ def process_ad_media_loop(message, selected_network, city):
         markup.add("💾 Сохранить как шаблон (и выйти)") # Новая кнопка
         markup.add("❌ Нет, изменить текст")
         
-        bot.send_message(message.chat.id, "Всё выглядит отлично? Выберите действие:", reply_markup=markup)
-        bot.register_next_step_handler(message, handle_confirmation_step, text, media_type, file_id, selected_network, city)
+        tg.send_message(message.chat.id, "Всё выглядит отлично? Выберите действие:", reply_markup=markup)
+        bot.register_next_step_handler(message, handle_confirmation_step, text, media_type, file_id, selected_network, city, has_links=has_links)
         return
 
     if message.text == "Назад":
-        bot.send_message(message.chat.id, "Создание отменено.", reply_markup=get_main_keyboard())
+        tg.send_message(message.chat.id, "Создание отменено.", reply_markup=get_main_keyboard())
         return
 
     # Продолжаем слушать чат для медиа
@@ -1334,15 +2684,16 @@ def process_ad_media_loop(message, selected_network, city):
         
         if len(current_media) >= 10:
             if not getattr(message, 'media_group_id', None):
-                bot.send_message(message.chat.id, "🚫 Лимит 10 файлов исчерпан! Жмите «Далее».")
+                tg.send_message(message.chat.id, "🚫 Лимит 10 файлов исчерпан! Жмите «Далее».")
         else:
             db['users'].update_one({"_id": uid}, {"$push": {"temp_ad_media": media_item}})
             if not getattr(message, 'media_group_id', None):
-                bot.send_message(message.chat.id, f"📥 Файл принят ({len(current_media) + 1}/10)")
+                tg.send_message(message.chat.id, f"📥 Файл принят ({len(current_media) + 1}/10)")
 
-def handle_confirmation_step(message, text, media_type, file_id, selected_network, city):
+@wizard_step
+def handle_confirmation_step(message, text, media_type, file_id, selected_network, city, has_links=None):
     if message.text == "❌ Нет, изменить текст" or message.text.lower() == "нет, изменить текст":
-        bot.send_message(message.chat.id, "Хорошо, напишите текст объявления заново:")
+        tg.send_message(message.chat.id, "Хорошо, напишите текст объявления заново:")
         bot.register_next_step_handler(message, process_text_step, selected_network, city)
         return
 
@@ -1365,7 +2716,7 @@ def handle_confirmation_step(message, text, media_type, file_id, selected_networ
             "created_at": now_ekb()
         })
         
-        bot.send_message(
+        tg.send_message(
             message.chat.id, 
             f"✅ <b>Шаблон сохранен!</b>\nТеперь вы можете быстро запустить его из меню «📝 Мои шаблоны».", 
             parse_mode="HTML", 
@@ -1378,8 +2729,8 @@ def handle_confirmation_step(message, text, media_type, file_id, selected_networ
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True, row_width=4)
         markup.add("4", "6", "8", "12")
         markup.add("Отмена")
-        bot.send_message(message.chat.id, "⏱ <b>Настройка автопостинга:</b>\nЧерез сколько часов автоматически повторять пост?\n\n<i>Нажмите кнопку или напишите цифру вручную (от 1 до 24):</i>", parse_mode="HTML", reply_markup=markup)
-        bot.register_next_step_handler(message, process_autopost_interval, text, media_type, file_id, selected_network, city)
+        tg.send_message(message.chat.id, "⏱ <b>Настройка автопостинга:</b>\nЧерез сколько часов автоматически повторять пост?\n\n<i>Нажмите кнопку или напишите цифру вручную (от 1 до 24):</i>", parse_mode="HTML", reply_markup=markup)
+        bot.register_next_step_handler(message, process_autopost_interval, text, media_type, file_id, selected_network, city, has_links=has_links)
         return
 
     user_id = message.from_user.id
@@ -1387,84 +2738,70 @@ def handle_confirmation_step(message, text, media_type, file_id, selected_networ
     text = escape_html(text)
     networks = ["Мужской Клуб", "ПАРНИ 18+", "НС", "Радуга", "Гей Знакомства"] if selected_network == "Все сети" else [selected_network]
 
-    was_published = False
+    media_array = []
+    if media_type == "album":
+        user_data = db['users'].find_one({"_id": user_id})
+        media_array = user_data.get("temp_ad_media", [])
 
+    # 1. Сначала все проверки по сетям, чтобы потом разослать одним параллельным заходом
+    targets = [] # (сеть, чат, подписка)
+    if has_links is None: # Шаблон или диалог, начатый до скана ссылок в process_text_step
+        has_links = bool(LINK_PATTERN.search(text.lower()))
+    user_stats = get_user_statistics(user_id) # Один раз на все сети: леджер не меняется до публикации
     for network in networks:
         net_key = normalize_network_key(network)
-        city_data = all_cities.get(city, {}).get(net_key)
+        city_data = matrix.all_cities.get(city, {}).get(net_key)
 
         if not city_data: continue
 
         # --- Проверка лимитов ---
-        user_stats = get_user_statistics(user_id)
         city_stats = user_stats.get("details", {}).get(network, {}).get(city, {})
 
         if city_stats.get("remaining", 0) <= 0:
-            bot.send_message(message.chat.id, f"⛔ Лимит публикаций на сегодня исчерпан для <b>{escape_html(network)}</b> ({escape_html(city)})", parse_mode="HTML")
+            tg.send_message(message.chat.id, f"⛔ Лимит публикаций на сегодня исчерпан для <b>{escape_html(network)}</b> ({escape_html(city)})", parse_mode="HTML")
             continue
 
         # --- Проверка на ссылки (Наша новая логика) ---
         sub = ad_subs_collection.find_one({"user_id": user_id, "city": city, "network": {"$in": ["Все сети", network]}, "end_date": {"$gt": now_ekb()}})
         can_post_links = sub.get("can_post_links", False) if sub else False
 
-        if not can_post_links:
-            has_links = bool(re.search(r'(t\.me/|@\w+|http)', text.lower()))
-            if has_links:
-                bot.send_message(message.chat.id, "❌ Ссылки и @username запрещены! Уберите их из текста.")
-                ask_for_new_post(message)
-                return
+        if not can_post_links and has_links:
+            tg.send_message(message.chat.id, "❌ Ссылки и @username запрещены! Уберите их из текста.")
+            ask_for_new_post(message)
+            return
+
+        for location in city_data:
+            targets.append((network, location, sub))
+
+    # 2. Публикация: все чаты параллельно, в рамках лимитов Telegram
+    reply_markup = types.InlineKeyboardMarkup()
+    reply_markup.add(types.InlineKeyboardButton(text="Напиши мне в ЛС", url=f"tg://user?id={user_id}", style="success", icon_custom_emoji_id="5470060791883374114"))
 
-        # --- Публикация ---
+    def make_job(network, location, sub):
         signature = network_signatures.get(network, "")
         full_text = f"{ad_top_stickers}📢 Объявление от {user_name}:\n\n{text}\n\n{signature}"
-        
-        reply_markup = types.InlineKeyboardMarkup()
-        reply_markup.add(types.InlineKeyboardButton(text="Напиши мне в ЛС", url=f"tg://user?id={user_id}", style="success", icon_custom_emoji_id="5470060791883374114"))
+        has_pin = bool(sub and sub.get("has_pin"))
+        return lambda: send_ad_to_chat(location["chat_id"], full_text, reply_markup, media_type, file_id, media_array, pin=has_pin)
 
-        for location in city_data:
-            chat_id = location["chat_id"]
-            try:
-                media_msg_ids = None # 👈 Переменная для ID альбома
-                
-                if media_type == "album":
-                    user_data = db['users'].find_one({"_id": user_id})
-                    media_array = user_data.get("temp_ad_media", [])
-                    
-                    media_list = []
-                    for m in media_array:
-                        if m['type'] == 'photo': media_list.append(types.InputMediaPhoto(m['id']))
-                        else: media_list.append(types.InputMediaVideo(m['id']))
-                    
-                    # 1. Отправляем альбом и сохраняем ID каждого отправленного фото
-                    sent_media = bot.send_media_group(chat_id, media_list)
-                    media_msg_ids = [m.message_id for m in sent_media]
-                    
-                    # 2. Следом кидаем текст
-                    sent_msg = bot.send_message(chat_id, full_text, parse_mode="HTML", reply_markup=reply_markup)
-                    main_msg_id = sent_msg.message_id
-                    
-                elif media_type == "photo": 
-                    sent_msg = bot.send_photo(chat_id, file_id, caption=full_text, parse_mode="HTML", reply_markup=reply_markup)
-                    main_msg_id = sent_msg.message_id
-                elif media_type == "video": 
-                    sent_msg = bot.send_video(chat_id, file_id, caption=full_text, parse_mode="HTML", reply_markup=reply_markup)
-                    main_msg_id = sent_msg.message_id
-                else: 
-                    sent_msg = bot.send_message(chat_id, full_text, parse_mode="HTML", reply_markup=reply_markup)
-                    main_msg_id = sent_msg.message_id
-
-                # 💥 Пишем в историю, передавая media_msg_ids
-                add_post_to_history(user_id, message.from_user.first_name or "Без имени", network, location['name'], chat_id, main_msg_id, media_message_ids=media_msg_ids)
-                
-                bot.send_message(message.chat.id, f"✅ Опубликовано в <b>{network}</b> ({location['name']}).", parse_mode="HTML")
-                was_published = True
-
-                if sub and sub.get("has_pin"):
-                    try: bot.pin_chat_message(chat_id, main_msg_id, disable_notification=True)
-                    except: pass
-
-            except telebot.apihelper.ApiTelegramException as e:
-                bot.send_message(message.chat.id, f"❌ Ошибка в {network}: {e.description}")
+    results = publish_engine.run([make_job(*target) for target in targets])
+
+    # 3. История (одной пачкой) и один общий отчет вместо сообщения на каждый чат
+    report, history = [], []
+    for (network, location, sub), (sent, error) in zip(targets, results):
+        if error:
+            reason = error.description if isinstance(error, ApiTelegramException) else str(error)
+            report.append(f"❌ Ошибка в {escape_html(network)}: {escape_html(reason)}")
+            continue
+
+        main_msg_id, media_msg_ids = sent
+        # 💥 Пишем в историю, передавая media_msg_ids
+        history.append(make_history_post(user_id, message.from_user.first_name or "Без имени", network, location['name'], location["chat_id"], main_msg_id, media_message_ids=media_msg_ids))
+        report.append(f"✅ Опубликовано в <b>{network}</b> ({location['name']}).")
+    add_posts_to_history(history)
+
+    # "Все сети" по всей матрице не влезает в одно сообщение — режем по строкам отчета
+    for chunk in pack_message_chunks(["\n".join(report)]):
+        tg.send_message(message.chat.id, chunk, parse_mode="HTML")
 
     ask_for_new_post(message)
 
@@ -1478,7 +2815,7 @@ def handle_my_templates(message):
     templates = list(ad_templates_collection.find({"user_id": user_id}).sort("created_at", pymongo.DESCENDING))
     
     if not templates:
-        bot.send_message(message.chat.id, "🤷‍♂️ У вас пока нет сохраненных шаблонов. Вы можете сохранить объявление как шаблон на этапе предпросмотра.")
+        tg.send_message(message.chat.id, "🤷‍♂️ У вас пока нет сохраненных шаблонов. Вы можете сохранить объявление как шаблон на этапе предпросмотра.")
         return
 
     for t in templates:
@@ -1495,23 +2832,21 @@ def handle_my_templates(message):
         media_status = "🖼 Есть вложения" if t.get('media_array') else "Без медиафайлов"
         preview_text += f"\n\n📎 <b>Медиа:</b> {media_status}"
 
-        bot.send_message(message.chat.id, preview_text, parse_mode="HTML", reply_markup=markup)
+        tg.send_message(message.chat.id, preview_text, parse_mode="HTML", reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("del_tpl_"))
-def handle_delete_template(call):
-    tpl_id = call.data.replace("del_tpl_", "")
-    ad_templates_collection.delete_one({"_id": ObjectId(tpl_id), "user_id": call.from_user.id})
+@callback_route("del_tpl_", args=(ObjectId,))
+def handle_delete_template(call, tpl_id):
+    ad_templates_collection.delete_one({"_id": tpl_id, "user_id": call.from_user.id})
     
-    bot.edit_message_text("🗑 Шаблон удален.", call.message.chat.id, call.message.message_id)
+    tg.edit_message_text("🗑 Шаблон удален.", call.message.chat.id, call.message.message_id)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("use_tpl_"))
-def handle_use_template(call):
-    bot.answer_callback_query(call.id)
-    tpl_id = call.data.replace("use_tpl_", "")
-    template = ad_templates_collection.find_one({"_id": ObjectId(tpl_id)})
+@callback_route("use_tpl_", args=(ObjectId,))
+def handle_use_template(call, tpl_id):
+    tg.answer_callback_query(call.id)
+    template = ad_templates_collection.find_one({"_id": tpl_id})
     
     if not template:
-        bot.send_message(call.message.chat.id, "❌ Ошибка: шаблон не найден.")
+        tg.send_message(call.message.chat.id, "❌ Ошибка: шаблон не найден.")
         return
 
     # Загружаем шаблон в корзину пользователя
@@ -1521,11 +2856,11 @@ def handle_use_template(call):
             "temp_ad_text": template['text'], 
             "temp_ad_media": template.get('media_array', []),
             "temp_ad_type": "std" # Сбрасываем тип на стандартный
-        }}, 
+        }, "$unset": {"temp_ad_has_links": ""}}, # Текст шаблона не сканировался — ссылки проверим при публикации
         upsert=True
     )
     
-    bot.send_message(
+    tg.send_message(
         call.message.chat.id, 
         f"✅ <b>Шаблон загружен!</b>\nКуда будем публиковать?", 
         parse_mode="HTML", 
@@ -1534,9 +2869,10 @@ def handle_use_template(call):
     # Передаем эстафету выбора сети (пропуская шаг написания текста)
     bot.register_next_step_handler(call.message, select_network_step)
 
-def process_autopost_interval(message, text, media_type, file_id, selected_network, city):
+@wizard_step
+def process_autopost_interval(message, text, media_type, file_id, selected_network, city, has_links=None):
     if message.text == "Отмена":
-        bot.send_message(message.chat.id, "Настройка автопоста отменена.", reply_markup=get_main_keyboard())
+        tg.send_message(message.chat.id, "Настройка автопоста отменена.", reply_markup=get_main_keyboard())
         return
         
     try:
@@ -1544,21 +2880,21 @@ def process_autopost_interval(message, text, media_type, file_id, selected_netwo
         if interval < 1 or interval > 24:
             raise ValueError
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Пожалуйста, введите корректную цифру от 1 до 24.")
-        bot.register_next_step_handler(message, process_autopost_interval, text, media_type, file_id, selected_network, city)
+        tg.send_message(message.chat.id, "❌ Пожалуйста, введите корректную цифру от 1 до 24.")
+        bot.register_next_step_handler(message, process_autopost_interval, text, media_type, file_id, selected_network, city, has_links=has_links)
         return
         
     user_id = message.from_user.id
     
     # 1. Публикуем ПЕРВЫЙ пост прямо сейчас (перенаправляем обратно в твою оригинальную функцию)
     message.text = "✅ Опубликовать разово (сейчас)"
-    handle_confirmation_step(message, text, media_type, file_id, selected_network, city)
+    handle_confirmation_step(message, text, media_type, file_id, selected_network, city, has_links=has_links)
     
     media_array = []
     if media_type == "album":
         media_array = db['users'].find_one({"_id": user_id}).get("temp_ad_media", [])
 
-    autopost_queue.insert_one({
+    task = autopost_queue.insert_one({
         "user_id": user_id,
         "network": selected_network,
         "city": city,
@@ -1570,26 +2906,120 @@ def process_autopost_interval(message, text, media_type, file_id, selected_netwo
         "posts_left": 2, 
         "next_run": now_ekb() + timedelta(hours=interval)
     })
+    autopost_scheduler.push(task.inserted_id, now_ekb() + timedelta(hours=interval))
+    autopost_scheduler.signal()
     
-    bot.send_message(message.chat.id, f"🔁 <b>Автопостинг включен!</b>\n\nПервый пост только что вышел. Следующие 2 поста выйдут автоматически с интервалом в <b>{interval} ч.</b>", parse_mode="HTML")
+    tg.send_message(message.chat.id, f"🔁 <b>Автопостинг включен!</b>\n\nПервый пост только что вышел. Следующие 2 поста выйдут автоматически с интервалом в <b>{interval} ч.</b>", parse_mode="HTML")
 
 def ask_for_new_post(message):
     markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
     markup.add("Да", "Нет")
-    bot.send_message(message.chat.id, "Хотите создать ещё одно объявление?", reply_markup=markup)
+    tg.send_message(message.chat.id, "Хотите создать ещё одно объявление?", reply_markup=markup)
     bot.register_next_step_handler(message, handle_new_post_choice)
 
+@wizard_step
 def handle_new_post_choice(message):
     if message.text.lower() == "да":
         # Перекидываем в самое начало воронки создания
         create_new_post_category(message)
     else:
-        bot.send_message(
+        tg.send_message(
             message.chat.id,
             "Спасибо за использование бота! 🙌\nЕсли хотите создать новое объявление, нажмите кнопку ниже.",
             reply_markup=get_main_keyboard()
         )
 
+# ==================== 🗑 ПАКЕТНОЕ УДАЛЕНИЕ ПОСТОВ ====================
+# Вместо delete_message на каждый текст и каждое фото альбома: id сообщений группируются по чату
+# и уходят пачками deleteMessages (до 100 штук за вызов), история помечается одним запросом.
+# Массовое удаление идет в фоновом потоке и обновляет одно сообщение с прогрессом.
+# Если пачка не прошла целиком (deleteMessages атомарен: одно «старое» сообщение валит все),
+# ее id удаляются по одному, и в истории помечаются только посты, чьи сообщения реально исчезли.
+DELETE_BATCH_SIZE = 100 # Лимит Bot API для deleteMessages
+DELETE_PROGRESS_INTERVAL = 2 # сек между правками сообщения с прогрессом
+posts_deletions_running = set() # чаты, из которых сейчас идет фоновое удаление
+posts_deletions_lock = threading.Lock()
+
+def delete_message_ids(chat_id, ids):
+    """Удаляет сообщения пачкой, при ошибке — по одному. Возвращает множество реально удаленных id"""
+    try:
+        tg.delete_messages(chat_id, ids) # Ненайденные сообщения Telegram просто пропускает
+        return set(ids)
+    except Exception as e:
+        print(f"⚠️ deleteMessages в {chat_id} ({len(ids)} шт.), удаляю по одному: {e}", flush=True)
+
+    removed = set()
+    for message_id in ids:
+        try:
+            tg.delete_message(chat_id, message_id)
+            removed.add(message_id)
+        except ApiTelegramException as e:
+            if "message to delete not found" in str(e.description): removed.add(message_id) # Уже удалено
+            else: print(f"⚠️ Не удалось удалить {message_id} в {chat_id}: {e}", flush=True)
+        except Exception as e:
+            print(f"⚠️ Не удалось удалить {message_id} в {chat_id}: {e}", flush=True)
+    return removed
+
+def delete_posts(posts, deleted_by, progress=None):
+    """Удаляет посты из чатов и помечает их в истории. progress(сделано, всего) зовется после каждой пачки.
+    Возвращает число постов, удаленных полностью (текст и все фото альбома)"""
+    by_chat = defaultdict(list)
+    for post in posts:
+        by_chat[post["chat_id"]].append(post["message_id"])
+        by_chat[post["chat_id"]].extend(post.get("media_message_ids") or [])
+
+    removed = defaultdict(set)
+    batches = [(chat_id, ids[i:i + DELETE_BATCH_SIZE]) for chat_id, ids in by_chat.items() for i in range(0, len(ids), DELETE_BATCH_SIZE)]
+    for done, (chat_id, ids) in enumerate(batches, 1):
+        removed[chat_id] |= delete_message_ids(chat_id, ids)
+        if progress: progress(done, len(batches))
+
+    deleted_ids = [
+        post["_id"] for post in posts
+        if removed[post["chat_id"]].issuperset([post["message_id"], *(post.get("media_message_ids") or [])])
+    ]
+    if deleted_ids:
+        ad_posts_collection.update_many({"_id": {"$in": deleted_ids}}, {"$set": {"deleted": True, "deleted_by": deleted_by}})
+    return len(deleted_ids)
+
+def start_posts_deletion(posts, deleted_by, chat_id, message_id, done_text):
+    """Фоновое удаление с прогрессом в сообщении message_id; done_text.format(count=...) — итог.
+    False — если из этого чата удаление уже идет (повторное нажатие кнопки)"""
+    with posts_deletions_lock:
+        if chat_id in posts_deletions_running: return False
+        posts_deletions_running.add(chat_id)
+
+    def report(done, total):
+        nonlocal last_report
+        if done < total and time.monotonic() - last_report < DELETE_PROGRESS_INTERVAL: return
+        last_report = time.monotonic()
+        try: tg.edit_message_text(f"⏳ Удаляю объявления... {done}/{total}", chat_id, message_id)
+        except ApiTelegramException: pass
+
+    def runner():
+        try:
+            count = delete_posts(posts, deleted_by, report)
+            text = done_text.format(count=count)
+            if count < len(posts):
+                text += f"\n⚠️ Не удалось удалить: <b>{len(posts) - count}</b> (нет прав или сообщение старше 48 ч)."
+            tg.edit_message_text(text, chat_id, message_id, parse_mode="HTML")
+        except Exception as e:
+            print(f"❌ Ошибка фонового удаления постов: {e}", flush=True)
+            try: tg.edit_message_text("❌ Произошла ошибка при удалении.", chat_id, message_id)
+            except Exception: pass
+        finally:
+            with posts_deletions_lock: posts_deletions_running.discard(chat_id)
+
+    last_report = time.monotonic()
+    try:
+        tg.edit_message_text(f"⏳ Удаляю объявления ({len(posts)} шт.)...", chat_id, message_id)
+        threading.Thread(target=runner, daemon=True).start()
+    except Exception:
+        with posts_deletions_lock: posts_deletions_running.discard(chat_id)
+        raise
+    return True
+# =============================================================
+
 # ==================== УДАЛЕНИЕ ОБЪЯВЛЕНИЙ ПОЛЬЗОВАТЕЛЕМ ====================
 
 @bot.message_handler(func=lambda message: message.text == "Удалить объявление")
@@ -1601,7 +3031,7 @@ def handle_user_delete_ad(message):
     posts = list(ad_posts_collection.find({"user_id": user_id, "deleted": False}).sort("time", pymongo.DESCENDING).limit(15))
     
     if not posts:
-        bot.send_message(message.chat.id, "🤷‍♂️ У вас нет активных объявлений для удаления.")
+        tg.send_message(message.chat.id, "🤷‍♂️ У вас нет активных объявлений для удаления.")
         return
 
     markup = types.InlineKeyboardMarkup(row_width=1)
@@ -1610,45 +3040,33 @@ def handle_user_delete_ad(message):
         btn_text = f"❌ {post.get('network', 'Сеть')} | {post.get('city', 'Город')} | {date_str}"
         markup.add(types.InlineKeyboardButton(btn_text, callback_data=f"user_del_{post['_id']}"))
         
-    bot.send_message(
+    tg.send_message(
         message.chat.id, 
         "🗑 <b>Выберите объявление для удаления:</b>\n\n<i>Показаны ваши последние активные публикации.</i>", 
         reply_markup=markup, 
         parse_mode="HTML"
     )
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("user_del_"))
-def process_user_delete_ad(call):
-    post_id = call.data.replace("user_del_", "")
-    
+@callback_route("user_del_", args=(ObjectId,))
+def process_user_delete_ad(call, post_id):
     try:
         # Ищем пост и убеждаемся, что он принадлежит этому юзеру
-        post = ad_posts_collection.find_one({"_id": ObjectId(post_id), "user_id": call.from_user.id})
+        post = ad_posts_collection.find_one({"_id": post_id, "user_id": call.from_user.id})
         
         if not post or post.get("deleted"):
-            bot.answer_callback_query(call.id, "❌ Объявление не найдено или уже было удалено.", show_alert=True)
+            tg.answer_callback_query(call.id, "❌ Объявление не найдено или уже было удалено.", show_alert=True)
             return
 
-        # 1. Удаляем из Telegram-канала/чата текст
-        try:
-            bot.delete_message(post["chat_id"], post["message_id"])
-        except telebot.apihelper.ApiTelegramException as e:
-            pass
-
-        # 🧹 НОВОЕ: Удаляем привязанный альбом (если есть)
-        if post.get("media_message_ids"):
-            for m_id in post["media_message_ids"]:
-                try: bot.delete_message(post["chat_id"], m_id)
-                except: pass
-
-        # 2. Помечаем как удаленное в MongoDB
-        ad_posts_collection.update_one({"_id": ObjectId(post_id)}, {"$set": {"deleted": True, "deleted_by": "Юзер"}})
+        # Текст и альбом — одним deleteMessages, затем пометка в MongoDB
+        if not delete_posts([post], "Юзер"):
+            tg.answer_callback_query(call.id, "❌ Не удалось удалить: нет прав или сообщение старше 48 ч.", show_alert=True)
+            return
         
-        bot.answer_callback_query(call.id, "✅ Объявление успешно удалено!")
-        bot.edit_message_text("✅ <b>Объявление удалено.</b>", call.message.chat.id, call.message.message_id, parse_mode="HTML")
+        tg.answer_callback_query(call.id, "✅ Объявление успешно удалено!")
+        tg.edit_message_text("✅ <b>Объявление удалено.</b>", call.message.chat.id, call.message.message_id, parse_mode="HTML")
 
     except Exception as e:
-        bot.answer_callback_query(call.id, "❌ Произошла ошибка при удалении.")
+        tg.answer_callback_query(call.id, "❌ Произошла ошибка при удалении.")
         print(f"Ошибка удаления юзером: {e}")
 
 @bot.message_handler(func=lambda message: message.text == "Удалить все объявления")
@@ -1659,7 +3077,7 @@ def handle_user_delete_all_ads(message):
     posts = list(ad_posts_collection.find({"user_id": user_id, "deleted": False}))
     
     if not posts:
-        bot.send_message(message.chat.id, "🤷‍♂️ У вас нет активных объявлений.")
+        tg.send_message(message.chat.id, "🤷‍♂️ У вас нет активных объявлений.")
         return
 
     markup = types.InlineKeyboardMarkup()
@@ -1668,37 +3086,25 @@ def handle_user_delete_all_ads(message):
         types.InlineKeyboardButton("❌ Отмена", callback_data="cancel_del_all_user")
     )
     
-    bot.send_message(
+    tg.send_message(
         message.chat.id, 
         f"⚠️ Вы уверены, что хотите удалить <b>ВСЕ</b> ваши активные объявления ({len(posts)} шт.)?\nОни будут удалены из всех каналов.", 
         reply_markup=markup, 
         parse_mode="HTML"
     )
 
-@bot.callback_query_handler(func=lambda call: call.data in ["confirm_del_all_user", "cancel_del_all_user"])
+@callback_route("confirm_del_all_user", "cancel_del_all_user")
 def process_user_delete_all_ads(call):
     if call.data == "cancel_del_all_user":
-        bot.edit_message_text("❌ Массовое удаление отменено.", call.message.chat.id, call.message.message_id)
+        tg.edit_message_text("❌ Массовое удаление отменено.", call.message.chat.id, call.message.message_id)
         return
 
     user_id = call.from_user.id
-    posts = list(ad_posts_collection.find({"user_id": user_id, "deleted": False}))
-    
-    deleted_count = 0
-    for post in posts:
-        try: bot.delete_message(post["chat_id"], post["message_id"])
-        except: pass 
-        
-        # 🧹 НОВОЕ: Удаляем альбомы
-        if post.get("media_message_ids"):
-            for m_id in post["media_message_ids"]:
-                try: bot.delete_message(post["chat_id"], m_id)
-                except: pass
-        
-        ad_posts_collection.update_one({"_id": post["_id"]}, {"$set": {"deleted": True, "deleted_by": "Юзер"}})
-        deleted_count += 1
-        
-    bot.edit_message_text(f"✅ Успешно удалено <b>{deleted_count}</b> объявлений.", call.message.chat.id, call.message.message_id, parse_mode="HTML")
+    posts = list(ad_posts_collection.find({"user_id": user_id, "deleted": False}, {"chat_id": 1, "message_id": 1, "media_message_ids": 1}))
+    if not start_posts_deletion(posts, "Юзер", call.message.chat.id, call.message.message_id, "✅ Успешно удалено <b>{count}</b> объявлений."):
+        tg.answer_callback_query(call.id, "⏳ Удаление уже идет, дождитесь итога.")
+        return
+    tg.answer_callback_query(call.id)
 
 # ===========================================================================
 
@@ -1713,10 +3119,10 @@ def handle_my_autoposts(message):
     tasks = list(autopost_queue.find({"user_id": user_id}).sort("next_run", pymongo.ASCENDING))
     
     if not tasks:
-        bot.send_message(message.chat.id, "🤷‍♂️ У вас нет активных задач автопостинга.")
+        tg.send_message(message.chat.id, "🤷‍♂️ У вас нет активных задач автопостинга.")
         return
 
-    bot.send_message(message.chat.id, f"📋 <b>Ваши активные задачи ({len(tasks)}):</b>", parse_mode="HTML")
+    tg.send_message(message.chat.id, f"📋 <b>Ваши активные задачи ({len(tasks)}):</b>", parse_mode="HTML")
 
     for t in tasks:
         markup = types.InlineKeyboardMarkup()
@@ -1736,24 +3142,24 @@ def handle_my_autoposts(message):
         text_snippet = t.get('text', '')
         preview_text += f"<i>{escape_html(text_snippet[:150])}...</i>" if len(text_snippet) > 150 else f"<i>{escape_html(text_snippet)}</i>"
 
-        bot.send_message(message.chat.id, preview_text, parse_mode="HTML", reply_markup=markup)
+        tg.send_message(message.chat.id, preview_text, parse_mode="HTML", reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("cancel_ap_"))
-def handle_cancel_autopost(call):
-    task_id = call.data.replace("cancel_ap_", "")
-    
+@callback_route("cancel_ap_", args=(ObjectId,))
+def handle_cancel_autopost(call, task_id):
     try:
         # Удаляем задачу из базы, строго убедившись, что она принадлежит этому юзеру
-        result = autopost_queue.delete_one({"_id": ObjectId(task_id), "user_id": call.from_user.id})
+        result = autopost_queue.delete_one({"_id": task_id, "user_id": call.from_user.id})
         
         if result.deleted_count > 0:
-            bot.edit_message_text("✅ <b>Задача автопостинга отменена.</b>\nБольше посты по этому расписанию выходить не будут.", call.message.chat.id, call.message.message_id, parse_mode="HTML")
+            autopost_scheduler.discard(task_id)
+            autopost_scheduler.signal()
+            tg.edit_message_text("✅ <b>Задача автопостинга отменена.</b>\nБольше посты по этому расписанию выходить не будут.", call.message.chat.id, call.message.message_id, parse_mode="HTML")
         else:
-            bot.answer_callback_query(call.id, "❌ Задача не найдена или уже была завершена.", show_alert=True)
-            try: bot.delete_message(call.message.chat.id, call.message.message_id)
+            tg.answer_callback_query(call.id, "❌ Задача не найдена или уже была завершена.", show_alert=True)
+            try: tg.delete_message(call.message.chat.id, call.message.message_id)
             except: pass
     except Exception as e:
-        bot.answer_callback_query(call.id, "❌ Произошла ошибка.")
+        tg.answer_callback_query(call.id, "❌ Произошла ошибка.")
         print(f"Ошибка отмены автопоста: {e}")
 
 # ==================================================================
@@ -1772,25 +3178,24 @@ def handle_stats_button(message):
             response += "\n🗂️ <b>Детали по сетям и городам:</b>\n"
             for network, cities in stats["details"].items():
                 for city, data in cities.items():
-                    # Ищем подписку в Mongo
-                    sub = ad_subs_collection.find_one({"user_id": user_id, "network": {"$in": ["Все сети", network]}, "city": city})
-                    expire_str = f"⏳ до {sub['end_date'].strftime('%d.%m.%Y')}" if sub else "(Срок истек)"
+                    expire_str = f"⏳ до {data['end_date'].strftime('%d.%m.%Y')}"
 
                     response += (f"  └ 🧩 <b>{network}</b>, 📍<b>{city}</b> {expire_str}:\n"
                                  f"     • Опубликовано: <b>{data['published']}</b>, Осталось: <b>{data['remaining']}</b>\n")
 
-        bot.send_message(message.chat.id, response, parse_mode="HTML")
+        tg.send_message(message.chat.id, response, parse_mode="HTML")
     except Exception as e:
-        bot.send_message(message.chat.id, f"❌ Произошла ошибка при получении статистики: {e}")
+        tg.send_message(message.chat.id, f"❌ Произошла ошибка при получении статистики: {e}")
 
 # --- АДМИНСКОЕ УДАЛЕНИЕ ---
+@wizard_step
 def delete_user_posts_step(message):
     try:
         user_id = int(message.text)
         posts = list(ad_posts_collection.find({"user_id": user_id, "deleted": False}))
 
         if not posts:
-            bot.send_message(message.chat.id, "❌ У пользователя нет активных объявлений.")
+            tg.send_message(message.chat.id, "❌ У пользователя нет активных объявлений.")
             return
 
         preview = f"📋 Найдено <b>{len(posts)}</b> объявлений у ID <code>{user_id}</code>:\n\n"
@@ -1802,43 +3207,179 @@ def delete_user_posts_step(message):
         markup.add(types.InlineKeyboardButton("✅ Удалить все", callback_data=f"confirm_delete_{user_id}"))
         markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel_delete"))
 
-        bot.send_message(message.chat.id, preview, reply_markup=markup, parse_mode="HTML")
+        tg.send_message(message.chat.id, preview, reply_markup=markup, parse_mode="HTML")
 
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Введите корректный числовой ID.")
+        tg.send_message(message.chat.id, "❌ Введите корректный числовой ID.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_delete_") or call.data == "cancel_delete")
-def handle_delete_confirmation(call):
+@callback_route("confirm_delete_", "cancel_delete", args=(int,))
+def handle_delete_confirmation(call, user_id=None):
     if call.data == "cancel_delete":
-        bot.edit_message_text("❌ Удаление отменено.", call.message.chat.id, call.message.message_id)
+        tg.edit_message_text("❌ Удаление отменено.", call.message.chat.id, call.message.message_id)
         return
 
-    user_id = int(call.data.split("_")[-1])
-    posts = list(ad_posts_collection.find({"user_id": user_id, "deleted": False}))
-    deleted = 0
-
-    for post in posts:
+    posts = list(ad_posts_collection.find({"user_id": user_id, "deleted": False}, {"chat_id": 1, "message_id": 1, "media_message_ids": 1}))
+    if not start_posts_deletion(posts, "Админ", call.message.chat.id, call.message.message_id,
+                                f"✅ Удалено {{count}} объявлений пользователя ID: <code>{user_id}</code>."):
+        tg.answer_callback_query(call.id, "⏳ Удаление уже идет, дождитесь итога.")
+        return
+    tg.answer_callback_query(call.id)
+
+# ==================== 📥 ОЧЕРЕДЬ ВХОДЯЩИХ АПДЕЙТОВ ====================
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 2000))
+
+def get_update_owner_id(raw):
+    """Ключ упорядочивания апдейта: ID отправителя (или чата), иначе сам update_id"""
+    for kind, obj in raw.items():
+        if kind == "update_id" or not isinstance(obj, dict): continue
+        sender = obj.get("from") or obj.get("chat") or {}
+        if sender.get("id") is not None:
+            return sender["id"]
+    return raw.get("update_id", 0)
+
+class UpdateDispatcher:
+    """Пул воркеров: апдейты одного юзера идут строго по порядку, разных юзеров — параллельно.
+
+    Каждый воркер владеет своей ограниченной очередью (шардом), юзер всегда попадает
+    в один и тот же шард, поэтому его next_step-цепочка не перемешивается.
+    """
+    def __init__(self, workers, queue_size):
+        per_shard = max(1, queue_size // workers)
+        self.shards = [queue.Queue(maxsize=per_shard) for _ in range(workers)]
+        for shard in self.shards:
+            threading.Thread(target=self._worker, args=(shard,), daemon=True).start()
+
+    def submit(self, raw):
+        """Кладет сырой апдейт в очередь. False — если шард переполнен"""
+        shard = self.shards[hash(get_update_owner_id(raw)) % len(self.shards)]
         try:
-            bot.delete_message(post["chat_id"], post["message_id"])
-            deleted += 1
-        except: pass
+            shard.put_nowait(raw)
+        except queue.Full:
+            inc_metric("updates_overflow")
+            return False
+        inc_metric("updates_accepted")
+        return True
 
-        # 🧹 НОВОЕ: Удаляем альбомы
-        if post.get("media_message_ids"):
-            for m_id in post["media_message_ids"]:
-                try: bot.delete_message(post["chat_id"], m_id)
-                except: pass
+    def depth(self):
+        return sum(shard.qsize() for shard in self.shards)
 
-        ad_posts_collection.update_one({"_id": post["_id"]}, {"$set": {"deleted": True, "deleted_by": "Админ"}})
+    def _worker(self, shard):
+        while True:
+            raw = shard.get()
+            try:
+                bot.process_new_updates([telebot.types.Update.de_json(raw)])
+                inc_metric("updates_processed")
+            except Exception as e:
+                inc_metric("updates_failed")
+                print(f"⚠️ Ошибка обработки апдейта {raw.get('update_id')}: {e}", flush=True)
+            finally:
+                shard.task_done()
+            # Профиль освежаем уже после обработки: сбой кэша не должен терять апдейт
+            try:
+                for kind, obj in raw.items():
+                    if isinstance(obj, dict) and obj.get("from"): user_profiles.observe(obj["from"])
+            except Exception as e:
+                print(f"⚠️ Не удалось обновить профиль из апдейта {raw.get('update_id')}: {e}", flush=True)
+
+update_dispatcher = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+metrics_gauges["update_queue_depth"] = update_dispatcher.depth
+
+class RecentIdCache:
+    """Набор недавно виденных ID с ограничением по размеру и времени жизни (O(1) на проверку)"""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._seen = OrderedDict() # key -> время первого появления, самые старые в начале
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        """True, если ключ уже встречался за последние ttl секунд. Иначе запоминает его"""
+        now = time.monotonic()
+        with self._lock:
+            while self._seen:
+                oldest_ts = next(iter(self._seen.values()))
+                if now - oldest_ts < self.ttl and len(self._seen) < self.maxsize: break
+                self._seen.popitem(last=False)
+            if key in self._seen:
+                return True
+            self._seen[key] = now
+            return False
+
+    def discard(self, key):
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+# ==================== 🚧 ПРЕДФИЛЬТР АПДЕЙТОВ ====================
+# Бот сидит в сотнях сетевых чатов, но реагирует почти только на ЛС. Решаем по сырому JSON,
+# не собирая объекты телебота, нужен ли вообще этот апдейт.
+HANDLED_UPDATE_KINDS = ("message", "callback_query", "pre_checkout_query")
+
+def get_prefilter_drop_reason(raw):
+    """Причина отбросить апдейт до десериализации или None, если его надо обработать"""
+    kind = next((k for k in HANDLED_UPDATE_KINDS if k in raw), None)
+    if kind is None:
+        return "kind" # edited_message, channel_post, my_chat_member и т.п. — хендлеров нет
+    if kind != "message":
+        return None   # Кнопки и оплаты обрабатываем в любом чате
+
+    message = raw["message"]
+    chat = message.get("chat") or {}
+    chat_type = chat.get("type")
+    if chat_type == "private":
+        return None
+    if chat_type == "channel":
+        return "channel"
+    # Группы: админский чат (там идут админские next_step-диалоги) и команды (/start, /admin)
+    if chat.get("id") == ADMIN_CHAT_ID:
+        return None
+    if (message.get("text") or "").startswith("/"):
+        return None
+    return "group"
 
-    bot.edit_message_text(f"✅ Удалено {deleted} объявлений пользователя ID: <code>{user_id}</code>.", call.message.chat.id, call.message.message_id, parse_mode="HTML")
+# Telegram повторяет доставку, пока не получит 200 — гасим повторы по update_id
+update_dedup = RecentIdCache(maxsize=int(os.getenv("UPDATE_DEDUP_SIZE", 10000)), ttl=int(os.getenv("UPDATE_DEDUP_TTL", 600)))
+metrics_gauges["update_dedup_size"] = update_dedup.__len__
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    update = telebot.types.Update.de_json(request.stream.read().decode('utf-8'))
-    bot.process_new_updates([update])
+    """Принимает апдейт и сразу отвечает Telegram, обработка идет в UpdateDispatcher"""
+    try:
+        raw = json.loads(request.stream.read().decode('utf-8'))
+    except ValueError:
+        raw = None
+    if not isinstance(raw, dict):
+        inc_metric("updates_dropped")
+        return 'ok', 200
+
+    drop_reason = get_prefilter_drop_reason(raw)
+    if drop_reason:
+        inc_metric(f"prefilter_dropped_{drop_reason}")
+        return 'ok', 200
+
+    update_id = raw.get("update_id")
+    if update_id is not None:
+        if update_dedup.seen(update_id):
+            inc_metric("dedup_hits")
+            return 'ok', 200
+        inc_metric("dedup_misses")
+
+    if not update_dispatcher.submit(raw):
+        # Очередь забита — пусть Telegram доставит апдейт повторно чуть позже (и не считаем его дублем)
+        if update_id is not None: update_dedup.discard(update_id)
+        return 'busy', 503
     return 'ok', 200
 
+@app.route('/metrics')
+def metrics():
+    token = request.headers.get("X-Metrics-Token", "")
+    if not METRICS_TOKEN or not hmac.compare_digest(token, METRICS_TOKEN):
+        return 'not found', 404
+    return jsonify(get_metrics_snapshot())
+
 @app.route('/')
 def index():
     return '✅ Бот запущен и работает!'
@@ -1859,7 +3400,7 @@ def crypto_webhook():
         if data and data.get("update_type") == "invoice_paid":
             # Достаем наш спрятанный payload (он выглядит как payload___user_id)
             invoice_payload = data["payload"]["payload"] 
-            amount_rub = data["payload"]["amount"]
+            amount_rub = float(data["payload"]["amount"])
             
             # Разделяем строку на оригинальный payload и ID юзера
             parts = invoice_payload.split("___")
@@ -1868,66 +3409,26 @@ def crypto_webhook():
             
             original_payload = parts[0]
             user_id = int(parts[1])
-            
-            # === ПОВТОРЯЕМ ЛОГИКУ ВЫДАЧИ ПРАВ ИЗ successful_payment ===
-            has_pin = "_pin" in original_payload 
-            is_vip = "_vip" in original_payload
-           
-            clean_payload = original_payload.replace("ad_access_vip_", "").replace("ad_access_", "").replace("_pin", "")
-            p_parts = clean_payload.split('_')
-            
-            if p_parts[0] == "discount":
-                days = int(p_parts[1])
-                net_key = p_parts[2]
-                city = p_parts[3]
-                promo_code = p_parts[4]
-                promocodes_collection.update_one({"_id": promo_code}, {"$inc": {"used_count": 1}})
-            else:
-                days = int(p_parts[0])
-                net_key = p_parts[1]
-                city = p_parts[2]
-
-            names = {"mk": "Мужской Клуб", "parni": "ПАРНИ 18+", "ns": "НС", "rainbow": "Радуга", "gayznak": "Гей Знакомства", "all": "Все сети"}
-            network = names.get(net_key, net_key)
-
-            end_date = now_ekb() + timedelta(days=days)
-
-            # 1. Записываем доступ в базу
-            ad_subs_collection.insert_one({
-                "user_id": user_id,
-                "network": network,
-                "city": city,
-                "end_date": end_date,
-                "purchase_date": now_ekb(),
-                "has_pin": has_pin,
-                "can_post_links": is_vip, 
-                "notified_72h": True if days <= 3 else False,
-                "notified_24h": True if days <= 1 else False,
-                "notified_3h": False
-            })
-            
-            # 2. Очищаем корзину
-            db['users'].update_one({"_id": user_id}, {"$unset": {"temp_ad_type": ""}})
-            
-            # 3. Пишем в бухгалтерию (чтобы видеть доходы в крипте)
-            db['daily_revenue'].insert_one({
-                "type": "ads_crypto", 
-                "amount": float(amount_rub), 
-                "timestamp": time.time(), 
-                "date": now_ekb().strftime("%d.%m.%Y")
-            })
-
-            # 4. Уведомление админу
-            try: bot.send_message(ADMIN_CHAT_ID, f"🟢 <b>КРИПТО-ОПЛАТА!</b>\nЮзер: <code>{user_id}</code>\nСеть: <b>{network}</b>\nГород: <b>{city}</b>\nСрок: <b>{days}</b> дн.", parse_mode="HTML")
-            except: pass
-
-            # 5. Сообщение счастливому рекламодателю
-            try: bot.send_message(user_id, f"✅ <b>Крипто-оплата успешно получена!</b>\n\nДоступ к сети <b>{network}</b> ({city}) открыт на {days} дней.\nЖмите кнопку ниже, чтобы разместить пост!", parse_mode="HTML", reply_markup=get_main_keyboard())
-            except: pass
-
+            invoice_id = data["payload"].get("invoice_id") or invoice_payload
+        else:
+            return 'ok', 200
     except Exception as e:
+        # Битый запрос повторная доставка не исправит
         print(f"Ошибка Webhook CryptoBot: {e}")
+        return 'ok', 200
 
+    # Только фиксируем оплату и сразу отвечаем: выдачу делает воркер платежей.
+    # Повторная доставка того же счета упрется в уникальный _id и будет проигнорирована.
+    try:
+        record_payment_event(f"crypto:{invoice_id}", "crypto", user_id, original_payload, "ads_crypto", amount_rub)
+    except Exception as e:
+        # Оплата не записана — 5xx, чтобы CryptoBot доставил ее еще раз
+        inc_metric("payments_record_errors")
+        print(f"❌ Оплата CryptoBot {invoice_id} не записана в журнал: {e}", flush=True)
+        return 'journal error', 500
+
+    try: crypto_invoices_collection.delete_many({"payload": invoice_payload}) # Оплаченный счет больше не выдаем
+    except PyMongoError as e: print(f"⚠️ Кэш счетов CryptoBot не очищен: {e}", flush=True)
     return 'ok', 200
 
 def is_user_paid(user_id, network, city):
@@ -1950,9 +3451,161 @@ def is_user_paid(user_id, network, city):
         
     return False
 
+# ==================== 💸 ЖУРНАЛ ПЛАТЕЖЕЙ ====================
+# Любая оплата (Stars, CryptoBot, баланс/очки рулетки) сначала пишется в payment_events с
+# уникальным _id (crypto:<invoice_id>, stars:<charge_id>, eco:<chat>:<msg>), повторные доставки
+# отсекаются на вставке. Выдачу доступа делает лидер-воркер через единый grant_ad_access:
+# подписка помечается payment_id (уникальный индекс), поэтому повтор после сбоя ничего не удвоит.
+# Рулетка: резерв события хранит всё для выдачи, а списание атомарно кладет _id события в
+# paid_users.ad_charges. Если процесс упал между списанием и записью события, лидер по этому
+# следу либо доводит резерв до выдачи, либо (денег не брали) удаляет его.
+PAYMENT_POLL_SECONDS = 5
+ECO_RESERVATION_MINUTES = 5 # Резерв старше — считаем брошенным
+PAYMENT_BATCH_SIZE = 50
+PAYMENT_MAX_ATTEMPTS = 5
+PAYMENT_SOURCES = { # источник -> (заголовок для админа, первая строка для юзера)
+    "stars": ("💰 <b>Новая продажа!</b>", "✅ <b>Оплата успешно получена!</b>"),
+    "crypto": ("🟢 <b>КРИПТО-ОПЛАТА!</b>", "✅ <b>Крипто-оплата успешно получена!</b>"),
+    "eco": ("🎰 <b>ОПЛАТА ИЗ РУЛЕТКИ!</b>", "🎉 <b>Оплата успешно прошла!</b>"),
+}
+payment_events_collection = db['payment_events']
+payments_wake = None # Event цикла выдачи (есть только у процесса-лидера)
+
+def record_payment_event(event_id, source, user_id, payload, revenue_type, revenue_amount, note=None):
+    """Фиксирует оплату в журнале. False — это событие уже было записано"""
+    event = {
+        "source": source,
+        "user_id": user_id,
+        "payload": payload,
+        "revenue_type": revenue_type,
+        "revenue_amount": revenue_amount,
+        "note": note,
+        "status": "pending",
+        "attempts": 0,
+        "created_at": now_utc()
+    }
+    if source == "eco":
+        # Для рулетки _id уже занят резервом (status "reserved") — переводим его в очередь
+        payment_events_collection.update_one({"_id": event_id}, {"$set": event})
+    else:
+        try:
+            payment_events_collection.insert_one({"_id": event_id, **event})
+        except DuplicateKeyError:
+            inc_metric("payment_duplicates")
+            return False
+    inc_metric(f"payments_recorded_{source}")
+    if payments_wake: payments_wake.set()
+    return True
+
+def parse_ad_payload(payload):
+    """ad_access[_vip]_[discount_]<дни>_<сеть>_<город>[_<промо>][_pin] -> словарь параметров"""
+    clean_payload = payload.replace("ad_access_vip_", "").replace("ad_access_", "").replace("_pin", "")
+    parts = clean_payload.split('_')
+    grant = {"has_pin": "_pin" in payload, "is_vip": payload.startswith("ad_access_vip_"), "promo_code": None}
+    # Первый элемент — либо "discount", либо количество дней
+    if parts[0] == "discount":
+        grant.update(days=int(parts[1]), net_key=parts[2], city=parts[3], promo_code=parts[4])
+    else:
+        grant.update(days=int(parts[0]), net_key=parts[1], city=parts[2])
+    # 💎 ПЕРЕВОДЧИК: Возвращаем красивое имя перед записью в базу!
+    grant["network"] = NETWORK_NAMES.get(grant["net_key"], grant["net_key"])
+    return grant
+
+def grant_ad_access(user_id, payload, payment_id):
+    """Единая выдача доступа по оплате. Идемпотентна по payment_id"""
+    grant = parse_ad_payload(payload)
+    days = grant["days"]
+    try:
+        insert_subscription({
+            "user_id": user_id,
+            "network": grant["network"],
+            "city": grant["city"],
+            "end_date": now_ekb() + timedelta(days=days),
+            "purchase_date": now_ekb(),
+            "has_pin": grant["has_pin"],
+            "can_post_links": grant["is_vip"], # 👈 Автоматически разрешаем ссылки для VIP!
+            "notified_72h": True if days <= 3 else False,
+            "notified_24h": True if days <= 1 else False,
+            "notified_3h": False,
+            "payment_id": payment_id
+        })
+    except DuplicateKeyError:
+        return grant # Уже выдано в прошлой попытке — промокод тоже уже учтен
+    if grant["promo_code"]:
+        promocodes_collection.update_one({"_id": grant["promo_code"]}, {"$inc": {"used_count": 1}})
+    # Сбрасываем временный статус, чтобы следующая покупка не была с наценкой
+    db['users'].update_one({"_id": user_id}, {"$unset": {"temp_ad_type": ""}})
+    return grant
+
+def fulfil_payment(event):
+    """Выдача + бухгалтерия по одному событию журнала; возвращает строку для сводки админу"""
+    grant = grant_ad_access(event["user_id"], event["payload"], event["_id"])
+    # Бухгалтерия тоже по payment_id: повтор не задвоит доход
+    db['daily_revenue'].update_one({"payment_id": event["_id"]}, {"$setOnInsert": {
+        "type": event["revenue_type"],
+        "amount": event["revenue_amount"],
+        "timestamp": time.time(),
+        "date": now_ekb().strftime("%d.%m.%Y")
+    }}, upsert=True)
+
+    admin_title, user_title = PAYMENT_SOURCES.get(event["source"], PAYMENT_SOURCES["stars"])
+    note = f"{event['note']}\n" if event.get("note") else ""
+    try: tg.send_message(event["user_id"], f"{user_title}\n\n{note}Доступ к сети <b>{grant['network']}</b> ({grant['city']}) открыт на {grant['days']} дней.\nЖмите кнопку ниже, чтобы разместить пост!", parse_mode="HTML", reply_markup=get_main_keyboard())
+    except: pass
+    return f"{admin_title} Юзер: <code>{event['user_id']}</code> | <b>{grant['network']}</b> / <b>{grant['city']}</b> | {grant['days']} дн. | {event['revenue_type']}: {event['revenue_amount']}"
+
+def reclaim_eco_reservations():
+    """Разбирает брошенные резервы рулетки: списание было — в очередь на выдачу, не было — удаляем"""
+    stale = payment_events_collection.find(
+        {"status": "reserved", "created_at": {"$lt": now_utc() - timedelta(minutes=ECO_RESERVATION_MINUTES)}}
+    ).limit(PAYMENT_BATCH_SIZE)
+    for event in stale:
+        charged = db['paid_users'].find_one({"uid": event.get("user_id"), "ad_charges": event["_id"]}, {"_id": 1})
+        if charged and event.get("payload"):
+            payment_events_collection.update_one({"_id": event["_id"], "status": "reserved"}, {"$set": {"status": "pending"}})
+            db['paid_users'].update_one({"_id": charged["_id"]}, {"$pull": {"ad_charges": event["_id"]}})
+            inc_metric("payments_reclaimed")
+        else:
+            payment_events_collection.delete_one({"_id": event["_id"], "status": "reserved"})
+
+def fulfil_payments():
+    """Фоновая задача (один проход): выдает доступ по записанным оплатам, сводка админу одним сообщением"""
+    reclaim_eco_reservations()
+    # Зависшие в обработке (процесс умер посреди выдачи) возвращаем в очередь — выдача идемпотентна
+    payment_events_collection.update_many(
+        {"status": "processing", "claimed_at": {"$lt": now_utc() - timedelta(minutes=5)}},
+        {"$set": {"status": "pending"}}
+    )
+    admin_lines = []
+    for _ in range(PAYMENT_BATCH_SIZE):
+        event = payment_events_collection.find_one_and_update(
+            {"status": "pending"},
+            {"$set": {"status": "processing", "claimed_at": now_utc()}, "$inc": {"attempts": 1}},
+            sort=[("created_at", 1)],
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if not event: break
+        try:
+            admin_lines.append(fulfil_payment(event))
+            payment_events_collection.update_one({"_id": event["_id"]}, {"$set": {"status": "done", "done_at": now_utc()}})
+            inc_metric("payments_fulfilled")
+        except Exception as e:
+            failed = event["attempts"] >= PAYMENT_MAX_ATTEMPTS
+            payment_events_collection.update_one({"_id": event["_id"]}, {"$set": {"status": "failed" if failed else "pending", "error": str(e)}})
+            inc_metric("payments_errors")
+            if failed: admin_lines.append(f"❌ <b>Оплата не выдана</b> <code>{event['_id']}</code>: {escape_html(str(e))}")
+
+    if admin_lines:
+        for chunk in pack_message_chunks(["\n".join(admin_lines)]):
+            try: tg.send_message(ADMIN_CHAT_ID, chunk, parse_mode="HTML")
+            except Exception as e: print(f"⚠️ Сводка оплат админу не отправлена: {e}", flush=True)
+    # Полная пачка — сразу следующий проход
+    return 0 if len(admin_lines) >= PAYMENT_BATCH_SIZE else PAYMENT_POLL_SECONDS
+# =============================================================
+
 @bot.pre_checkout_query_handler(func=lambda query: query.invoice_payload.startswith("ad_access_"))
 def checkout_process(pre_checkout_query):
-    bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+    tg.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
 @bot.message_handler(content_types=['successful_payment'])
 def successful_payment(message):
@@ -1962,173 +3615,61 @@ def successful_payment(message):
     amount = message.successful_payment.total_amount
 
     if payload.startswith("ad_access_"):
-        # 👇 НОВАЯ СТРОЧКА (Пишем в копилку) 👇
-        db['daily_revenue'].insert_one({"type": "ads", "amount": amount, "timestamp": time.time(), "date": now_ekb().strftime("%d.%m.%Y")})
-
-        has_pin = "_pin" in payload 
-        is_vip = "_vip" in payload # Проверяем VIP
-        
-        # Очищаем строку от всех префиксов и суффиксов
-        clean_payload = payload.replace("ad_access_vip_", "").replace("ad_access_", "").replace("_pin", "")
-        parts = clean_payload.split('_')
-        
-        # Теперь первый элемент (parts[0]) всегда либо "discount", либо количество дней
-        if parts[0] == "discount":
-            days = int(parts[1])
-            net_key = parts[2]
-            city = parts[3]
-            promo_code = parts[4]
-            promocodes_collection.update_one({"_id": promo_code}, {"$inc": {"used_count": 1}})
-        else:
-            days = int(parts[0])
-            net_key = parts[1]
-            city = parts[2]
-
-        # 💎 ПЕРЕВОДЧИК: Возвращаем красивое имя перед записью в базу!
-        names = {"mk": "Мужской Клуб", "parni": "ПАРНИ 18+", "ns": "НС", "rainbow": "Радуга", "gayznak": "Гей Знакомства", "all": "Все сети"}
-        network = names.get(net_key, net_key)
-
-        end_date = now_ekb() + timedelta(days=days)
-
-        # Проверяем, была ли это VIP-оплата
-        is_vip = "_vip_" in payload
-
-        # 💥 ЗАПИСЬ В БАЗУ ДАННЫХ
-        ad_subs_collection.insert_one({
-            "user_id": user_id,
-            "network": network,
-            "city": city,
-            "end_date": end_date,
-            "purchase_date": now_ekb(),
-            "has_pin": has_pin,
-            "can_post_links": is_vip, # 👈 Автоматически разрешаем ссылки для VIP!
-            "notified_72h": True if days <= 3 else False,
-            "notified_24h": True if days <= 1 else False,
-            "notified_3h": False
-        })
-        
-        # Сбрасываем временный статус, чтобы следующая покупка не была с наценкой
-        db['users'].update_one({"_id": user_id}, {"$unset": {"temp_ad_type": ""}})
-
-        # Уведомление админу
-        try:
-            bot.send_message(ADMIN_CHAT_ID, f"💰 **Новая продажа!**\nЮзер: <code>{user_id}</code>\nСеть: <b>{network}</b>\nГород: <b>{city}</b>\nСрок: <b>{days}</b> дн.", parse_mode="HTML")
-        except: pass
-
-        # Сообщение юзеру
-        try:
-            bot.send_message(user_id, f"✅ <b>Оплата успешно получена!</b>\n\nДоступ к сети <b>{network}</b> ({city}) открыт на {days} дней.\nЖмите кнопку ниже, чтобы разместить пост!", parse_mode="HTML", reply_markup=get_main_keyboard())
-        except: pass
+        # Telegram может повторить апдейт — charge_id делает запись идемпотентной
+        charge_id = message.successful_payment.telegram_payment_charge_id
+        record_payment_event(f"stars:{charge_id}", "stars", user_id, payload, "ads", amount)
 
 # ================= ПРОМОКОДЫ ДЛЯ РЕКЛАМЫ =================
-@bot.callback_query_handler(func=lambda call: call.data.startswith('ad_promo_'))
-def handle_ad_promo(call):
-    bot.answer_callback_query(call.id) # 🛑 Снимаем залипание!
-    
-    parts = call.data.split('_')
-    network = parts[2] # РОДНОЕ ПОЛНОЕ НАЗВАНИЕ
-    city = parts[3]
+@callback_route("ad_promo_", args=(str, str))
+def handle_ad_promo(call, network, city):
+    tg.answer_callback_query(call.id) # 🛑 Снимаем залипание!
     
-    msg = bot.send_message(call.message.chat.id, "👇 <b>Введите ваш промокод ответом на это сообщение:</b>", parse_mode="HTML")
+    msg = tg.send_message(call.message.chat.id, "👇 <b>Введите ваш промокод ответом на это сообщение:</b>", parse_mode="HTML")
     bot.register_next_step_handler(msg, process_ad_promo, network, city)
 
+@wizard_step
 def process_ad_promo(message, network, city):
     promo_text = message.text.strip().upper()
     promo_data = promocodes_collection.find_one({"_id": promo_text})
     
     if not promo_data or not promo_data.get("is_active"):
-        bot.send_message(message.chat.id, "❌ Промокод не найден или уже недействителен.")
+        tg.send_message(message.chat.id, "❌ Промокод не найден или уже недействителен.")
         return
         
     if promo_data["used_count"] >= promo_data.get("usage_limit", 1):
-        bot.send_message(message.chat.id, "❌ Лимит активаций этого промокода исчерпан.")
+        tg.send_message(message.chat.id, "❌ Лимит активаций этого промокода исчерпан.")
         return
         
     if promo_data.get("target") not in ["all", "ads"]:
-        bot.send_message(message.chat.id, "❌ Этот промокод нельзя применить к покупке рекламы.")
+        tg.send_message(message.chat.id, "❌ Этот промокод нельзя применить к покупке рекламы.")
         return
 
-    # Сохраняем введенный промокод временно в профиль юзера
-    db['users'].update_one({"_id": message.from_user.id}, {"$set": {"temp_promo": promo_text}}, upsert=True)
+    # Промокод едет внутри котировки — чекаут возьмет уже посчитанные суммы
+    quote = build_quote(message.from_user.id, network, city, promo_data=promo_data)
+    if not quote:
+        tg.send_message(message.chat.id, "❌ Ошибка: Город или сеть больше не существуют.")
+        return
 
-    discount_promo = promo_data["value"]
     markup = types.InlineKeyboardMarkup(row_width=1)
-    
-    # --- Достаем VIP статус для наценки ---
-    user_data = db['users'].find_one({"_id": message.from_user.id})
-    is_vip = user_data.get("temp_ad_type") == "vip" if user_data else False
-    markup_multiplier = 1.5 if is_vip else 1.0
-
-    discount_net = 0  # 👈 ДОБАВЛЯЕМ ПЕРЕМЕННУЮ ДЛЯ СКИДКИ ЗА ПАКЕТ СЕТЕЙ
-
-    if network == "all":
-        first_avail_net = list(all_cities[city].keys())[0]
-        chat_id = all_cities[city][first_avail_net][0]["chat_id"]
-        
-        active_subs_count = len(ad_subs_collection.distinct("network", {"user_id": message.from_user.id, "city": city, "end_date": {"$gt": now_ekb()}}))
-        buying_now = len([n for n, d in all_cities[city].items() if d]) - active_subs_count
-        
-        # 👇 ВОССТАНАВЛИВАЕМ РАСЧЕТ ПАКЕТНОЙ СКИДКИ 👇
-        total_nets = active_subs_count + buying_now
-        if total_nets == 3: discount_net = 10
-        elif total_nets == 4: discount_net = 20
-        elif total_nets >= 5: discount_net = 30
-    else:
-        chat_id = all_cities[city][network][0]["chat_id"]
-        buying_now = 1
-
-    for days in [1, 7, 15, 30]:
-        base_p = get_price_for_chat(chat_id, days)
-        if base_p:
-            base_p = int(base_p * markup_multiplier)
-            
-            # 👇 ТЕПЕРЬ СКИДКИ ПРИМЕНЯЮТСЯ КАСКАДОМ 👇
-            # 1. Пакетная скидка (Все сети)
-            price_with_net_discount = int((base_p * buying_now) * (1 - discount_net / 100))
-            
-            # 2. Скидка по промокоду
-            f_price = int(price_with_net_discount * (1 - discount_promo / 100))
+    add_quote_buttons(markup, quote, promo_data["value"])
             
-            pin_p = int(f_price * 1.2)
-            
-            btn_prefix = "🔥 VIP:" if is_vip else "💳"
-            
-            markup.row(
-                types.InlineKeyboardButton(f"{btn_prefix} {days} дн. (-{discount_promo}% за {f_price}⭐️)", callback_data=f"ad_pay_{days}_{network}_{city}"),
-                types.InlineKeyboardButton(f"📌 +Закреп ({pin_p}⭐️)", callback_data=f"ad_paypin_{days}_{network}_{city}")
-            )
-            
-    bot.send_message(message.chat.id, f"✅ <b>Промокод применен!</b> Выберите тариф:", reply_markup=markup, parse_mode="HTML")
+    tg.send_message(message.chat.id, f"✅ <b>Промокод применен!</b> Выберите тариф:", reply_markup=markup, parse_mode="HTML")
 
 # --- БЫСТРОЕ ПРОДЛЕНИЕ ИЗ УВЕДОМЛЕНИЙ ---
-@bot.callback_query_handler(func=lambda call: call.data.startswith("renew_"))
-def handle_renew_request(call):
-    parts = call.data.split('_')
-    net_key = parts[1]
-    city = parts[2]
+@callback_route("renew_", args=(str, str))
+def handle_renew_request(call, net_key, city):
+    network = NETWORK_NAMES.get(net_key, net_key)
 
-    names = {"mk": "Мужской Клуб", "parni": "ПАРНИ 18+", "ns": "НС", "rainbow": "Радуга", "gayznak": "Гей Знакомства"}
-    network = names.get(net_key, net_key)
-
-    try:
-        chat_id = all_cities[city][net_key][0]["chat_id"]
-    except KeyError:
-        bot.answer_callback_query(call.id, "❌ Ошибка: Город или сеть больше не существуют.")
+    quote = build_quote(call.from_user.id, net_key, city)
+    if not quote:
+        tg.answer_callback_query(call.id, "❌ Ошибка: Город или сеть больше не существуют.")
         return
 
+    # Актуальные цены из котировки — кнопки оплаты
     markup = types.InlineKeyboardMarkup(row_width=1)
+    add_quote_buttons(markup, quote)
 
-    # Достаем актуальные цены и генерируем кнопки оплаты
-    for days in [1, 7, 15, 30]:
-        base_price = get_price_for_chat(chat_id, days)
-        if base_price:
-            pin_price = int(base_price * 1.2)
-            markup.row(
-                types.InlineKeyboardButton(f"💳 {days} дн. ({base_price}⭐️)", callback_data=f"ad_pay_{days}_{net_key}_{city}"),
-                types.InlineKeyboardButton(f"📌 +Закреп ({pin_price}⭐️)", callback_data=f"ad_paypin_{days}_{net_key}_{city}")
-            )
-
-    bot.edit_message_text(
+    tg.edit_message_text(
         f"♻️ <b>Продление рекламы:</b> {network} ({city})\n\nВыберите новый тарифный план:",
         call.message.chat.id, 
         call.message.message_id, 
@@ -2136,86 +3677,42 @@ def handle_renew_request(call):
         parse_mode="HTML"
     )
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('ad_pay_') or call.data.startswith('ad_paypin_'))
-def handle_ad_checkout(call):
-    bot.answer_callback_query(call.id)
-    
+@callback_route("ad_pay_", "ad_paypin_", args=(str, int))
+def handle_ad_checkout(call, quote_id, days):
     is_pin = call.data.startswith('ad_paypin_')
-    parts = call.data.split('_')
-    
-    days = int(parts[2])
-    net_key = parts[3] 
-    city = parts[4]
-    
-    # --- VIP Наценка и Промо ---
-    user_data = db['users'].find_one({"_id": call.from_user.id})
-    is_vip = user_data.get("temp_ad_type") == "vip" if user_data else False
-    temp_promo = user_data.get("temp_promo") if user_data else None
 
-    if net_key == "all":
-        network = "Все сети"
-        # Для базовой цены берем первый доступный чат в этом городе
-        first_avail_net = list(all_cities[city].keys())[0]
-        chat_id = all_cities[city][first_avail_net][0]["chat_id"]
-        base_price = get_price_for_chat(chat_id, days)
-        
-        if is_vip:
-            base_price = int(base_price * 1.5)
-            
-        # Воспроизводим расчет скидки для "Всех сетей"
-        active_subs_count = len(ad_subs_collection.distinct("network", {"user_id": call.from_user.id, "city": city, "end_date": {"$gt": now_ekb()}}))
-        buying_now = len([n for n, d in all_cities[city].items() if d]) - active_subs_count
-        total_nets = active_subs_count + buying_now
-        
-        discount_net = 0
-        if total_nets == 3: discount_net = 10
-        elif total_nets == 4: discount_net = 20
-        elif total_nets >= 5: discount_net = 30
-        
-        final_price = int((base_price * buying_now) * (1 - discount_net / 100))
-        amount = int(final_price * 1.2) if is_pin else final_price
+    # Сумма — ровно та, что была показана на кнопке
+    quote = get_quote(quote_id, call.from_user.id)
+    tier = quote["tiers"].get(str(days)) if quote else None
+    if not tier:
+        tg.answer_callback_query(call.id, "⌛ Цены устарели. Откройте список тарифов заново.", show_alert=True)
+        return
+    tg.answer_callback_query(call.id)
 
-    else:
-        names = {"mk": "Мужской Клуб", "parni": "ПАРНИ 18+", "ns": "НС", "rainbow": "Радуга", "gayznak": "Гей Знакомства"}
-        network = names.get(net_key, net_key)
+    net_key, city, network = quote["net_key"], quote["city"], quote["network"]
+    amount = tier["pin_price"] if is_pin else tier["price"]
+    promo_code = quote.get("promo_code")
 
-        chat_id = all_cities[city][net_key][0]["chat_id"]
-        base_price = get_price_for_chat(chat_id, days)
-        
-        if is_vip: base_price = int(base_price * 1.5)
-        
-        amount = int(base_price * 1.2) if is_pin else base_price
-    
-    # 👇 ВОТ ЭТОТ БЛОК МЫ СЛУЧАЙНО ЗАТЕРЛИ ПРОШЛЫЙ РАЗ 👇
     # --- Вшиваем VIP метку в payload ---
-    payload_base = "ad_access_vip" if is_vip else "ad_access"
-    payload = f"{payload_base}_discount_{days}_{net_key}_{city}_{temp_promo}" if temp_promo else f"{payload_base}_{days}_{net_key}_{city}"
-    if is_pin: payload += "_pin"
+    payload = get_quote_payload(quote, days, is_pin)
     
     description_text = f"Сеть: {network}\nГород: {city}\nСрок: {days} дн."
-    
-    if temp_promo:
-        promo_data = promocodes_collection.find_one({"_id": temp_promo})
-        if promo_data:
-            discount = promo_data["value"]
-            amount = int(amount * (1 - discount / 100))
-            description_text += f"\n🎁 Промокод: {temp_promo} (-{discount}%)"
-            
-        db['users'].update_one({"_id": call.from_user.id}, {"$unset": {"temp_promo": ""}})
-    # 👆 КОНЕЦ ВОССТАНОВЛЕННОГО БЛОКА 👆
-
-    # 👇 ГЕНЕРИРУЕМ КРИПТО-ССЫЛКИ 👇
-    crypto_payload = f"{payload}___{call.from_user.id}"
-    url_usdt = get_crypto_pay_url(crypto_payload, amount, f"Реклама: {network} ({city})", asset="USDT")
-    url_ton = get_crypto_pay_url(crypto_payload, amount, f"Реклама: {network} ({city})", asset="TON")
+    if promo_code:
+        description_text += f"\n🎁 Промокод: {promo_code} (-{quote['promo_discount']}%)"
 
     markup = types.InlineKeyboardMarkup(row_width=1)
     markup.add(types.InlineKeyboardButton(text=f"⭐️ Оплатить {amount} Звезд", pay=True))
-    
-    if url_usdt:
-        markup.add(types.InlineKeyboardButton("🟢 Оплатить через USDT (CryptoBot)", url=url_usdt))
-    if url_ton:
-        markup.add(types.InlineKeyboardButton("💎 Оплатить через TON (CryptoBot)", url=url_ton))
+
+    # 👇 КРИПТО-ССЫЛКИ (сразу или по нажатию, см. CRYPTO_INVOICE_MODE) 👇
+    pin_flag = "1" if is_pin else "0"
+    if CRYPTO_INVOICE_MODE == "lazy":
+        for asset, label in CRYPTO_ASSETS.items():
+            markup.add(types.InlineKeyboardButton(label, callback_data=f"ad_crypto_{asset}_{pin_flag}_{quote_id}_{days}"))
+    else:
+        crypto_urls = get_cached_crypto_urls(f"{payload}___{call.from_user.id}", amount, f"Реклама: {network} ({city})", list(CRYPTO_ASSETS))
+        for asset, label in CRYPTO_ASSETS.items():
+            if crypto_urls.get(asset):
+                markup.add(types.InlineKeyboardButton(label, url=crypto_urls[asset]))
 
     # 👇 НОВАЯ КНОПКА 👇
     markup.add(types.InlineKeyboardButton("💳 Проблема с оплатой/Альтернатива", callback_data=f"ad_altpay_{amount}_{days}_{net_key}_{city}"))
@@ -2230,7 +3727,6 @@ def handle_ad_checkout(call):
     # Считаем стоимость тарифа во внутренних валютах
     cost_rub = int(amount * 1.8) # Курс: 1 звезда = 1.8₽
     cost_points = amount * 5    # Курс: 1 звезда = 5 очков
-    pin_flag = "1" if is_pin else "0"
     
     # 1. Кнопка оплаты РУБЛЯМИ (Кэшбэк из рулетки)
     if rub_balance >= cost_rub:
@@ -2247,7 +3743,7 @@ def handle_ad_checkout(call):
         markup.add(types.InlineKeyboardButton(f"🎰 Не хватает {missing_points} Очков (Играть)", url="https://t.me/FAQMKBOT"))
     # 👆 =================================== 👆
 
-    bot.send_invoice(
+    tg.send_invoice(
         call.message.chat.id, 
         title="Доступ + ЗАКРЕП 📌" if is_pin else "Доступ к публикации 📢", 
         description=description_text, 
@@ -2258,15 +3754,32 @@ def handle_ad_checkout(call):
         reply_markup=markup
     )
 
+@callback_route("ad_crypto_", args=(str, str, str, int))
+def handle_crypto_invoice(call, asset, pin_flag, quote_id, days):
+    """Ленивый режим: счет CryptoBot создается только по нажатию (и переиспользуется)"""
+    quote = get_quote(quote_id, call.from_user.id)
+    tier = quote["tiers"].get(str(days)) if quote else None
+    if not tier or asset not in CRYPTO_ASSETS:
+        tg.answer_callback_query(call.id, "⌛ Цены устарели. Откройте список тарифов заново.", show_alert=True)
+        return
+    tg.answer_callback_query(call.id, "⏳ Создаем счет...")
+
+    is_pin = pin_flag == "1"
+    amount = tier["pin_price"] if is_pin else tier["price"]
+    crypto_payload = f"{get_quote_payload(quote, days, is_pin)}___{call.from_user.id}"
+    url = get_cached_crypto_urls(crypto_payload, amount, f"Реклама: {quote['network']} ({quote['city']})", [asset]).get(asset)
+    if not url:
+        tg.send_message(call.message.chat.id, "❌ CryptoBot сейчас не отвечает. Попробуйте позже или выберите другой способ оплаты.")
+        return
+
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(CRYPTO_ASSETS[asset], url=url))
+    tg.send_message(call.message.chat.id, f"🧾 Счет на <b>{amount}⭐️</b> готов:", parse_mode="HTML", reply_markup=markup)
+
 # 👇 ВСТАВЛЯЕМ СЮДА 👇
-@bot.callback_query_handler(func=lambda call: call.data.startswith('ad_altpay_'))
-def handle_alternative_payment(call):
-    bot.answer_callback_query(call.id)
-    parts = call.data.split('_')
-    amount = int(parts[2])
-    days = parts[3]
-    net_key = parts[4]
-    city = parts[5]
+@callback_route("ad_altpay_", args=(int, int, str, str))
+def handle_alternative_payment(call, amount, days, net_key, city):
+    tg.answer_callback_query(call.id)
     
     names = {"mk": "Мужской Клуб", "parni": "ПАРНИ 18+", "ns": "НС", "rainbow": "Радуга", "gayznak": "Гей Знакомства", "all": "Все сети"}
     network = names.get(net_key, net_key)
@@ -2287,265 +3800,517 @@ def handle_alternative_payment(call):
     markup = types.InlineKeyboardMarkup(row_width=1)
     markup.add(types.InlineKeyboardButton("💬 Получить реквизиты в Поддержке", url="https://t.me/FAQMKBOT"))
     
-    try: bot.delete_message(call.message.chat.id, call.message.message_id)
+    try: tg.delete_message(call.message.chat.id, call.message.message_id)
     except: pass
-    bot.send_message(call.message.chat.id, text, parse_mode="HTML", reply_markup=markup)
+    tg.send_message(call.message.chat.id, text, parse_mode="HTML", reply_markup=markup)
 # 👆 КОНЕЦ ВСТАВКИ 👆
 
 # ==================== ОПЛАТА ИЗ ЭКОСИСТЕМЫ РУЛЕТКИ (₽ / Очки) ====================
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('ad_rubpay_') or call.data.startswith('ad_pointspay_'))
-def handle_ecosystem_payment(call):
-    bot.answer_callback_query(call.id)
+@callback_route("ad_rubpay_", "ad_pointspay_", args=(int, int, str, str, str))
+def handle_ecosystem_payment(call, cost, days, net_key, pin_flag, city):
+    tg.answer_callback_query(call.id)
     
     is_points = call.data.startswith('ad_pointspay_')
-    parts = call.data.split('_')
-    
-    cost = int(parts[2]) # Сюда прилетит либо сумма в ₽, либо в очках
-    days = int(parts[3])
-    net_key = parts[4]
-    is_pin = True if parts[5] == "1" else False
-    city = "_".join(parts[6:]) 
+    # cost — либо сумма в ₽, либо в очках
+    is_pin = pin_flag == "1"
     
     user_id = call.from_user.id
-    paid_user = db['paid_users'].find_one({"uid": user_id})
     
     # Настраиваем переменные в зависимости от типа валюты
     if is_points:
-        current_funds = paid_user.get("bounty_points", 0) if paid_user else 0
         update_field = "bounty_points"
         currency_name = "очков"
         revenue_type = "ads_points"
         equivalent_stars = cost // 5 # Для бухгалтерии
     else:
-        current_funds = paid_user.get("cashback_balance", 0) if paid_user else 0
         update_field = "cashback_balance"
         currency_name = "₽"
         revenue_type = "ads_rub_balance"
         equivalent_stars = int(cost / 1.8) # Возвращаем в звезды для бухгалтерии
 
-    # Проверка на случай, если баланс изменился пока висело меню
-    if current_funds < cost:
-        bot.send_message(call.message.chat.id, f"❌ Ошибка транзакции: Недостаточно {currency_name} на счету!")
-        return
-        
-    # 1. Списываем средства из БД Секретаря
-    db['paid_users'].update_one({"uid": user_id}, {"$inc": {update_field: -cost}})
-    
-    # 2. Пишем в бухгалтерию (в эквиваленте звезд, чтобы проще считать доходы)
-    db['daily_revenue'].insert_one({
-        "type": revenue_type, 
-        "amount": equivalent_stars, 
-        "timestamp": time.time(), 
-        "date": now_ekb().strftime("%d.%m.%Y")
-    })
-    
-    # 3. Выдаем рекламный доступ
-    names = {"mk": "Мужской Клуб", "parni": "ПАРНИ 18+", "ns": "НС", "rainbow": "Радуга", "gayznak": "Гей Знакомства", "all": "Все сети"}
-    network = names.get(net_key, net_key)
-    end_date = now_ekb() + timedelta(days=days)
-    
     user_data = db['users'].find_one({"_id": user_id})
     is_vip = user_data.get("temp_ad_type") == "vip" if user_data else False
+    payload = f"{'ad_access_vip' if is_vip else 'ad_access'}_{days}_{net_key}_{city}" + ("_pin" if is_pin else "")
 
-    ad_subs_collection.insert_one({
-        "user_id": user_id,
-        "network": network,
-        "city": city,
-        "end_date": end_date,
-        "purchase_date": now_ekb(),
-        "has_pin": is_pin,
-        "can_post_links": is_vip, 
-        "notified_72h": True if days <= 3 else False,
-        "notified_24h": True if days <= 1 else False,
-        "notified_3h": False
-    })
-    
-    db['users'].update_one({"_id": user_id}, {"$unset": {"temp_ad_type": ""}})
-    
-    try: bot.delete_message(call.message.chat.id, call.message.message_id)
-    except: pass
-    
-    bot.send_message(
-        user_id, 
-        f"🎉 <b>Оплата успешно прошла!</b>\n\nСписано: <b>{cost}{currency_name if currency_name == '₽' else ' ' + currency_name}</b>\nДоступ к <b>{network}</b> ({city}) открыт на {days} дней.\n\nЖмите кнопку ниже, чтобы разместить пост!", 
-        parse_mode="HTML", 
-        reply_markup=get_main_keyboard()
+    # Одно меню оплаты = одна покупка: повторное нажатие упрется в уникальный _id.
+    # Резерв сразу несет данные события — по ним лидер восстановит выдачу, если мы упадем после списания
+    event_id = f"eco:{call.message.chat.id}:{call.message.message_id}"
+    spent = f"{cost}{currency_name if currency_name == '₽' else ' ' + currency_name}"
+    try:
+        payment_events_collection.insert_one({
+            "_id": event_id, "status": "reserved", "source": "eco", "user_id": user_id, "payload": payload,
+            "revenue_type": revenue_type, "revenue_amount": equivalent_stars, "note": f"Списано: <b>{spent}</b>",
+            "attempts": 0, "created_at": now_utc()
+        })
+    except DuplicateKeyError:
+        tg.send_message(call.message.chat.id, "⏳ Эта оплата уже обрабатывается.")
+        return
+
+    # 1. Атомарно списываем средства из БД Секретаря (только если их хватает прямо сейчас) и оставляем след списания
+    charged = db['paid_users'].find_one_and_update(
+        {"uid": user_id, update_field: {"$gte": cost}},
+        {"$inc": {update_field: -cost}, "$push": {"ad_charges": event_id}}
     )
+    if not charged:
+        payment_events_collection.delete_one({"_id": event_id})
+        tg.send_message(call.message.chat.id, f"❌ Ошибка транзакции: Недостаточно {currency_name} на счету!")
+        return
+
+    # 2. Выдачу, бухгалтерию и уведомления делает воркер платежей; след списания больше не нужен
+    record_payment_event(event_id, "eco", user_id, payload, revenue_type, equivalent_stars, note=f"Списано: <b>{spent}</b>")
+    db['paid_users'].update_one({"_id": charged["_id"]}, {"$pull": {"ad_charges": event_id}})
     
-    try: bot.send_message(ADMIN_CHAT_ID, f"🎰 <b>ОПЛАТА ИЗ РУЛЕТКИ!</b>\nЮзер: <code>{user_id}</code> купил рекламу за {cost}{currency_name if currency_name == '₽' else ' ' + currency_name}.\nСеть: <b>{network} ({city})</b> на {days} дн.", parse_mode="HTML")
+    try: tg.delete_message(call.message.chat.id, call.message.message_id)
     except: pass
 
-@bot.callback_query_handler(func=lambda call: call.data == "insufficient_funds")
+@callback_route("insufficient_funds")
 def handle_insufficient_funds(call):
-    bot.answer_callback_query(call.id, "На вашем счету не хватает средств для оплаты этого тарифа! 😔 Поиграйте еще или пополните баланс.", show_alert=True)
+    tg.answer_callback_query(call.id, "На вашем счету не хватает средств для оплаты этого тарифа! 😔 Поиграйте еще или пополните баланс.", show_alert=True)
 
 # --- ФОНОВЫЕ ЗАДАЧИ ---
+# ⏰ Напоминания об окончании подписки. У каждой подписки есть next_notify_at — время ближайшего
+# неотправленного напоминания (индекс due_notifications). Воркер спит до самого раннего из них,
+# забирает созревшие пачкой через find_one_and_update и переводит на следующую стадию.
+NOTIFY_STAGES = [ # (часов до конца, флаг, текст)
+    (72, "notified_72h", "⏳ <b>Мягкое напоминание:</b>\nВаша подписка на <b>{network}</b> ({city}) истекает через 3 дня.\nПодготовьтесь к продлению, чтобы не терять клиентов!"),
+    (24, "notified_24h", "🚨 <b>Остались ровно 1 сутки!</b>\nВаш доступ к <b>{network}</b> ({city}) закончится через 24 часа!\n\nЖмите кнопку ниже, чтобы продлить доступ в пару кликов 👇"),
+    (3, "notified_3h", "🔥 <b>СГОРАЕТ ЧЕРЕЗ 3 ЧАСА!</b>\nДоступ к <b>{network}</b> ({city}) почти истек.\n\nПродлите сейчас, чтобы ваши посты не перестали публиковаться!"),
+]
+NOTIFY_LATE_GRACE = timedelta(hours=1) # Опоздавшее напоминание еще шлем, если просрочено не больше часа
+NOTIFY_CLAIM_MINUTES = 10              # Забранная подписка не берется повторно, пока идет отправка
+NOTIFY_BATCH_SIZE = 100
+notify_wake = None # Event цикла напоминаний (есть только у процесса-лидера)
+notify_backfill_done = False
+
+def get_next_notify_at(end_date, sub, now=None):
+    """Время ближайшего неотправленного напоминания (UTC) или None"""
+    end_utc = to_utc_naive(end_date)
+    now = now or now_utc()
+    for hours, flag, _ in NOTIFY_STAGES:
+        if sub.get(flag): continue
+        due = end_utc - timedelta(hours=hours)
+        if due >= now - NOTIFY_LATE_GRACE: return due
+    return None
+
+def with_notify_schedule(sub):
+    """Проставляет next_notify_at в новую подписку перед вставкой"""
+    next_notify_at = get_next_notify_at(sub["end_date"], sub)
+    if next_notify_at: sub["next_notify_at"] = next_notify_at
+    return sub
+
+def insert_subscription(sub):
+    """Вставляет подписку с расписанием напоминаний; цикл будим уже после записи, иначе он ее не увидит"""
+    result = ad_subs_collection.insert_one(with_notify_schedule(sub))
+    if notify_wake: notify_wake.set()
+    return result
+
+def reschedule_notify(sub_id, end_date, sub):
+    """Пересчитывает next_notify_at после смены срока"""
+    next_notify_at = get_next_notify_at(end_date, sub)
+    update = {"$set": {"next_notify_at": next_notify_at}} if next_notify_at else {"$unset": {"next_notify_at": ""}}
+    ad_subs_collection.update_one({"_id": sub_id}, update)
+    if notify_wake: notify_wake.set()
+
+def backfill_notify_schedule():
+    """Разово: next_notify_at для подписок, созданных до появления этого поля"""
+    for sub in ad_subs_collection.find({"end_date": {"$gt": now_ekb()}, "next_notify_at": {"$exists": False}}):
+        next_notify_at = get_next_notify_at(sub["end_date"], sub)
+        if next_notify_at:
+            ad_subs_collection.update_one({"_id": sub["_id"]}, {"$set": {"next_notify_at": next_notify_at}})
+
 def check_expiring_subs():
-    """Фоновая задача: ищет подписки, истекающие через 72, 24 и 3 часа"""
+    """Фоновая задача (один проход): шлет созревшие напоминания и спит до следующего"""
+    global notify_backfill_done
+    if not notify_backfill_done:
+        backfill_notify_schedule()
+        notify_backfill_done = True
+
     reverse_names = {"Мужской Клуб": "mk", "ПАРНИ 18+": "parni", "НС": "ns", "Радуга": "rainbow", "Гей Знакомства": "gayznak"}
 
-    while True:
-        try:
-            now = now_ekb()
-            
-            # --- Функция генерации кнопки продления ---
-            def get_renew_markup(network_name, city):
-                net_key = reverse_names.get(network_name, "mk")
-                markup = types.InlineKeyboardMarkup()
-                markup.add(types.InlineKeyboardButton("♻️ Продлить подписку", callback_data=f"renew_{net_key}_{city}"))
-                return markup
-
-            # 1. Проверка за 72 часа (3 дня)
-            target_72 = now + timedelta(hours=72)
-            expiring_72 = ad_subs_collection.find({"end_date": {"$gte": target_72 - timedelta(hours=1), "$lte": target_72 + timedelta(hours=1)}, "notified_72h": {"$ne": True}})
-            for sub in expiring_72:
-                try:
-                    bot.send_message(sub['user_id'], f"⏳ <b>Мягкое напоминание:</b>\nВаша подписка на <b>{sub['network']}</b> ({sub['city']}) истекает через 3 дня.\nПодготовьтесь к продлению, чтобы не терять клиентов!", parse_mode="HTML", reply_markup=get_renew_markup(sub['network'], sub['city']))
-                    ad_subs_collection.update_one({"_id": sub["_id"]}, {"$set": {"notified_72h": True}})
-                except: pass
-
-            # 2. Проверка за 24 часа
-            target_24 = now + timedelta(hours=24)
-            expiring_24 = ad_subs_collection.find({"end_date": {"$gte": target_24 - timedelta(hours=1), "$lte": target_24 + timedelta(hours=1)}, "notified_24h": {"$ne": True}})
-            for sub in expiring_24:
-                try:
-                    bot.send_message(sub['user_id'], f"🚨 <b>Остались ровно 1 сутки!</b>\nВаш доступ к <b>{sub['network']}</b> ({sub['city']}) закончится через 24 часа!\n\nЖмите кнопку ниже, чтобы продлить доступ в пару кликов 👇", parse_mode="HTML", reply_markup=get_renew_markup(sub['network'], sub['city']))
-                    ad_subs_collection.update_one({"_id": sub["_id"]}, {"$set": {"notified_24h": True}})
-                except: pass
-
-            # 3. НОВОЕ: Экстренная проверка за 3 часа (Для тех, кто брал на 24 часа)
-            target_3 = now + timedelta(hours=3)
-            expiring_3 = ad_subs_collection.find({"end_date": {"$gte": target_3 - timedelta(hours=1), "$lte": target_3 + timedelta(hours=1)}, "notified_3h": {"$ne": True}})
-            for sub in expiring_3:
-                try:
-                    bot.send_message(sub['user_id'], f"🔥 <b>СГОРАЕТ ЧЕРЕЗ 3 ЧАСА!</b>\nДоступ к <b>{sub['network']}</b> ({sub['city']}) почти истек.\n\nПродлите сейчас, чтобы ваши посты не перестали публиковаться!", parse_mode="HTML", reply_markup=get_renew_markup(sub['network'], sub['city']))
-                    ad_subs_collection.update_one({"_id": sub["_id"]}, {"$set": {"notified_3h": True}})
-                except: pass
+    # --- Функция генерации кнопки продления ---
+    def get_renew_markup(network_name, city):
+        net_key = reverse_names.get(network_name, "mk")
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("♻️ Продлить подписку", callback_data=f"renew_{net_key}_{city}"))
+        return markup
+
+    for _ in range(NOTIFY_BATCH_SIZE):
+        now = now_utc()
+        # Забираем подписку: пока шлем, next_notify_at сдвинут вперед (второй раз ее не возьмут)
+        sub = ad_subs_collection.find_one_and_update(
+            {"next_notify_at": {"$lte": now}},
+            {"$set": {"next_notify_at": now + timedelta(minutes=NOTIFY_CLAIM_MINUTES)}},
+            sort=[("next_notify_at", 1)]
+        )
+        if not sub: break
+
+        # Все созревшие стадии закрываем разом, шлем только самую срочную (если еще не поздно)
+        flags, text = {}, None
+        end_utc = to_utc_naive(sub["end_date"])
+        for hours, flag, stage_text in NOTIFY_STAGES:
+            due = end_utc - timedelta(hours=hours)
+            if sub.get(flag) or due > now: continue
+            flags[flag] = True
+            text = stage_text if due >= now - NOTIFY_LATE_GRACE else None
+
+        if text:
+            try:
+                tg.send_message(sub['user_id'], text.format(network=sub['network'], city=sub['city']), parse_mode="HTML", reply_markup=get_renew_markup(sub['network'], sub['city']))
+                inc_metric("expiry_notifications_sent")
+            except Exception as e:
+                # Флаги не ставим: захват истечет через NOTIFY_CLAIM_MINUTES и стадия уйдет повторно
+                # (пока не вышло окно NOTIFY_LATE_GRACE)
+                inc_metric("expiry_notifications_failed")
+                print(f"⚠️ Напоминание {sub['_id']} не отправлено, повторим: {e}", flush=True)
+                continue
+
+        next_notify_at = get_next_notify_at(sub["end_date"], {**sub, **flags}, now)
+        update = {"$set": flags}
+        if next_notify_at: update["$set"]["next_notify_at"] = next_notify_at
+        else: update["$unset"] = {"next_notify_at": ""}
+        ad_subs_collection.update_one({"_id": sub["_id"]}, update)
+    else:
+        return 0 # Пачка забрана целиком — сразу следующая
+
+    # Спим до ближайшего напоминания (новые подписки будят цикл через notify_wake)
+    upcoming = ad_subs_collection.find_one({"next_notify_at": {"$ne": None}}, {"next_notify_at": 1}, sort=[("next_notify_at", 1)])
+    if not upcoming: return 900
+    return min(max((upcoming["next_notify_at"] - now_utc()).total_seconds(), 1), 900)
+
+# 🔁 Автопостинг: вместо опроса базы раз в минуту — куча ближайших next_run в памяти лидера.
+# Цикл просыпается ровно к сроку ближайшей задачи, забирает созревшие одним update_many и
+# отдает их ограниченному пулу. Создание/отмена задачи будят цикл сразу, если лидер — этот процесс,
+# и увеличивают счетчик settings/autopost_signal для лидера в другом процессе. Счетчик лежит в
+# settings_cache: при живом change stream смена версии будит цикл без опроса, без стрима кэш
+# перечитывает его по TTL, а цикл заглядывает в кэш раз в AUTOPOST_SIGNAL_POLL_SECONDS.
+# Отмененная задача из кучи не выстрелит: захват update_many берет только существующие документы.
+AUTOPOST_WORKERS = int(os.getenv("AUTOPOST_WORKERS", 2))
+AUTOPOST_RESYNC_SECONDS = 600
+AUTOPOST_SIGNAL_POLL_SECONDS = 60 # Только без change stream
+AUTOPOST_CLAIM_MINUTES = 10 # Забранная задача не берется повторно, пока публикуется
+
+def run_autopost(post, user_subs):
+    """Публикует один автопост. Возвращает следующий next_run или None, если задача закрыта"""
+    user_id = post['user_id']
+    network = post['network']
+    city = post['city']
+    now = now_ekb()
 
-            time.sleep(3600)
-        except Exception as e:
-            time.sleep(60)
+    # Подписки юзера уже подгружены пачкой на весь проход
+    def find_sub(net):
+        matches = [sub for sub in user_subs if sub["city"] == city and sub["network"] in ("Все сети", net)]
+        return next((sub for sub in matches if sub.get("has_pin")), matches[0] if matches else None)
 
-# Запускаем поток
-threading.Thread(target=check_expiring_subs, daemon=True).start()
+    # 1. Проверяем, активна ли еще подписка
+    if not find_sub(network):
+        autopost_queue.delete_one({"_id": post["_id"]})
+        return None
 
-def process_autoposts_worker():
-    """Фоновый поток: публикует отложенные посты каждые X часов"""
-    while True:
-        try:
-            refresh_matrix() # <--- ДОБАВИТЬ ЭТУ СТРОКУ СЮДА
-            now = now_ekb()
-            ready_posts = list(autopost_queue.find({"next_run": {"$lte": now}, "posts_left": {"$gt": 0}}))
-            
-            for post in ready_posts:
-                user_id = post['user_id']
-                network = post['network']
-                city = post['city']
-                
-                # 1. Проверяем, активна ли еще подписка
-                if not is_user_paid(user_id, network, city):
-                    autopost_queue.delete_one({"_id": post["_id"]})
-                    continue
-
-                # 2. Проверяем лимит 3 поста на сегодня
-                user_stats = get_user_statistics(user_id)
-                city_stats = user_stats.get("details", {}).get(network, {}).get(city, {})
-                if city_stats.get("remaining", 0) <= 0:
-                    # Лимит исчерпан. Переносим попытку на завтра (на утро)
-                    autopost_queue.update_one(
-                        {"_id": post["_id"]},
-                        {"$set": {"next_run": now.replace(hour=8, minute=0) + timedelta(days=1)}}
-                    )
-                    continue
-
-                # 3. Публикация
-                try:
-                    user_info = bot.get_chat(user_id)
-                    user_name = f'<b>{get_user_html_link(user_info)}</b>'
-                except:
-                    user_name = f'<b><a href="tg://user?id={user_id}">Пользователь</a></b>'
-                    
-                networks = ["Мужской Клуб", "ПАРНИ 18+", "НС", "Радуга", "Гей Знакомства"] if network == "Все сети" else [network]
-                
-                for net in networks:
-                    net_key = normalize_network_key(net)
-                    city_data = all_cities.get(city, {}).get(net_key)
-                    if not city_data: continue
-                    
-                    signature = network_signatures.get(net, "")
-                    full_text = f"{ad_top_stickers}📢 Объявление от {user_name}:\n\n{post['text']}\n\n{signature}"
-                    reply_markup = types.InlineKeyboardMarkup()
-                    reply_markup.add(types.InlineKeyboardButton(text="Напиши мне в ЛС", url=f"tg://user?id={user_id}", style="success", icon_custom_emoji_id="5470060791883374114"))
-                    
-                    for location in city_data:
-                        chat_id = location["chat_id"]
-                        try:
-                            media_msg_ids = None # 👈 Добавили переменную для автопостов
-                            
-                            if post['media_type'] == "album":
-                                media_list = []
-                                for m in post.get('media_array', []):
-                                    if m['type'] == 'photo': media_list.append(types.InputMediaPhoto(m['id']))
-                                    else: media_list.append(types.InputMediaVideo(m['id']))
-                                
-                                # 1. Кидаем медиа и собираем ID
-                                sent_media = bot.send_media_group(chat_id, media_list)
-                                media_msg_ids = [m.message_id for m in sent_media]
-                                
-                                # 2. Следом текст
-                                sent_msg = bot.send_message(chat_id, full_text, parse_mode="HTML", reply_markup=reply_markup)
-                                
-                            elif post['media_type'] == "photo": 
-                                sent_msg = bot.send_photo(chat_id, post['file_id'], caption=full_text, parse_mode="HTML", reply_markup=reply_markup)
-                            elif post['media_type'] == "video": 
-                                sent_msg = bot.send_video(chat_id, post['file_id'], caption=full_text, parse_mode="HTML", reply_markup=reply_markup)
-                            else: 
-                                sent_msg = bot.send_message(chat_id, full_text, parse_mode="HTML", reply_markup=reply_markup)
-                            
-                            # 💥 Пишем в историю, передавая media_msg_ids (как в ручной публикации!)
-                            add_post_to_history(user_id, "Автопост", net, location['name'], chat_id, sent_msg.message_id, media_message_ids=media_msg_ids)
-                            
-                            # Проверяем закреп
-                            sub = ad_subs_collection.find_one({"user_id": user_id, "city": city, "network": {"$in": ["Все сети", net]}, "end_date": {"$gt": now_ekb()}})
-                            if sub and sub.get("has_pin"):
-                                try: bot.pin_chat_message(chat_id, sent_msg.message_id, disable_notification=True)
-                                except: pass
-                                
-                        except Exception as e: pass
-                            
-                # 4. Обновляем счетчик
-                posts_left = post['posts_left'] - 1
-                if posts_left > 0:
-                    autopost_queue.update_one(
-                        {"_id": post["_id"]}, 
-                        {"$set": {"posts_left": posts_left, "next_run": now + timedelta(hours=post['interval_hours'])}}
-                    )
-                else:
-                    autopost_queue.delete_one({"_id": post["_id"]})
-                    try: bot.send_message(user_id, f"ℹ️ Серия автопубликаций для <b>{network} ({city})</b> завершена (3 из 3 постов вышли).", parse_mode="HTML")
-                    except: pass
-                    
-        except Exception as e: pass
-        time.sleep(60) # Проверка базы раз в минуту
+    # 2. Проверяем лимит 3 поста на сегодня
+    user_stats = get_user_statistics(user_id, active_subs=user_subs)
+    city_stats = user_stats.get("details", {}).get(network, {}).get(city, {})
+    if city_stats.get("remaining", 0) <= 0:
+        # Лимит исчерпан. Переносим попытку на завтра (на утро)
+        next_run = now.replace(hour=8, minute=0) + timedelta(days=1)
+        autopost_queue.update_one({"_id": post["_id"]}, {"$set": {"next_run": next_run}, "$unset": {"claim": ""}})
+        return next_run
+
+    # 3. Публикация
+    user_info = user_profiles.get(user_id)
+    if user_info:
+        user_name = f'<b>{get_user_html_link(user_info)}</b>'
+    else:
+        user_name = f'<b><a href="tg://user?id={user_id}">Пользователь</a></b>'
+        
+    networks = ["Мужской Клуб", "ПАРНИ 18+", "НС", "Радуга", "Гей Знакомства"] if network == "Все сети" else [network]
+    
+    reply_markup = types.InlineKeyboardMarkup()
+    reply_markup.add(types.InlineKeyboardButton(text="Напиши мне в ЛС", url=f"tg://user?id={user_id}", style="success", icon_custom_emoji_id="5470060791883374114"))
+
+    targets = [] # (сеть, чат)
+    jobs = []
+    for net in networks:
+        net_key = normalize_network_key(net)
+        city_data = matrix.all_cities.get(city, {}).get(net_key)
+        if not city_data: continue
+        
+        signature = network_signatures.get(net, "")
+        full_text = f"{ad_top_stickers}📢 Объявление от {user_name}:\n\n{post['text']}\n\n{signature}"
+
+        # Закреп — из уже подгруженных подписок
+        sub = find_sub(net)
+        has_pin = bool(sub and sub.get("has_pin"))
+
+        for location in city_data:
+            targets.append((net, location))
+            jobs.append(lambda chat_id=location["chat_id"], full_text=full_text, has_pin=has_pin: send_ad_to_chat(
+                chat_id, full_text, reply_markup, post['media_type'], post.get('file_id'), post.get('media_array', []), pin=has_pin))
+
+    history = []
+    for (net, location), (sent, error) in zip(targets, publish_engine.run(jobs)):
+        if error: continue
+        main_msg_id, media_msg_ids = sent
+        # 💥 Пишем в историю, передавая media_msg_ids (как в ручной публикации!)
+        history.append(make_history_post(user_id, "Автопост", net, location['name'], location["chat_id"], main_msg_id, media_message_ids=media_msg_ids))
+    add_posts_to_history(history)
+
+    # 4. Обновляем счетчик
+    posts_left = post['posts_left'] - 1
+    if posts_left > 0:
+        next_run = now + timedelta(hours=post['interval_hours'])
+        autopost_queue.update_one(
+            {"_id": post["_id"]}, 
+            {"$set": {"posts_left": posts_left, "next_run": next_run}, "$unset": {"claim": ""}}
+        )
+        return next_run
+
+    autopost_queue.delete_one({"_id": post["_id"]})
+    try: tg.send_message(user_id, f"ℹ️ Серия автопубликаций для <b>{network} ({city})</b> завершена (3 из 3 постов вышли).", parse_mode="HTML")
+    except: pass
+    return None
 
-# 👇 ЗАПУСКАЕМ НАШ НОВЫЙ ПОТОК (Вставить перед if __name__ == '__main__':)
-threading.Thread(target=process_autoposts_worker, daemon=True).start()
+class AutopostScheduler:
+    def __init__(self, workers):
+        self.heap = []          # (next_run в UTC, id задачи)
+        self.scheduled = {}     # id -> next_run; записи кучи, не совпадающие с ним, устарели
+        self.in_flight = set()  # задачи, которые сейчас публикуются
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.last_resync = 0
+        self.signal_version = None # последняя увиденная версия settings/autopost_signal в settings_cache
+        self.wake = None        # Event лидер-цикла
+
+    def push(self, task_id, next_run):
+        """Ставит (или переносит) задачу в куче"""
+        next_run = to_utc_naive(next_run)
+        with self.lock:
+            self.scheduled[task_id] = next_run
+            heapq.heappush(self.heap, (next_run, task_id))
+        if self.wake: self.wake.set()
+
+    def discard(self, task_id):
+        with self.lock:
+            self.scheduled.pop(task_id, None)
+
+    def signal(self):
+        """Сообщает лидеру (в любом процессе) об изменении очереди"""
+        db['settings'].update_one({"_id": "autopost_signal"}, {"$inc": {"version": 1}}, upsert=True)
+        self.notify()
+
+    def notify(self):
+        if self.wake: self.wake.set()
+
+    def signal_changed(self):
+        """True, если с прошлой проверки очередь меняли (в том числе другие процессы). Без запроса в Mongo"""
+        version = settings_cache.version("autopost_signal")
+        changed = self.signal_version is not None and version != self.signal_version
+        self.signal_version = version
+        return changed
+
+    def resync(self):
+        """Полная пересборка кучи из autopost_queue"""
+        self.signal_changed() # Все изменения до этой точки попадут в пересборку
+        tasks = list(autopost_queue.find({"posts_left": {"$gt": 0}}, {"next_run": 1}).sort("next_run", pymongo.ASCENDING))
+        with self.lock:
+            self.scheduled = {task["_id"]: task["next_run"] for task in tasks if task["_id"] not in self.in_flight}
+            self.heap = [(next_run, task_id) for task_id, next_run in self.scheduled.items()]
+            heapq.heapify(self.heap)
+        self.last_resync = time.time()
+
+    def pop_due(self, now):
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                next_run, task_id = heapq.heappop(self.heap)
+                if self.scheduled.get(task_id) != next_run: continue
+                del self.scheduled[task_id]
+                self.in_flight.add(task_id)
+                due.append(task_id)
+        return due
+
+    def next_delay(self):
+        """Секунд до ближайшей задачи (или до пересинхронизации)"""
+        with self.lock:
+            while self.heap and self.scheduled.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            until_next = (self.heap[0][0] - now_utc()).total_seconds() if self.heap else AUTOPOST_RESYNC_SECONDS
+        until_resync = self.last_resync + AUTOPOST_RESYNC_SECONDS - time.time()
+        # Со change stream о чужих изменениях сообщит слушатель settings_cache — спим ровно до срока
+        until_poll = AUTOPOST_RESYNC_SECONDS if settings_cache.watching else AUTOPOST_SIGNAL_POLL_SECONDS
+        return max(0.5, min(until_next, until_resync, until_poll))
+
+    def run_task(self, post, user_subs):
+        next_run = None
+        try:
+            next_run = run_autopost(post, user_subs)
+        except Exception as e:
+            inc_metric("autopost_errors")
+            print(f"⚠️ Ошибка автопоста {post['_id']}: {e}", flush=True)
+            next_run = now_utc() + timedelta(minutes=AUTOPOST_CLAIM_MINUTES) # Вернется, когда истечет захват
+        finally:
+            with self.lock: self.in_flight.discard(post["_id"])
+        if next_run: self.push(post["_id"], next_run)
+
+    def tick(self):
+        """Фоновая задача (один проход): отдает созревшие автопосты в пул"""
+        if time.time() - self.last_resync >= AUTOPOST_RESYNC_SECONDS or self.signal_changed():
+            self.resync()
+        now = now_utc()
+        due_ids = self.pop_due(now)
+        if due_ids:
+            refresh_matrix()
+            # Захват одним запросом: next_run сдвигается на время публикации, claim метит пачку
+            claim = uuid.uuid4().hex
+            autopost_queue.update_many(
+                {"_id": {"$in": due_ids}, "next_run": {"$lte": now}, "posts_left": {"$gt": 0}},
+                {"$set": {"next_run": now + timedelta(minutes=AUTOPOST_CLAIM_MINUTES), "claim": claim}}
+            )
+            posts = list(autopost_queue.find({"_id": {"$in": due_ids}, "claim": claim}))
+            with self.lock: self.in_flight -= set(due_ids) - {post["_id"] for post in posts}
+
+            # Подписки всех владельцев — тоже одним запросом
+            subs_by_user = defaultdict(list)
+            for sub in ad_subs_collection.find({"user_id": {"$in": list({post["user_id"] for post in posts})}, "end_date": {"$gt": now_ekb()}}):
+                subs_by_user[sub["user_id"]].append(sub)
+            for post in posts:
+                self.executor.submit(self.run_task, post, subs_by_user[post["user_id"]])
+            inc_metric("autoposts_dispatched", len(posts))
+        return self.next_delay()
+
+autopost_scheduler = AutopostScheduler(AUTOPOST_WORKERS)
+settings_cache.listeners["autopost_signal"].append(autopost_scheduler.notify)
+metrics_gauges["autopost_heap_size"] = lambda: len(autopost_scheduler.scheduled)
 
 # === ДАТЧИК ПУЛЬСА РЕКЛАМНОГО БОТА ===
 def heartbeat_ads():
-    import time
-    while True:
+    db['settings'].update_one({"_id": "bot_status"}, {"$set": {"ads_last_seen": time.time()}}, upsert=True)
+    return 60
+# ====================================
+
+# ==================== 👑 ЛИДЕР ДЛЯ ФОНОВЫХ ЗАДАЧ ====================
+# Фоновые циклы не должны дублироваться, когда процессов на время больше одного (деплой,
+# перезапуск дайно с перекрытием, ручной запуск рядом): каждый цикл крутится только в процессе,
+# который держит аренду (lease) в коллекции leases. Лидер продлевает аренду каждые LEASE_TTL/3 секунд,
+# если он умер — аренда протухает и ее забирает любой другой живой процесс.
+# Ограничение: бот рассчитан на ОДИН веб-процесс (Procfile: --workers 1, один web-дайно).
+# Порядок апдейтов юзера (UpdateDispatcher), дедуп update_id (RecentIdCache), сборка альбомов
+# и буфер журнала отказов (BufferedWriter) живут в памяти процесса, поэтому масштабирование
+# на несколько воркеров не поддерживается — пропускная способность растет за счет потоков
+# UPDATE_WORKERS внутри процесса.
+LEASE_TTL_SECONDS = int(os.getenv("LEASE_TTL_SECONDS", 60))
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+leases_collection = db['leases']
+leader_leases = []
+
+class LeaderLease:
+    """Аренда лидерства на одну фоновую задачу, хранится в документе leases/{name}"""
+    def __init__(self, name, ttl=LEASE_TTL_SECONDS):
+        self.name = name
+        self.ttl = ttl
+        self.held_until = 0.0 # time.monotonic(), до которого мы точно лидер
+
+    @property
+    def is_leader(self):
+        return time.monotonic() < self.held_until
+
+    def renew(self):
+        """Захватывает свободную/протухшую аренду или продлевает свою. True — мы лидер"""
+        started = time.monotonic()
+        now = now_ekb()
         try:
-            db['settings'].update_one({"_id": "bot_status"}, {"$set": {"ads_last_seen": time.time()}}, upsert=True)
-        except: pass
-        time.sleep(60)
+            leases_collection.update_one(
+                {"_id": self.name, "$or": [{"owner": INSTANCE_ID}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": INSTANCE_ID, "expires_at": now + timedelta(seconds=self.ttl), "renewed_at": now}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Документ есть, и его держит другой живой процесс
+            if self.is_leader: inc_metric(f"lease_lost_{self.name}")
+            self.held_until = 0.0
+            return False
+        except Exception as e:
+            # Mongo недоступна: остаемся лидером только до конца уже оплаченной аренды
+            print(f"⚠️ Не удалось продлить аренду {self.name}: {e}", flush=True)
+            return self.is_leader
 
-import threading
-threading.Thread(target=heartbeat_ads, daemon=True).start()
+        if not self.is_leader: inc_metric(f"lease_acquired_{self.name}")
+        # Берем запас в треть TTL на расхождение часов и задержки сети
+        self.held_until = started + self.ttl * 2 / 3
+        return True
+
+    def release(self):
+        if self.is_leader:
+            self.held_until = 0.0
+            try: leases_collection.delete_one({"_id": self.name, "owner": INSTANCE_ID})
+            except Exception: pass
+
+def start_leader_loop(name, tick):
+    """Запускает фоновый цикл, работающий только у лидера аренды name.
+
+    tick() выполняет одну итерацию и возвращает, сколько секунд ждать следующей.
+    Возвращает threading.Event: set() будит цикл досрочно.
+    """
+    lease = LeaderLease(name)
+    leader_leases.append(lease)
+    wake = threading.Event()
+    metrics_gauges[f"leader_{name}"] = lambda: int(lease.is_leader)
+
+    def runner():
+        while True:
+            delay = LEASE_TTL_SECONDS / 3
+            if lease.is_leader or lease.renew():
+                try:
+                    delay = tick()
+                except Exception as e:
+                    inc_metric(f"background_errors_{name}")
+                    print(f"⚠️ Ошибка фоновой задачи {name}: {e}", flush=True)
+                    delay = 60
+            wake.wait(delay)
+            wake.clear()
+
+    threading.Thread(target=runner, daemon=True).start()
+    return wake
+
+def renew_leases_forever():
+    while True:
+        for lease in list(leader_leases):
+            lease.renew()
+        time.sleep(LEASE_TTL_SECONDS / 3)
+
+@atexit.register
+def release_leases():
+    """При штатной остановке (деплой) сразу отдаем аренды, не дожидаясь их протухания"""
+    for lease in leader_leases:
+        lease.release()
+
+def start_background_workers():
+    global payments_wake, notify_wake
+    threading.Thread(target=renew_leases_forever, daemon=True).start()
+    payments_wake = start_leader_loop("payments", fulfil_payments)
+    notify_wake = start_leader_loop("expiring_subs", check_expiring_subs)
+    autopost_scheduler.wake = start_leader_loop("autoposts", autopost_scheduler.tick)
+    start_leader_loop("heartbeat", heartbeat_ads)
+    start_leader_loop("member_counts", sweep_member_counts)
+    start_leader_loop("quota_rebuild", rebuild_quota_ledger_tick)
+
+if not CLI_COMMAND:
+    start_background_workers()
 # ====================================
 
 if __name__ == '__main__':
+    if CLI_COMMAND == "verify-indexes":
+        failed_queries = verify_query_plans()
+        if failed_queries:
+            print(f"❌ COLLSCAN в запросах: {', '.join(failed_queries)}", flush=True)
+        sys.exit(1 if failed_queries else 0)
+    elif CLI_COMMAND == "rebuild-quota":
+        days = int(sys.argv[2]) if len(sys.argv) > 2 else QUOTA_LEDGER_DAYS
+        print(f"✅ Леджер квот пересобран: {rebuild_quota_ledger(days)} счетчиков за {days} дн.", flush=True)
+        sys.exit(0)
+    elif CLI_COMMAND:
+        sys.exit(f"❌ Неизвестная команда: {CLI_COMMAND}")
+
     print("✅ Скайнет-Модуль mpserv запущен!")
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file